@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import logging
+import os
+import socket
+import threading
+import time
+from typing import ContextManager, Dict, Iterator, List, Optional
+import uuid
+
+from base_util import locked_json_file
+from config import (
+    lease_ttl,
+    asr_admission_control,
+    asr_admission_dir,
+    asr_admission_poll_interval,
+    asr_memory_base_mb,
+    asr_memory_per_minute_mb,
+    asr_memory_limit_mb,
+    asr_cpus_per_job,
+)
+
+logger = logging.getLogger(__name__)
+# in ASR_ADMISSION_DIR, the decodes running on this node (by all worker processes)
+RESERVATIONS_FILE = "dane_asr_reservations.json"
+CGROUP_MEMORY_MAX = "/sys/fs/cgroup/memory.max"  # cgroup v2
+MB = 1024 * 1024
+HEARTBEATS_PER_TTL = 3  # renewals within LEASE_TTL, so one missed renewal is fine
+
+
+@dataclass
+class AsrSlot:
+    key: str = ""  # empty if admission control is disabled
+    memory: int = 0  # bytes reserved for the decode
+    cpus: List[int] = field(default_factory=list)  # cores reserved for the decode
+
+
+# bytes a decode of audio_duration secs is expected to need
+def estimate_memory(audio_duration: float) -> int:
+    minutes = max(audio_duration, 0) / 60
+    return int((asr_memory_base_mb + asr_memory_per_minute_mb * minutes) * MB)
+
+
+# waits until the node has the memory and cores for the decode and reserves them until
+# leaving the with block. A decode is always admitted when no other decode is running
+# on the node, so a job that is estimated to need more than the budget still runs.
+# The workers sharing ASR_ADMISSION_DIR may run in containers (with their own PIDs),
+# so a reservation expires after LEASE_TTL unless it is renewed by its worker
+@contextmanager
+def admit(audio_duration: float) -> Iterator[AsrSlot]:
+    if not asr_admission_control:
+        yield AsrSlot()
+        return
+    memory = estimate_memory(audio_duration)
+    start_time = time.time()
+    slot = _try_reserve(memory, asr_cpus_per_job)
+    if slot is None:
+        logger.info(f"Waiting for {memory // MB}MB and {asr_cpus_per_job} core(s)")
+    while slot is None:
+        time.sleep(asr_admission_poll_interval)
+        slot = _try_reserve(memory, asr_cpus_per_job)
+    logger.info(
+        f"Admitted the decode after {time.time() - start_time:.1f}s: "
+        f"{slot.memory // MB}MB, cores {slot.cpus}"
+    )
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(
+        target=_renew, args=(slot, stop_event), name=f"asr-{slot.key}", daemon=True
+    )
+    heartbeat.start()
+    try:
+        yield slot
+    finally:
+        stop_event.set()
+        heartbeat.join()
+        _release(slot)
+
+
+def _try_reserve(memory: int, num_cpus: int) -> Optional[AsrSlot]:
+    with _locked_reservations() as reservations:
+        now = time.time()
+        for key in [k for k, r in reservations.items() if not _is_valid(r, now)]:
+            logger.warning(f"Removing the expired reservation of a worker: {key}")
+            del reservations[key]
+        reserved_memory = sum([r["memory"] for r in reservations.values()])
+        reserved_cpus = set([c for r in reservations.values() for c in r["cpus"]])
+        free_cpus = [
+            c for c in sorted(os.sched_getaffinity(0)) if c not in reserved_cpus
+        ]
+        if reservations and (
+            reserved_memory + memory > _memory_budget()
+            or memory > _available_memory()
+            or len(free_cpus) < num_cpus
+        ):
+            return None
+        slot = AsrSlot(_new_key(), memory, free_cpus[:num_cpus])
+        reservations[slot.key] = {
+            "memory": slot.memory,
+            "cpus": slot.cpus,
+            "since": now,
+            "expires_at": now + lease_ttl,
+        }
+        return slot
+
+
+# extends the reservation every LEASE_TTL / 3 secs until stop_event is set
+def _renew(slot: AsrSlot, stop_event: threading.Event):
+    while not stop_event.wait(lease_ttl / HEARTBEATS_PER_TTL):
+        try:
+            with _locked_reservations() as reservations:
+                if slot.key in reservations:
+                    reservations[slot.key]["expires_at"] = time.time() + lease_ttl
+        except (OSError, ValueError):
+            logger.exception("Failed to renew the ASR reservation")
+
+
+def _release(slot: AsrSlot):
+    with _locked_reservations() as reservations:
+        reservations.pop(slot.key, None)
+
+
+# host, PID & a random ID, so keys of workers in other containers never collide
+def _new_key() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# reservations of older versions (with only a PID) have no expiry and are dropped
+def _is_valid(reservation: dict, now: float) -> bool:
+    return reservation.get("expires_at", 0) > now
+
+
+# bytes the decodes on this node may use together
+def _memory_budget() -> int:
+    if asr_memory_limit_mb:
+        return asr_memory_limit_mb * MB
+    try:
+        with open(CGROUP_MEMORY_MAX, "r") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            return int(limit)
+    except (OSError, ValueError):
+        pass
+    return _meminfo().get("MemTotal", 0)
+
+
+def _available_memory() -> int:
+    return _meminfo().get("MemAvailable", 0)
+
+
+# /proc/meminfo in bytes
+def _meminfo() -> Dict[str, int]:
+    info = {}
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                info[name] = int(value.split()[0]) * 1024  # in KB
+    except (OSError, ValueError):
+        logger.exception("Could not read /proc/meminfo")
+    return info
+
+
+def _locked_reservations() -> ContextManager[Dict[str, dict]]:
+    return locked_json_file(os.path.join(asr_admission_dir, RESERVATIONS_FILE), dict)
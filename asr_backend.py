@@ -0,0 +1,299 @@
+from abc import ABC, abstractmethod
+import json
+import logging
+import os
+from queue import Empty, Queue
+import signal
+import subprocess
+import threading
+import time
+from typing import IO, List, Optional
+
+from base_util import CommandResult, record_command
+
+logger = logging.getLogger(__name__)
+STOP_TIMEOUT = 10  # secs a decoder process gets to exit after its stdin is closed
+
+# Protocol spoken by the decoder processes of the PersistentBackend: once the models
+# are loaded the decoder writes {"status": "ready"} on a line to its stdout. Then it
+# reads one job per line from its stdin, {"input": <audio file>, "output": <dir>},
+# and writes the Kaldi_NL output (1Best.ctm, 1Best.txt) to the output dir. When done
+# it writes {"status": "ok"} (or {"status": "error", "message": ...}). Other lines on
+# stdout/stderr are logged. The decoder should exit when its stdin is closed.
+READY = "ready"
+OK = "ok"
+
+
+class AsrBackend(ABC):
+    """
+    Runs the ASR on a single audio file, writing the Kaldi_NL output to output_dir,
+    optionally pinned to the given cores. Must be safe to call from multiple threads
+    (see segmented_asr.py).
+    """
+
+    @abstractmethod
+    def decode(
+        self, input_path: str, output_dir: str, cpus: Optional[List[int]] = None
+    ) -> bool:
+        pass
+
+    # releases the resources (e.g. processes) held by the backend
+    def close(self):
+        pass
+
+
+class DecoderProcess:
+    """
+    A long-lived decoder process (see the protocol above), with its models loaded.
+    """
+
+    def __init__(self, cmd: str, cwd: Optional[str] = None):
+        self.cmd = cmd
+        self.jobs = 0  # number of jobs decoded so far
+        self._messages: Queue[Optional[dict]] = Queue()  # None: stdout was closed
+        logger.info(f"Starting decoder process: {cmd}")
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=True,
+            cwd=cwd,
+            start_new_session=True,  # so the whole process group can be stopped
+            text=True,
+            errors="replace",
+            bufsize=1,
+        )
+        for target, stream in [
+            (self._read_messages, self.process.stdout),
+            (self._log_lines, self.process.stderr),
+        ]:
+            threading.Thread(target=target, args=(stream,), daemon=True).start()
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    # waits until the models are loaded
+    def wait_until_ready(self, timeout: float) -> bool:
+        message = self._next_message(timeout)
+        if not message or message.get("status") != READY:
+            logger.error(f"Decoder process {self.pid} did not start: {message}")
+            return False
+        logger.info(f"Decoder process {self.pid} is ready")
+        return True
+
+    # timeout in secs (0 = no timeout), on a timeout the process is stopped. Like
+    # run_shell_command, the resource usage of the job is recorded as a CommandResult
+    def decode(self, input_path: str, output_dir: str, timeout: float = 0) -> bool:
+        result = CommandResult(start_time=time.time())
+        cpu_start = self.cpu_time()
+        try:
+            self.process.stdin.write(  # type: ignore
+                json.dumps({"input": input_path, "output": output_dir}) + "\n"
+            )
+            self.process.stdin.flush()  # type: ignore
+        except OSError:
+            logger.exception(f"Could not send the job to decoder process {self.pid}")
+            return False
+        self.jobs += 1
+        message = self._next_message(timeout)
+        result.wall_time = time.time() - result.start_time
+        result.cpu_time = self.cpu_time() - cpu_start
+        result.max_rss = self.rss()  # the models stay loaded, so about the peak
+        if message is None:
+            logger.error(f"Decoder process {self.pid} timed out or died")
+            result.timed_out = self.is_alive()
+            self.stop()
+        elif message.get("status") != OK:
+            logger.error(f"Decoder process {self.pid} failed: {message}")
+            result.return_code = 1
+        else:
+            result.return_code = 0
+            logger.info(
+                f"Decoder process {self.pid} done in {result.wall_time:.1f}s "
+                f"(job {self.jobs}, RSS: {result.max_rss} bytes)"
+            )
+        record_command(result)
+        return result.success
+
+    # pins the process and the processes it starts from now on to the given cores
+    def set_affinity(self, cpus: List[int]):
+        for pid in _process_group_pids(self.pid):
+            try:
+                os.sched_setaffinity(pid, cpus)
+            except OSError:
+                pass  # the process exited meanwhile
+
+    # bytes, the resident memory of the process and the processes it started
+    def rss(self) -> int:
+        total = 0
+        for pid in _process_group_pids(self.pid):
+            try:
+                with open(f"/proc/{pid}/status", "r") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) * 1024  # in KB
+            except (OSError, ValueError):
+                pass  # the process exited meanwhile
+        return total
+
+    # secs, the CPU time of the processes in the process group (of those still running)
+    def cpu_time(self) -> float:
+        ticks = 0
+        for pid in _process_group_pids(self.pid):
+            try:
+                with open(f"/proc/{pid}/stat", "r") as f:
+                    # the fields after the command (which may contain spaces)
+                    fields = f.read().rsplit(")", 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])  # utime & stime
+            except (OSError, ValueError, IndexError):
+                pass  # the process exited meanwhile
+        return ticks / os.sysconf("SC_CLK_TCK")
+
+    # closes stdin so the decoder exits by itself, kills it if it does not
+    def stop(self):
+        logger.info(f"Stopping decoder process {self.pid}")
+        try:
+            self.process.stdin.close()  # type: ignore
+            self.process.wait(timeout=STOP_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        try:
+            os.killpg(self.pid, signal.SIGKILL)  # also its children
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def _next_message(self, timeout: float) -> Optional[dict]:
+        try:
+            return self._messages.get(timeout=timeout if timeout > 0 else None)
+        except Empty:
+            return None
+
+    def _read_messages(self, stream: IO[str]):
+        for line in stream:
+            line = line.rstrip()
+            try:
+                message = json.loads(line)
+            except ValueError:
+                message = None
+            if isinstance(message, dict) and "status" in message:
+                self._messages.put(message)
+            else:
+                logger.info(line)
+        stream.close()
+        self._messages.put(None)
+
+    def _log_lines(self, stream: IO[str]):
+        for line in stream:
+            logger.info(line.rstrip())
+        stream.close()
+
+
+class PersistentBackend(AsrBackend):
+    """
+    Keeps a pool of decoder processes, so the models are not loaded again for every
+    file. A process is started when it is first needed and replaced after max_jobs
+    jobs (0 = no max), when its memory exceeds max_rss bytes (0 = no max) or when a
+    job failed or timed out. Decodes wait for a free process when they are all busy.
+    """
+
+    def __init__(
+        self,
+        cmd: str,
+        pool_size: int = 1,
+        max_jobs: int = 0,
+        max_rss: int = 0,
+        startup_timeout: float = 600,
+        decode_timeout: float = 0,
+        cwd: Optional[str] = None,
+    ):
+        self.cmd = cmd
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.startup_timeout = startup_timeout
+        self.decode_timeout = decode_timeout
+        self.cwd = cwd
+        # a slot per process, None until the process is (re)started
+        self._idle: Queue[Optional[DecoderProcess]] = Queue()
+        for _ in range(pool_size):
+            self._idle.put(None)
+        self._started: List[DecoderProcess] = []
+        self._lock = threading.Lock()
+
+    def decode(
+        self, input_path: str, output_dir: str, cpus: Optional[List[int]] = None
+    ) -> bool:
+        decoder = self._idle.get()
+        try:
+            if decoder is None or not decoder.is_alive():
+                decoder = self._start()
+                if decoder is None:
+                    return False
+            decoder.set_affinity(cpus or sorted(os.sched_getaffinity(0)))
+            success = decoder.decode(input_path, output_dir, self.decode_timeout)
+            if self._needs_recycling(decoder, success):
+                self._stop(decoder)
+                decoder = None
+            return success
+        finally:
+            self._idle.put(decoder)
+
+    def close(self):
+        with self._lock:
+            started = list(self._started)
+        for decoder in started:
+            self._stop(decoder)
+
+    def _start(self) -> Optional[DecoderProcess]:
+        try:
+            decoder = DecoderProcess(self.cmd, self.cwd)
+        except OSError:
+            logger.exception("Could not start a decoder process")
+            return None
+        with self._lock:
+            self._started.append(decoder)
+        if not decoder.wait_until_ready(self.startup_timeout):
+            self._stop(decoder)
+            return None
+        return decoder
+
+    def _stop(self, decoder: DecoderProcess):
+        if decoder.is_alive():
+            decoder.stop()
+        with self._lock:
+            if decoder in self._started:
+                self._started.remove(decoder)
+
+    def _needs_recycling(self, decoder: DecoderProcess, success: bool) -> bool:
+        if not decoder.is_alive():
+            return True
+        if not success:  # its state (e.g. a half finished job) cannot be trusted
+            logger.info(f"Decoder process {decoder.pid} failed a job")
+            return True
+        if self.max_jobs and decoder.jobs >= self.max_jobs:
+            logger.info(f"Decoder process {decoder.pid} did {decoder.jobs} jobs")
+            return True
+        rss = decoder.rss() if self.max_rss else 0
+        if rss > self.max_rss:
+            logger.info(f"Decoder process {decoder.pid} uses {rss} bytes")
+            return True
+        return False
+
+
+# the processes in the process group (the decoder was started in its own session)
+def _process_group_pids(pgid: int) -> List[int]:
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            if os.getpgid(int(entry)) == pgid:
+                pids.append(int(entry))
+        except OSError:
+            pass
+    return pids
@@ -1,13 +1,39 @@
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+import fcntl
+import hashlib
+import json
 import logging
 import ntpath
 import os
+import signal
 import subprocess
-from typing import Tuple
+import threading
+import time
+from typing import (
+    IO,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 from config import output_base_dir
 
 
 LOG_FORMAT = "%(asctime)s|%(levelname)s|%(process)d|%(module)s|%(funcName)s|%(lineno)d|%(message)s"
 logger = logging.getLogger(__name__)
+STDERR_TAIL_LINES = 20  # logged as errors when a command fails
+KILL_GRACE_PERIOD = 10  # secs between SIGTERM and SIGKILL when killing a command
+READER_JOIN_TIMEOUT = 5  # secs to wait for the output of a command after it exited
+
+_running_commands: Dict[int, "CommandResult"] = {}  # by pid (= process group ID)
+_running_lock = threading.Lock()
+_command_logs = threading.local()  # the CommandLog of the thread (see command_log)
 
 
 # the file name without extension is used as asset ID
@@ -18,30 +44,307 @@ def get_asset_info(input_file: str) -> Tuple[str, str]:
     return asset_id, extension
 
 
-# i.e. {output_base_dir}/output/{input_filename_without_extension}
+# the asset ID, prefixed with the URI hash dir if the input was downloaded into one
+# (i.e. another URI has the same file name, see download_cache.file_path_for)
+def asset_key(input_path: str) -> str:
+    asset_id, _ = get_asset_info(input_path)
+    input_dir = os.path.dirname(os.path.abspath(input_path))
+    if os.path.dirname(input_dir) == os.path.abspath(output_base_dir):
+        return os.path.join(os.path.basename(input_dir), asset_id)
+    return asset_id
+
+
+# i.e. {output_base_dir}/output/{input_filename_without_extension}, or
+# {output_base_dir}/output/{URI hash}/{input_filename_without_extension}
 def asr_output_dir(input_path):
-    return os.path.join(output_base_dir, "output", get_asset_info(input_path)[0])
+    return os.path.join(output_base_dir, "output", asset_key(input_path))
+
+
+# sha256 of the file, read in chunks so large files do not end up in memory
+def file_checksum(path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# loads a JSON (index) file, which is saved again when leaving the with block. A lock
+# file next to it keeps other threads/processes out in the meantime. With
+# remove_if_empty, an empty dict removes the file and its lock file instead
+@contextmanager
+def locked_json_file(
+    path: str, default: Callable[[], dict], remove_if_empty: bool = False
+) -> Iterator[dict]:
+    with _locked_file(f"{path}.lock") as lock:
+        try:
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            else:
+                data = default()
+            yield data
+            if remove_if_empty and not data:
+                if os.path.exists(path):
+                    os.remove(path)
+                os.remove(lock.name)  # still locked, see _locked_file
+                return
+            with open(f"{path}.part", "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(f"{path}.part", path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# opens & locks the lock file. As it may have been removed by its previous holder
+# (while this process was waiting for it), it is opened again until the locked file
+# is the one at lock_path
+def _locked_file(lock_path: str) -> IO[str]:
+    while True:
+        lock = open(lock_path, "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+@dataclass
+class CommandResult:
+    return_code: int = -1
+    start_time: float = 0  # time.time() when the command was started
+    wall_time: float = 0  # secs
+    cpu_time: float = 0  # secs, user + system time of the command (and its children)
+    max_rss: int = 0  # bytes, peak memory of the command (or its largest child)
+    timed_out: bool = False
+    cancelled: bool = False  # e.g. killed because the worker received a SIGTERM
+    input_failed: bool = False  # reading the stdin chunks failed, the command is killed
+
+    @property
+    def success(self) -> bool:
+        return (
+            self.return_code == 0
+            and not self.timed_out
+            and not self.cancelled
+            and not self.input_failed
+        )
 
 
-# used by asr.py and transcode.py
-def run_shell_command(cmd: str) -> bool:
+class CommandLog:
+    """
+    The results of the commands run within a command_log block, e.g. to attach the
+    resource usage of Kaldi_NL/ffmpeg to the metrics of the stage that ran them.
+    """
+
+    def __init__(self):
+        self.results: List[CommandResult] = []
+        self._lock = threading.Lock()
+
+    def add(self, result: CommandResult):
+        with self._lock:
+            self.results.append(result)
+
+    # secs at least one of the commands was running (they may run in parallel)
+    def busy_time(self) -> float:
+        with self._lock:
+            intervals = sorted(
+                [(r.start_time, r.start_time + r.wall_time) for r in self.results]
+            )
+        busy, busy_until = 0.0, 0.0
+        for start, end in intervals:
+            if end > busy_until:
+                busy += end - max(start, busy_until)
+                busy_until = end
+        return busy
+
+
+# the commands run by this thread in the with block are added to the (new) log.
+# Threads started in the block (e.g. a ThreadPoolExecutor) should enter the with
+# block with the log of current_command_log() themselves
+@contextmanager
+def command_log(log: Optional[CommandLog] = None) -> Iterator[CommandLog]:
+    previous = current_command_log()
+    _command_logs.log = log if log is not None else CommandLog()
+    try:
+        yield _command_logs.log
+    finally:
+        _command_logs.log = previous
+
+
+def current_command_log() -> Optional[CommandLog]:
+    return getattr(_command_logs, "log", None)
+
+
+# adds the result of a command to the log of the running with command_log block
+def record_command(result: CommandResult):
+    log = current_command_log()
+    if log is not None:
+        log.add(result)
+
+
+# used by kaldi_nl.py and transcode.py. The output is logged line by line while the
+# command runs. The command gets its own process group, so on a timeout (secs, 0 is
+# no timeout) or cancellation the whole tree of processes it started is killed. The
+# stdin_chunks (e.g. an HTTP response) are written to the stdin of the command
+def run_shell_command(
+    cmd: str,
+    timeout: float = 0,
+    cwd: Optional[str] = None,
+    stdin_chunks: Optional[Iterable[bytes]] = None,
+) -> CommandResult:
     logger.info(cmd)
+    result = CommandResult(start_time=time.time())
     try:
         process = subprocess.Popen(
             cmd,
+            stdin=subprocess.PIPE if stdin_chunks is not None else None,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             shell=True,  # needed to support file glob
+            cwd=cwd,
+            start_new_session=True,
+            text=True,
+            errors="replace",
         )
-
-        stdout, stderr = process.communicate()
-        logger.info(stdout)
-        logger.error(stderr)
-        logger.info(f"Process is done: return code {process.returncode}")
-        return process.returncode == 0
-    except subprocess.CalledProcessError:
-        logger.exception("CalledProcessError")
-        return False
     except Exception:
         logger.exception("Exception")
+        return result
+
+    with _running_lock:
+        _running_commands[process.pid] = result
+    stderr_tail: Deque[str] = deque(maxlen=STDERR_TAIL_LINES)
+    readers = [
+        threading.Thread(target=_log_lines, args=(process.stdout, None), daemon=True),
+        threading.Thread(
+            target=_log_lines, args=(process.stderr, stderr_tail), daemon=True
+        ),
+    ]
+    if stdin_chunks is not None:
+        readers.append(
+            threading.Thread(
+                target=_feed_stdin,
+                args=(process, stdin_chunks, result),
+                daemon=True,
+            )
+        )
+    for reader in readers:
+        reader.start()
+    timer = None
+    if timeout > 0:
+        timer = threading.Timer(
+            timeout, _on_timeout, args=(process.pid, timeout, result)
+        )
+        timer.daemon = True
+        timer.start()
+
+    try:
+        # unlike Popen.wait(), wait4 also returns the resource usage of the command
+        _, status, rusage = os.wait4(process.pid, 0)
+    finally:
+        if timer:
+            timer.cancel()
+        with _running_lock:
+            del _running_commands[process.pid]
+    process.returncode = os.waitstatus_to_exitcode(status)
+    for reader in readers:
+        reader.join(timeout=READER_JOIN_TIMEOUT)
+
+    result.return_code = process.returncode
+    result.wall_time = time.time() - result.start_time
+    result.cpu_time = rusage.ru_utime + rusage.ru_stime
+    result.max_rss = rusage.ru_maxrss * 1024  # KB on Linux
+    record_command(result)
+    logger.info(f"Process is done: return code {process.returncode} ({result})")
+    if not result.success:
+        logger.error(f"Command failed: {cmd}")
+        for line in stderr_tail:
+            logger.error(line)
+    return result
+
+
+# kills all running commands, e.g. when the worker is asked to stop. With wait, only
+# returns once the commands are gone: those still running after the grace period are
+# killed right away, as the SIGKILL timers do not survive the exit of the worker
+def cancel_running_commands(wait: bool = False):
+    with _running_lock:
+        running = list(_running_commands.items())
+    for pid, result in running:
+        logger.warning(f"Cancelling process {pid}")
+        result.cancelled = True
+        _kill_process_group(pid)
+    if not wait:
+        return
+    deadline = time.time() + KILL_GRACE_PERIOD
+    pids = [pid for pid, _ in running]
+    while pids and time.time() < deadline:
+        time.sleep(0.1)
+        pids = [pid for pid in pids if _process_group_exists(pid)]
+    for pid in pids:
+        logger.warning(f"Process group {pid} ignored SIGTERM, killing it")
+        _force_kill_process_group(pid)
+
+
+def _on_timeout(pid: int, timeout: float, result: CommandResult):
+    logger.error(f"Process {pid} timed out after {timeout} secs, killing it")
+    result.timed_out = True
+    _kill_process_group(pid)
+
+
+# asks the process group to terminate and kills it if it is still there after a while
+def _kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    timer = threading.Timer(KILL_GRACE_PERIOD, _force_kill_process_group, args=(pgid,))
+    timer.daemon = True
+    timer.start()
+
+
+def _process_group_exists(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
         return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _force_kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _feed_stdin(
+    process: subprocess.Popen, chunks: Iterable[bytes], result: CommandResult
+):
+    stdin = process.stdin.buffer  # type: ignore
+    try:
+        for chunk in chunks:
+            stdin.write(chunk)
+    except BrokenPipeError:
+        pass  # the command stopped reading, its return code tells why
+    except Exception:
+        # the command must not take the truncated input for the whole input
+        logger.exception(f"Failed to read the input of process {process.pid}")
+        result.input_failed = True
+        _kill_process_group(process.pid)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def _log_lines(stream: IO[str], tail: Optional[Deque[str]]):
+    for line in stream:
+        line = line.rstrip()
+        logger.info(line)
+        if tail is not None:
+            tail.append(line)
+    stream.close()
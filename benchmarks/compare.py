@@ -0,0 +1,105 @@
+import argparse
+import json
+import sys
+from typing import List, Tuple
+
+# Compares two results files of run_benchmarks.py (e.g. of the main branch and a
+# change), scenario by scenario and stage by stage:
+#   python -m benchmarks.compare base.json new.json --threshold 10
+# Exits with 1 if a time or the peak RSS went up by more than the threshold (%)
+
+SCENARIO_METRICS = ["wall_time", "cpu_time", "max_rss", "max_child_rss"]
+STAGE_METRICS = ["wall_time", "cpu_time"]
+MIN_TIME = 0.05  # secs, shorter times are mostly noise, so never count as regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two benchmark results")
+    parser.add_argument("base", help="results JSON of the baseline")
+    parser.add_argument("new", help="results JSON to compare with the baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="%% increase of a time or the peak RSS that counts as a regression",
+    )
+    args = parser.parse_args()
+    base, new = _load(args.base), _load(args.new)
+    print(f"base: {_describe(base)}\nnew:  {_describe(new)}\n")
+    if base.get("parameters") != new.get("parameters"):
+        print("WARNING: the benchmarks ran with different parameters\n")
+
+    base_results = {r["scenario"]: r for r in base["results"]}
+    regressions = []
+    for result in new["results"]:
+        scenario = result["scenario"]
+        if scenario not in base_results:
+            print(f"{scenario}: not in the baseline\n")
+            continue
+        rows = _compare(base_results[scenario], result, SCENARIO_METRICS, "")
+        base_stages = {s["stage"]: s for s in base_results[scenario]["stages"]}
+        for stage in result["stages"]:
+            if stage["stage"] in base_stages:
+                rows += _compare(
+                    base_stages[stage["stage"]], stage, STAGE_METRICS, stage["stage"]
+                )
+        print(scenario)
+        for name, old_value, new_value, change in rows:
+            regressed = _is_regression(name, old_value, new_value, args.threshold)
+            if regressed:
+                regressions.append(f"{scenario} {name}")
+            print(
+                f"  {name:<26}{_format(name, old_value):>12}{_format(name, new_value):>12}"
+                f"{change:>+9.1f}%{'  REGRESSION' if regressed else ''}"
+            )
+        print()
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:g}%")
+        sys.exit(1)
+    print(f"No regressions above {args.threshold:g}%")
+
+
+def _load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _describe(results: dict) -> str:
+    commit = results.get("commit", "")[:10] or "unknown commit"
+    dirty = " (with local changes)" if results.get("dirty") else ""
+    return f"{commit}{dirty} at {results.get('timestamp', '?')}"
+
+
+# (name, base value, new value, % change) of each metric both results have
+def _compare(
+    base: dict, new: dict, metrics: List[str], prefix: str
+) -> List[Tuple[str, float, float, float]]:
+    rows = []
+    for metric in metrics:
+        if metric not in base or metric not in new:
+            continue
+        old_value, new_value = base[metric], new[metric]
+        change = (new_value - old_value) / old_value * 100 if old_value > 0 else 0
+        rows.append(
+            (f"{prefix}.{metric}" if prefix else metric, old_value, new_value, change)
+        )
+    return rows
+
+
+def _is_regression(
+    name: str, old_value: float, new_value: float, threshold: float
+) -> bool:
+    if name.endswith("_time") and max(old_value, new_value) < MIN_TIME:
+        return False
+    return old_value > 0 and (new_value - old_value) / old_value * 100 > threshold
+
+
+def _format(name: str, value: float) -> str:
+    if name.endswith("rss"):
+        return f"{value / (1024 * 1024):.1f}MB"
+    return f"{value:.3f}s"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import wave
+
+from benchmarks.synthetic import write_kaldi_output
+
+# Stand-in for Kaldi_NL's decode_OH.sh (called as: decode_OH.sh <input> <output dir>),
+# run (as benchmarks.fake_kaldi) by the decode_OH.sh of run_benchmarks.py. It takes
+# FAKE_KALDI_RTF secs per sec of audio and writes realistic 1Best.txt & 1Best.ctm,
+# plus FAKE_KALDI_INTERMEDIATE_MB of intermediate files (like the lattices)
+RTF = float(os.environ.get("FAKE_KALDI_RTF", "0.01"))
+INTERMEDIATE_MB = int(os.environ.get("FAKE_KALDI_INTERMEDIATE_MB", "0"))
+
+
+def main(input_path: str, output_dir: str) -> int:
+    try:
+        with wave.open(input_path, "rb") as w:
+            duration = w.getnframes() / w.getframerate()
+    except (wave.Error, EOFError, OSError) as e:
+        print(f"Cannot read {input_path}: {e}", file=sys.stderr)
+        return 1
+    asset_id = os.path.splitext(os.path.basename(input_path))[0]
+    time.sleep(duration * RTF)
+    if INTERMEDIATE_MB:
+        lattice_dir = os.path.join(output_dir, "intermediate", "lattices")
+        os.makedirs(lattice_dir, exist_ok=True)
+        with open(os.path.join(lattice_dir, "lat.1.gz"), "wb") as f:
+            for _ in range(INTERMEDIATE_MB):
+                f.write(os.urandom(1024 * 1024))
+    write_kaldi_output(output_dir, asset_id, duration, seed=len(asset_id))
+    print(f"Decoded {duration:.1f}s of audio into {output_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,373 @@
+import argparse
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from benchmarks.synthetic import write_kaldi_output, write_speech_wav
+
+# Runs the worker end to end on synthetic input without any network: the input is
+# served by a local HTTP server, S3 is mocked with moto and Kaldi_NL is replaced by
+# benchmarks/fake_kaldi.py. Every scenario runs in its own process (with a fresh
+# OUTPUT_BASE_DIR), so the peak RSS is that of the scenario. Run from the repo root:
+#   python -m benchmarks.run_benchmarks --minutes 1,10,60 --output results.json
+
+logger = logging.getLogger(__name__)
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_VERSION = 1  # of the results JSON, bump when the fields change
+S3_ENDPOINT_URL = "https://s3.amazonaws.com"  # intercepted by moto
+S3_BUCKET = "asr-benchmark"
+S3_FOLDER_IN_BUCKET = "assets"
+PIPELINE = "pipeline"  # simple_asr.run on a wav of the given minutes
+TRANSCRIPT = "transcript"  # generate_transcript on ASR output of the given hours
+
+
+@dataclass
+class StageResult:
+    stage: str
+    success: bool
+    skipped: bool
+    wall_time: float  # secs
+    cpu_time: float  # secs, the worker process + its child processes
+    bytes_in: int
+    bytes_out: int
+    throughput: float  # bytes_in per sec of wall time (-1 if unknown)
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str  # e.g. pipeline:60 (minutes) or transcript:10 (hours)
+    success: bool
+    audio_duration: float  # secs of (synthetic) audio
+    wall_time: float  # secs
+    cpu_time: float  # secs, the scenario process + its child processes
+    max_rss: int  # bytes, peak RSS of the scenario process
+    max_child_rss: int  # bytes, peak RSS of its child processes (e.g. fake Kaldi_NL)
+    speed: float  # secs of audio processed per sec of wall time
+    stages: List[StageResult] = field(default_factory=list)
+
+
+def main():
+    args = _parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        stream=sys.stderr,  # stdout is for the results
+        format="%(asctime)s|%(levelname)s|%(module)s|%(message)s",
+    )
+    if args.run_scenario:
+        kind, value = _parse_scenario(args.run_scenario)
+        result = _run_in_sandbox(kind, value, args)
+        print(json.dumps(asdict(result)))
+        sys.exit(0 if result.success else 1)
+
+    scenarios = [f"{PIPELINE}:{m:g}" for m in _numbers(args.minutes)] + [
+        f"{TRANSCRIPT}:{h:g}" for h in _numbers(args.transcript_hours)
+    ]
+    results = [_run_scenario_process(s, args) for s in scenarios]
+    report = {
+        "version": RESULTS_VERSION,
+        **_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            "fake_kaldi_rtf": args.rtf,
+            "fake_kaldi_intermediate_mb": args.intermediate_mb,
+            "env": args.env,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+    sys.exit(0 if all([r["success"] for r in results]) else 1)
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the ASR worker offline (see README.md)"
+    )
+    parser.add_argument(
+        "--minutes",
+        default="1,10",
+        help="comma separated durations (minutes) of the end to end runs",
+    )
+    parser.add_argument(
+        "--transcript-hours",
+        default="1,10",
+        help="comma separated durations (hours) of the transcript generation runs",
+    )
+    parser.add_argument(
+        "--rtf",
+        type=float,
+        default=0.01,
+        help="secs the fake Kaldi_NL takes per sec of audio",
+    )
+    parser.add_argument(
+        "--intermediate-mb",
+        type=int,
+        default=0,
+        help="MB of intermediate files (lattices) the fake Kaldi_NL writes",
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="worker setting for all runs, e.g. --env S3_UPLOAD_MODE=archive",
+    )
+    parser.add_argument("--output", help="file to write the results JSON to")
+    parser.add_argument("--keep", action="store_true", help="keep the work dirs")
+    parser.add_argument("--verbose", action="store_true", help="show the worker logs")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)  # internal
+    return parser.parse_args()
+
+
+def _numbers(values: str) -> List[float]:
+    return [float(v) for v in values.split(",") if v.strip()]
+
+
+def _parse_scenario(scenario: str) -> Tuple[str, float]:
+    kind, _, value = scenario.partition(":")
+    assert kind in [PIPELINE, TRANSCRIPT], f"Unknown scenario {scenario}"
+    return kind, float(value)
+
+
+def _revision() -> Dict[str, object]:
+    def git(*cmd: str) -> str:
+        result = subprocess.run(
+            ["git", *cmd], cwd=REPO_DIR, capture_output=True, text=True
+        )
+        return result.stdout.strip() if result.returncode == 0 else ""
+
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+# runs the scenario in a new process, which prints its ScenarioResult as JSON
+def _run_scenario_process(scenario: str, args: argparse.Namespace) -> dict:
+    cmd = [sys.executable, "-m", "benchmarks.run_benchmarks"]
+    cmd += ["--run-scenario", scenario, "--rtf", str(args.rtf)]
+    cmd += ["--intermediate-mb", str(args.intermediate_mb)]
+    cmd += [f"--env={e}" for e in args.env]
+    cmd += ["--keep"] if args.keep else []
+    cmd += ["--verbose"] if args.verbose else []
+    print(f"Running {scenario}", file=sys.stderr)
+    result = subprocess.run(cmd, cwd=REPO_DIR, stdout=subprocess.PIPE, text=True)
+    try:
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        print(f"{scenario} crashed (exit code {result.returncode})", file=sys.stderr)
+        return {"scenario": scenario, "success": False, "stages": []}
+
+
+# sets up the worker environment in a new work dir, so the worker modules can only
+# be imported after this
+def _run_in_sandbox(kind: str, value: float, args: argparse.Namespace):
+    work_dir = tempfile.mkdtemp(prefix="asr_benchmark_")
+    try:
+        output_base_dir = os.path.join(work_dir, "output_base_dir")
+        os.makedirs(output_base_dir)
+        os.environ.update(
+            {
+                "OUTPUT_BASE_DIR": output_base_dir,
+                "S3_ENDPOINT_URL": S3_ENDPOINT_URL,
+                "S3_BUCKET": S3_BUCKET,
+                "S3_FOLDER_IN_BUCKET": S3_FOLDER_IN_BUCKET,
+                "ASR_BACKEND": "oneshot",
+                "FAKE_KALDI_RTF": str(args.rtf),
+                "FAKE_KALDI_INTERMEDIATE_MB": str(args.intermediate_mb),
+            }
+        )
+        os.environ.update(dict([e.split("=", 1) for e in args.env]))
+        # never touch a real bucket, whatever is in the environment
+        os.environ.update(
+            {
+                "AWS_ACCESS_KEY_ID": "benchmark",
+                "AWS_SECRET_ACCESS_KEY": "benchmark",
+                "AWS_DEFAULT_REGION": "us-east-1",
+            }
+        )
+        for name in ["AWS_PROFILE", "AWS_SESSION_TOKEN"]:
+            os.environ.pop(name, None)
+        if kind == PIPELINE:
+            return _pipeline(value, work_dir)
+        return _transcript(value, work_dir)
+    finally:
+        if args.keep:
+            print(f"Kept {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# downloads, transcodes (nothing, the wav is in the right format), decodes with the
+# fake Kaldi_NL, generates the transcript & uploads a wav of the given minutes
+def _pipeline(minutes: float, work_dir: str) -> ScenarioResult:
+    from moto import mock_aws
+    import boto3
+
+    import kaldi_nl
+    import simple_asr
+    from metrics import METRICS_FILE
+
+    kaldi_nl.KALDI_NL_DIR = _install_fake_kaldi(work_dir)
+    input_dir = os.path.join(work_dir, "input")
+    os.makedirs(input_dir)
+    asset_id = f"benchmark__{minutes:g}min"
+    write_speech_wav(os.path.join(input_dir, f"{asset_id}.wav"), minutes * 60)
+
+    with _serve(input_dir) as base_url, mock_aws():
+        boto3.client("s3", endpoint_url=S3_ENDPOINT_URL).create_bucket(Bucket=S3_BUCKET)
+        with _measure() as measured:
+            success = simple_asr.run(
+                f"{base_url}/{asset_id}.wav", f"s3://{S3_BUCKET}/{S3_FOLDER_IN_BUCKET}"
+            )
+
+    metrics_file = os.path.join(
+        os.environ["OUTPUT_BASE_DIR"], "output", asset_id, METRICS_FILE
+    )
+    stages = []
+    if os.path.exists(metrics_file):
+        with open(metrics_file, "r", encoding="utf-8") as f:
+            stages = [
+                StageResult(
+                    s["stage"],
+                    s["success"],
+                    s["skipped"],
+                    s["wall_time"],
+                    s["cpu_time"],
+                    s["bytes_in"],
+                    s["bytes_out"],
+                    _throughput(s["bytes_in"], s["wall_time"]),
+                )
+                for s in json.load(f)["stages"]
+            ]
+    return _result(f"{PIPELINE}:{minutes:g}", success, minutes * 60, measured, stages)
+
+
+# generates the transcript of the (synthetic) ASR output of the given hours
+def _transcript(hours: float, work_dir: str) -> ScenarioResult:
+    from transcript import CTM_FILE, TXT_FILE, generate_transcript, transcript_file
+
+    asr_output_dir = os.path.join(work_dir, "output", f"benchmark__{hours:g}h")
+    write_kaldi_output(asr_output_dir, os.path.basename(asr_output_dir), hours * 3600)
+    bytes_in = sum(
+        [os.path.getsize(os.path.join(asr_output_dir, f)) for f in [CTM_FILE, TXT_FILE]]
+    )
+    with _measure() as measured:
+        success = generate_transcript(asr_output_dir)
+    path = transcript_file(asr_output_dir)
+    stage = StageResult(
+        TRANSCRIPT,
+        success,
+        False,
+        measured["wall_time"],
+        measured["cpu_time"],
+        bytes_in,
+        os.path.getsize(path) if os.path.exists(path) else 0,
+        _throughput(bytes_in, measured["wall_time"]),
+    )
+    return _result(f"{TRANSCRIPT}:{hours:g}", success, hours * 3600, measured, [stage])
+
+
+# a decode_OH.sh running fake_kaldi.py, in a dir standing in for KALDI_NL_DIR
+def _install_fake_kaldi(work_dir: str) -> str:
+    kaldi_dir = os.path.join(work_dir, "Kaldi_NL")
+    os.makedirs(kaldi_dir)
+    script = os.path.join(kaldi_dir, "decode_OH.sh")
+    with open(script, "w", encoding="utf-8") as f:
+        f.write(
+            "#!/bin/sh\n"
+            f'PYTHONPATH="{REPO_DIR}" exec "{sys.executable}" '
+            '-m benchmarks.fake_kaldi "$@"\n'
+        )
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+    return kaldi_dir
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# serves the files in directory over HTTP (with Last-Modified, like most servers)
+@contextmanager
+def _serve(directory: str) -> Iterator[str]:
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(_QuietHandler, directory=directory)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# the wall & CPU time (of this process and its children) of the with block
+@contextmanager
+def _measure() -> Iterator[Dict[str, float]]:
+    measured: Dict[str, float] = {}
+    start_time, cpu_start = time.time(), _cpu_time()
+    try:
+        yield measured
+    finally:
+        measured["wall_time"] = time.time() - start_time
+        measured["cpu_time"] = _cpu_time() - cpu_start
+
+
+def _cpu_time() -> float:
+    usage = [resource.getrusage(resource.RUSAGE_SELF)]
+    usage.append(resource.getrusage(resource.RUSAGE_CHILDREN))
+    return sum([u.ru_utime + u.ru_stime for u in usage])
+
+
+def _throughput(num_bytes: int, wall_time: float) -> float:
+    return num_bytes / wall_time if wall_time > 0 else -1
+
+
+def _result(
+    scenario: str,
+    success: bool,
+    audio_duration: float,
+    measured: Dict[str, float],
+    stages: List[StageResult],
+) -> ScenarioResult:
+    wall_time = measured["wall_time"]
+    return ScenarioResult(
+        scenario,
+        success,
+        audio_duration,
+        wall_time,
+        measured["cpu_time"],
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # KB on Linux
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        audio_duration / wall_time if wall_time > 0 else -1,
+        stages,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from array import array
+import math
+import os
+import random
+import wave
+
+# Synthetic inputs & Kaldi_NL output for the benchmarks, generated in chunks so that
+# many hours of audio/transcript never have to fit in memory
+
+SAMPLE_RATE = 16000
+SYLLABLE_FRAMES = SAMPLE_RATE // 4  # ~4 syllables per second
+WORDS_PER_SECOND = 2.7  # as in scripts/transcript-example.json
+SEGMENT_SECONDS = (3.0, 20.0)  # min & max length of a segment (one 1Best.txt line)
+PAUSE_SECONDS = (0.3, 2.5)  # between the segments
+VOCABULARY = (
+    "de het een en van in is dat op te zijn met voor niet aan er om ook als bij "
+    "nog maar uit dan naar wel wat over door kabinet minister nieuws journaal "
+    "vandaag gisteren morgen nederland amsterdam regering partij verkiezingen "
+    "mensen jaar tijd land stad water weer rapport onderzoek gesprek uitzending "
+    "programma muziek verhaal vraag antwoord informatie politie rechter economie"
+).split()
+
+
+# 16 bit mono PCM with "speech" (noise shaped like syllables) and quiet pauses, tiled
+# from a few precomputed syllables, so hours of audio are generated in seconds
+def write_speech_wav(path: str, duration: float, seed: int = 0):
+    rng = random.Random(seed)
+    syllables = [_samples(rng, SYLLABLE_FRAMES, 6000, True) for _ in range(8)]
+    silence = _samples(rng, SYLLABLE_FRAMES, 30, False)
+    bytes_left = int(duration * SAMPLE_RATE) * 2  # 16 bit samples
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        speaking = True
+        while bytes_left > 0:
+            seconds = rng.uniform(*(SEGMENT_SECONDS if speaking else PAUSE_SECONDS))
+            count = max(1, int(seconds * SAMPLE_RATE / SYLLABLE_FRAMES))
+            data = b"".join(
+                [rng.choice(syllables) if speaking else silence for _ in range(count)]
+            )[:bytes_left]
+            w.writeframes(data)
+            bytes_left -= len(data)
+            speaking = not speaking
+
+
+# 1Best.txt & 1Best.ctm as written by Kaldi_NL for duration secs of speech
+def write_kaldi_output(
+    output_dir: str,
+    asset_id: str,
+    duration: float,
+    words_per_second: float = WORDS_PER_SECOND,
+    seed: int = 0,
+):
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    with (
+        open(os.path.join(output_dir, "1Best.txt"), "w", encoding="utf-8") as txt,
+        open(os.path.join(output_dir, "1Best.ctm"), "w", encoding="utf-8") as ctm,
+    ):
+        t = rng.uniform(*PAUSE_SECONDS)
+        segment = 0
+        while t < duration:
+            segment += 1
+            fragment = f"{asset_id}.{segment:04d}"
+            end = min(t + rng.uniform(*SEGMENT_SECONDS), duration)
+            start = t
+            words = []
+            while t < end:
+                word = rng.choice(VOCABULARY)
+                word_duration = min(rng.uniform(0.5, 1.5) / words_per_second, end - t)
+                ctm.write(
+                    f"{fragment} 1 {t:.2f} {word_duration:.2f} {word} "
+                    f"{rng.uniform(0.5, 1):.2f}\n"
+                )
+                words.append(word)
+                t += word_duration
+            if words:
+                txt.write(f"{' '.join(words)} ({fragment} {start:.3f})\n")
+            t = end + rng.uniform(*PAUSE_SECONDS)
+
+
+def _samples(rng: random.Random, n: int, level: float, shaped: bool) -> bytes:
+    samples = array("h")
+    for i in range(n):
+        envelope = abs(math.sin(math.pi * i / n)) if shaped else 1
+        samples.append(int(max(-32768, min(32767, rng.gauss(0, level) * envelope))))
+    return samples.tobytes()
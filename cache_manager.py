@@ -0,0 +1,186 @@
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from typing import ContextManager, Dict, List, Optional, Tuple
+import uuid
+
+from base_util import locked_json_file
+from config import lease_ttl, output_base_dir, output_quota_gb
+
+logger = logging.getLogger(__name__)
+INDEX_FILE = ".cache_index.json"  # in OUTPUT_BASE_DIR, keeps track of all artifacts
+
+# artifact kinds, listed in the order in which they are evicted
+INPUT = "input"  # downloaded input file
+INTERMEDIATE = "intermediate"  # transcoded audio file
+OUTPUT = "output"  # Kaldi_NL output dir
+EVICTION_PRIORITY = {INPUT: 0, INTERMEDIATE: 0, OUTPUT: 1}
+HEARTBEATS_PER_TTL = 3  # pin renewals within LEASE_TTL, so one missed renewal is fine
+
+quota_bytes = int(output_quota_gb * 1024 * 1024 * 1024)
+
+
+class CacheLease:
+    """
+    Marks the artifacts of a job as in use, so they will not be evicted until the
+    job releases them. Does nothing when no OUTPUT_QUOTA_GB is configured. As the
+    index may be shared by workers on other hosts, a pin is not a PID but an owner
+    (host, PID & a random ID) with an expiry, renewed every LEASE_TTL / 3 secs while
+    the job runs. The pins of a worker that died expire after LEASE_TTL.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.paths: List[str] = []
+        self._stop_event = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def add(self, path: str, kind: str):
+        if not quota_bytes or not os.path.exists(path):
+            return
+        with _locked_index() as index:
+            entry = index.setdefault(path, {"kind": kind, "pins": []})
+            entry["kind"] = kind
+            entry["size"] = _disk_usage(path)
+            entry["last_used"] = time.time()
+            entry["pins"] = [p for p in entry["pins"] if _owner(p) != self.owner]
+            entry["pins"].append(self._pin())
+            _evict(index)
+        if path not in self.paths:
+            self.paths.append(path)
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(
+                target=self._renew_pins, name=f"cache-{self.owner}", daemon=True
+            )
+            self._heartbeat.start()
+
+    def release(self):
+        if self._heartbeat:
+            self._stop_event.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+            self._stop_event.clear()
+        if not quota_bytes or not self.paths:
+            return
+        with _locked_index() as index:
+            for path in self.paths:
+                if path in index:
+                    index[path]["pins"] = [
+                        p for p in index[path]["pins"] if _owner(p) != self.owner
+                    ]
+                    index[path]["size"] = _disk_usage(path)
+            _evict(index)
+        self.paths = []
+
+    def _pin(self) -> dict:
+        return {"owner": self.owner, "expires_at": time.time() + lease_ttl}
+
+    def _renew_pins(self):
+        while not self._stop_event.wait(lease_ttl / HEARTBEATS_PER_TTL):
+            try:
+                with _locked_index() as index:
+                    for path in self.paths:
+                        if path in index:
+                            index[path]["pins"] = [
+                                p
+                                for p in index[path]["pins"]
+                                if _owner(p) != self.owner
+                            ] + [self._pin()]
+            except (OSError, ValueError):
+                logger.exception("Failed to renew the cache pins")
+
+    def __enter__(self) -> "CacheLease":
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _locked_index() -> ContextManager[Dict[str, dict]]:
+    return locked_json_file(
+        os.path.join(output_base_dir, INDEX_FILE), _scan_output_base_dir
+    )
+
+
+# registers the artifacts already present, e.g. from before the quota was configured
+def _scan_output_base_dir() -> Dict[str, dict]:
+    logger.info(f"Building cache index of {output_base_dir}")
+    index: Dict[str, dict] = {}
+    candidates: List[Tuple[str, str]] = [
+        (os.path.join(output_base_dir, fn), INPUT)
+        for fn in os.listdir(output_base_dir)
+        if not fn.startswith(".") and not fn.endswith(".part")  # skip in progress
+    ]
+    asr_output_root = os.path.join(output_base_dir, "output")
+    if os.path.isdir(asr_output_root):
+        candidates += [
+            (os.path.join(asr_output_root, fn), OUTPUT)
+            for fn in os.listdir(asr_output_root)
+        ]
+    for path, kind in candidates:
+        if path == asr_output_root or (kind == INPUT and not os.path.isfile(path)):
+            continue
+        index[path] = {
+            "kind": kind,
+            "size": _disk_usage(path),
+            "last_used": os.path.getmtime(path),
+            "pins": [],
+        }
+    return index
+
+
+# removes the least recently used (unpinned) artifacts until the quota is met
+def _evict(index: Dict[str, dict]):
+    for path in [p for p in index if not os.path.exists(p)]:
+        del index[path]
+    for entry in index.values():
+        entry["pins"] = [pin for pin in entry["pins"] if _is_valid(pin)]
+
+    total = sum([entry["size"] for entry in index.values()])
+    if total <= quota_bytes:
+        return
+    candidates = sorted(
+        [(path, entry) for path, entry in index.items() if not entry["pins"]],
+        key=lambda x: (EVICTION_PRIORITY.get(x[1]["kind"], 0), x[1]["last_used"]),
+    )
+    for path, entry in candidates:
+        if total <= quota_bytes:
+            break
+        logger.info(f"Evicting {entry['kind']} {path} ({entry['size']} bytes)")
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            logger.exception(f"Failed to evict {path}")
+            continue
+        total -= entry["size"]
+        del index[path]
+    if total > quota_bytes:
+        logger.warning(f"{total} bytes in use, exceeding the quota of {quota_bytes}")
+
+
+def _disk_usage(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fn))
+            except OSError:  # e.g. removed while walking
+                pass
+    return total
+
+
+def _owner(pin) -> str:
+    return pin.get("owner", "") if isinstance(pin, dict) else ""
+
+
+# pins of older versions (plain PIDs) cannot be checked across hosts, so are dropped
+def _is_valid(pin) -> bool:
+    return isinstance(pin, dict) and pin.get("expires_at", 0) > time.time()
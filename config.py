@@ -22,3 +22,329 @@ if audio_sample_url:
         assert validators.url(
             audio_sample_url
         ), "Please provide a valid AUDIO_SAMPLE_URL"
+
+# batch mode: number of parallel workers & max. number of queued items per stage
+pipeline_download_workers = int(os.environ.get("PIPELINE_DOWNLOAD_WORKERS", "1"))
+pipeline_transcode_workers = int(os.environ.get("PIPELINE_TRANSCODE_WORKERS", "1"))
+pipeline_asr_workers = int(os.environ.get("PIPELINE_ASR_WORKERS", "1"))
+pipeline_upload_workers = int(os.environ.get("PIPELINE_UPLOAD_WORKERS", "1"))
+pipeline_queue_depth = int(os.environ.get("PIPELINE_QUEUE_DEPTH", "1"))
+
+assert all(
+    [
+        x > 0
+        for x in [
+            pipeline_download_workers,
+            pipeline_transcode_workers,
+            pipeline_asr_workers,
+            pipeline_upload_workers,
+            pipeline_queue_depth,
+        ]
+    ]
+), "PIPELINE_*_WORKERS and PIPELINE_QUEUE_DEPTH should be positive integers"
+
+# batch mode: the ASR stage takes the longest of its queued items first (the duration
+# is known after the transcode), so a long item does not hold up the end of the batch.
+# Its queue then holds up to PIPELINE_LONGEST_FIRST_DEPTH (transcoded) items to choose
+# from, instead of PIPELINE_QUEUE_DEPTH
+pipeline_longest_first = os.environ.get("PIPELINE_LONGEST_FIRST", "false").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+pipeline_longest_first_depth = int(os.environ.get("PIPELINE_LONGEST_FIRST_DEPTH", "8"))
+assert pipeline_longest_first_depth > 0, "PIPELINE_LONGEST_FIRST_DEPTH should be > 0"
+
+# HTTP downloads: timeouts (secs), retries and the size (bytes) of streamed chunks
+http_connect_timeout = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+http_read_timeout = float(os.environ.get("HTTP_READ_TIMEOUT", "60"))
+http_retries = int(os.environ.get("HTTP_RETRIES", "5"))
+http_backoff_factor = float(os.environ.get("HTTP_BACKOFF_FACTOR", "1"))
+http_chunk_size = int(os.environ.get("HTTP_CHUNK_SIZE", str(1024 * 1024)))
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+
+assert http_retries >= 0, "HTTP_RETRIES should be >= 0"
+assert http_chunk_size > 0, "HTTP_CHUNK_SIZE should be a positive integer"
+assert http_pool_size > 0, "HTTP_POOL_SIZE should be a positive integer"
+
+# S3 transfers: multipart chunk size (bytes), threads per transfer, connection pool
+# size of the (shared) client and the number of files uploaded in parallel
+s3_multipart_chunksize = int(
+    os.environ.get("S3_MULTIPART_CHUNKSIZE", str(64 * 1024 * 1024))
+)
+s3_max_concurrency = int(os.environ.get("S3_MAX_CONCURRENCY", "10"))
+s3_max_pool_connections = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "50"))
+s3_parallel_uploads = int(os.environ.get("S3_PARALLEL_UPLOADS", "4"))
+
+assert all(
+    [
+        x > 0
+        for x in [
+            s3_multipart_chunksize,
+            s3_max_concurrency,
+            s3_max_pool_connections,
+            s3_parallel_uploads,
+        ]
+    ]
+), "S3_* transfer settings should be positive integers"
+
+# S3 upload of the ASR output: "files" (each file as an object) or "archive" (one tar,
+# streamed through the compressor into a multipart upload, with a JSON manifest of its
+# contents next to it). S3_ARCHIVE_COMPRESSION: none, gz, bz2 or the (multi threaded)
+# external pigz or zstd. Besides 1Best.ctm & 1Best.txt, the transcript and the files
+# matching S3_UPLOAD_EXTRA_FILES (comma separated glob patterns, relative to the ASR
+# output dir) can be uploaded. Objects whose ETag matches the local file are skipped
+s3_upload_mode = os.environ.get("S3_UPLOAD_MODE", "files").lower()
+s3_archive_compression = os.environ.get("S3_ARCHIVE_COMPRESSION", "gz").lower()
+s3_archive_compression_level = int(os.environ.get("S3_ARCHIVE_COMPRESSION_LEVEL", "6"))
+s3_upload_transcript = os.environ.get("S3_UPLOAD_TRANSCRIPT", "false").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+s3_upload_extra_files = [
+    p.strip()
+    for p in os.environ.get("S3_UPLOAD_EXTRA_FILES", "").split(",")
+    if p.strip()
+]
+s3_skip_unchanged = os.environ.get("S3_SKIP_UNCHANGED", "true").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+
+assert s3_upload_mode in ["files", "archive"], "S3_UPLOAD_MODE should be files/archive"
+assert s3_archive_compression in [
+    "none",
+    "gz",
+    "bz2",
+    "pigz",
+    "zstd",
+], "S3_ARCHIVE_COMPRESSION should be none, gz, bz2, pigz or zstd"
+assert (
+    1 <= s3_archive_compression_level <= (19 if s3_archive_compression == "zstd" else 9)
+), "S3_ARCHIVE_COMPRESSION_LEVEL should be 1-9 (1-19 for zstd)"
+
+# audio format fed to Kaldi_NL: "wav" (PCM, decoded once at the right sample rate)
+# or "mp3" (the original behaviour)
+transcode_format = os.environ.get("TRANSCODE_FORMAT", "wav").lower()
+transcode_sample_rate = int(os.environ.get("TRANSCODE_SAMPLE_RATE", "16000"))
+transcode_channels = int(os.environ.get("TRANSCODE_CHANNELS", "1"))
+
+assert transcode_format in ["wav", "mp3"], "TRANSCODE_FORMAT should be wav or mp3"
+assert transcode_sample_rate > 0, "TRANSCODE_SAMPLE_RATE should be positive"
+assert transcode_channels > 0, "TRANSCODE_CHANNELS should be positive"
+
+# how video inputs are fetched: "download" (the whole file, then transcoded) or
+# "stream" (the HTTP/S3 stream is piped into ffmpeg and only the audio is stored).
+# Inputs that cannot be read from a pipe (e.g. an MP4 with its index at the end) and
+# failed streams are downloaded instead
+ingest_mode = os.environ.get("INGEST_MODE", "download").lower()
+
+assert ingest_mode in ["download", "stream"], "INGEST_MODE should be download/stream"
+
+# segment-parallel ASR: split audio longer than ASR_SEGMENT_MINUTES (0 = disabled)
+# at silences and decode up to ASR_PARALLELISM segments at the same time. The decodes
+# of the segments are removed once merged, unless ASR_KEEP_FILES is set
+asr_segment_minutes = float(os.environ.get("ASR_SEGMENT_MINUTES", "0"))
+asr_parallelism = int(os.environ.get("ASR_PARALLELISM", "2"))
+asr_silence_threshold_db = float(os.environ.get("ASR_SILENCE_THRESHOLD_DB", "-35"))
+asr_min_silence = float(os.environ.get("ASR_MIN_SILENCE", "0.3"))  # secs
+
+assert asr_segment_minutes >= 0, "ASR_SEGMENT_MINUTES should be >= 0"
+assert asr_parallelism > 0, "ASR_PARALLELISM should be a positive integer"
+
+# transcript output: "pretty" (indented JSON), "compact" (JSON without whitespace)
+# or "ndjson" (one JSON object per line/segment, written to transcript.ndjson)
+transcript_format = os.environ.get("TRANSCRIPT_FORMAT", "pretty").lower()
+
+assert transcript_format in [
+    "pretty",
+    "compact",
+    "ndjson",
+], "TRANSCRIPT_FORMAT should be pretty, compact or ndjson"
+
+# (optional) also write a compact binary word index (word_index.bin) of the transcript,
+# for searching it without parsing the JSON (see word_index.py)
+word_index = os.environ.get("WORD_INDEX", "false").lower() in ["true", "1", "yes"]
+
+# processes used by --regenerate-transcripts (0 = one per core)
+transcript_workers = int(os.environ.get("TRANSCRIPT_WORKERS", "0"))
+
+assert transcript_workers >= 0, "TRANSCRIPT_WORKERS should be >= 0"
+
+# max. disk space (GB) used by the inputs, transcodes & ASR output in OUTPUT_BASE_DIR
+# (0 = unlimited), least recently used artifacts are removed when it is exceeded. The
+# artifacts of running jobs (of any host sharing it) are pinned for LEASE_TTL secs at
+# a time, renewed while the job runs
+output_quota_gb = float(os.environ.get("OUTPUT_QUOTA_GB", "0"))
+
+assert output_quota_gb >= 0, "OUTPUT_QUOTA_GB should be >= 0"
+
+# (optional) metrics export: dir for the Prometheus node_exporter textfile collector
+# and/or the URL of a Prometheus Pushgateway
+metrics_textfile_dir = os.environ.get("METRICS_TEXTFILE_DIR", "")
+metrics_pushgateway_url = os.environ.get("METRICS_PUSHGATEWAY_URL", "")
+
+if metrics_textfile_dir:
+    assert os.path.isdir(metrics_textfile_dir), "METRICS_TEXTFILE_DIR does not exist"
+if metrics_pushgateway_url:
+    assert validators.url(
+        metrics_pushgateway_url, simple_host=True  # e.g. http://pushgateway:9091
+    ), "Please provide a valid METRICS_PUSHGATEWAY_URL"
+
+# (optional) profile the stages of 1 in PROFILE_EVERY_N_JOBS jobs (0 = off, 1 = all,
+# like --profile) with cProfile & tracemalloc, writing a .prof file and a report of the
+# top PROFILE_TOP_N allocations per stage to the ASR output dir (see profiling.py)
+profile_every_n_jobs = int(os.environ.get("PROFILE_EVERY_N_JOBS", "0"))
+profile_top_n = int(os.environ.get("PROFILE_TOP_N", "25"))
+
+assert profile_every_n_jobs >= 0, "PROFILE_EVERY_N_JOBS should be >= 0"
+assert profile_top_n > 0, "PROFILE_TOP_N should be a positive integer"
+
+# max. secs a transcode (ffmpeg) or a Kaldi_NL decode may take (0 = no timeout)
+transcode_timeout = float(os.environ.get("TRANSCODE_TIMEOUT", "0"))
+asr_timeout = float(os.environ.get("ASR_TIMEOUT", "0"))
+
+assert transcode_timeout >= 0, "TRANSCODE_TIMEOUT should be >= 0"
+assert asr_timeout >= 0, "ASR_TIMEOUT should be >= 0"
+
+# daemon mode: the (SQLite) job queue, number of jobs processed at the same time and
+# how failed jobs are retried (backoff in secs, doubled after each attempt). The queue
+# should be on a local disk (not the shared OUTPUT_BASE_DIR volume): SQLite's locking
+# is not safe on network filesystems
+job_queue_db = os.environ.get("JOB_QUEUE_DB", os.path.abspath(".job_queue.sqlite"))
+worker_concurrency = int(os.environ.get("WORKER_CONCURRENCY", "1"))
+job_max_attempts = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+job_retry_backoff = float(os.environ.get("JOB_RETRY_BACKOFF", "60"))
+job_poll_interval = float(os.environ.get("JOB_POLL_INTERVAL", "5"))
+# running jobs not finished within this many secs are considered lost and retried
+job_visibility_timeout = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", "86400"))
+
+assert worker_concurrency > 0, "WORKER_CONCURRENCY should be a positive integer"
+assert job_max_attempts > 0, "JOB_MAX_ATTEMPTS should be a positive integer"
+
+# ASR backend: "oneshot" runs decode_OH.sh per file (models are loaded every time),
+# "persistent" keeps a pool of ASR_DECODER_POOL_SIZE decoder processes (started with
+# ASR_DECODER_CMD) with the models loaded and "stub" does the same with a fake decoder
+# (stub_decoder.py), to try the pool without Kaldi_NL. A decoder process is restarted
+# after ASR_DECODER_MAX_JOBS jobs, when it uses more than ASR_DECODER_MAX_RSS_MB or
+# after a failed or timed out job
+asr_backend = os.environ.get("ASR_BACKEND", "oneshot").lower()
+asr_decoder_cmd = os.environ.get("ASR_DECODER_CMD", "")
+asr_decoder_pool_size = int(os.environ.get("ASR_DECODER_POOL_SIZE", "1"))
+asr_decoder_max_jobs = int(os.environ.get("ASR_DECODER_MAX_JOBS", "50"))  # 0 = no max
+asr_decoder_max_rss_mb = int(
+    os.environ.get("ASR_DECODER_MAX_RSS_MB", "0")
+)  # 0 = no max
+asr_decoder_startup_timeout = float(
+    os.environ.get("ASR_DECODER_STARTUP_TIMEOUT", "600")  # secs to load the models
+)
+
+assert asr_backend in [
+    "oneshot",
+    "persistent",
+    "stub",
+], "ASR_BACKEND should be oneshot, persistent or stub"
+if asr_backend == "persistent":
+    assert asr_decoder_cmd, "Please provide the ASR_DECODER_CMD (persistent backend)"
+assert asr_decoder_pool_size > 0, "ASR_DECODER_POOL_SIZE should be a positive integer"
+assert asr_decoder_max_jobs >= 0, "ASR_DECODER_MAX_JOBS should be >= 0"
+assert asr_decoder_max_rss_mb >= 0, "ASR_DECODER_MAX_RSS_MB should be >= 0"
+assert asr_decoder_startup_timeout > 0, "ASR_DECODER_STARTUP_TIMEOUT should be > 0"
+
+# ASR admission control: only start a decode when the node has the memory & cores
+# for it, also counting the decodes of the other workers on the node (that share the
+# node-local ASR_ADMISSION_DIR). A decode is estimated to need ASR_MEMORY_BASE_MB plus
+# ASR_MEMORY_PER_MINUTE_MB per minute of audio. The memory budget is ASR_MEMORY_LIMIT_MB
+# (0 = the cgroup limit or the total memory). Optionally each decode is pinned to the
+# cores reserved for it and/or runs with a nice value. Reservations are renewed while
+# the decode runs and expire LEASE_TTL secs after a worker died
+asr_admission_control = os.environ.get("ASR_ADMISSION_CONTROL", "false").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+asr_admission_dir = os.environ.get("ASR_ADMISSION_DIR", "/tmp")
+asr_admission_poll_interval = float(os.environ.get("ASR_ADMISSION_POLL_INTERVAL", "5"))
+asr_memory_base_mb = int(os.environ.get("ASR_MEMORY_BASE_MB", "16384"))
+asr_memory_per_minute_mb = float(os.environ.get("ASR_MEMORY_PER_MINUTE_MB", "16"))
+asr_memory_limit_mb = int(os.environ.get("ASR_MEMORY_LIMIT_MB", "0"))
+asr_cpus_per_job = int(os.environ.get("ASR_CPUS_PER_JOB", "1"))
+asr_cpu_affinity = os.environ.get("ASR_CPU_AFFINITY", "false").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+asr_nice = int(os.environ.get("ASR_NICE", "0"))
+
+if asr_admission_control:
+    assert os.path.isdir(asr_admission_dir), "ASR_ADMISSION_DIR does not exist"
+assert asr_admission_poll_interval > 0, "ASR_ADMISSION_POLL_INTERVAL should be > 0"
+assert asr_memory_base_mb >= 0, "ASR_MEMORY_BASE_MB should be >= 0"
+assert asr_memory_per_minute_mb >= 0, "ASR_MEMORY_PER_MINUTE_MB should be >= 0"
+assert asr_memory_limit_mb >= 0, "ASR_MEMORY_LIMIT_MB should be >= 0"
+assert asr_cpus_per_job > 0, "ASR_CPUS_PER_JOB should be a positive integer"
+assert -20 <= asr_nice <= 19, "ASR_NICE should be between -20 and 19"
+
+# (optional) skip the non-speech (silence, music beds, test cards) before the ASR:
+# regions of at least VAD_MIN_NONSPEECH secs below VAD_THRESHOLD_DB (in the speech
+# band) are cut out, leaving VAD_PADDING secs around the speech and replacing each cut
+# by VAD_GAP secs of silence. The ASR output times are mapped back to the media time
+vad_enabled = os.environ.get("VAD_ENABLED", "false").lower() in ["true", "1", "yes"]
+vad_threshold_db = float(os.environ.get("VAD_THRESHOLD_DB", "-40"))
+vad_min_nonspeech = float(os.environ.get("VAD_MIN_NONSPEECH", "2"))
+vad_padding = float(os.environ.get("VAD_PADDING", "0.3"))
+vad_gap = float(os.environ.get("VAD_GAP", "0.5"))
+
+assert vad_min_nonspeech > 0, "VAD_MIN_NONSPEECH should be > 0"
+assert vad_padding >= 0, "VAD_PADDING should be >= 0"
+assert vad_gap >= 0, "VAD_GAP should be >= 0"
+assert (
+    vad_min_nonspeech > 2 * vad_padding + vad_gap
+), "VAD_MIN_NONSPEECH should be longer than 2 * VAD_PADDING + VAD_GAP"
+
+# (optional) leases, so workers sharing OUTPUT_BASE_DIR never work on the same stage
+# of the same asset: "none", "file" (lock files in LEASE_DIR on the shared volume) or
+# "s3" (conditional writes to LEASE_S3_BUCKET). A lease expires LEASE_TTL secs after
+# its last heartbeat. When another worker holds the lease, the stage either waits for
+# it (and then usually finds the output done) or the asset is skipped. A stage waits
+# at most LEASE_MAX_WAIT secs (0 = no max), after which the asset is skipped as well
+lease_backend = os.environ.get("LEASE_BACKEND", "none").lower()
+lease_dir = os.environ.get("LEASE_DIR", os.path.join(output_base_dir, ".leases"))
+lease_s3_bucket = os.environ.get("LEASE_S3_BUCKET", s3_bucket)
+lease_s3_prefix = os.environ.get("LEASE_S3_PREFIX", "leases")
+lease_ttl = float(os.environ.get("LEASE_TTL", "300"))
+lease_conflict = os.environ.get("LEASE_CONFLICT", "wait").lower()
+lease_poll_interval = float(os.environ.get("LEASE_POLL_INTERVAL", "10"))
+lease_max_wait = float(os.environ.get("LEASE_MAX_WAIT", "3600"))
+
+assert lease_backend in [
+    "none",
+    "file",
+    "s3",
+], "LEASE_BACKEND should be none, file or s3"
+if lease_backend == "s3":
+    assert lease_s3_bucket, "Please provide the LEASE_S3_BUCKET (or S3_BUCKET)"
+assert lease_ttl > 0, "LEASE_TTL should be > 0"
+assert lease_conflict in ["wait", "skip"], "LEASE_CONFLICT should be wait or skip"
+assert lease_poll_interval > 0, "LEASE_POLL_INTERVAL should be > 0"
+assert lease_max_wait >= 0, "LEASE_MAX_WAIT should be >= 0"
+
+# (optional) reuse the ASR output of identical audio (e.g. a re-broadcast under another
+# carrier ID), found by a hash of the decoded PCM audio
+asr_dedupe = os.environ.get("ASR_DEDUPE", "false").lower() in ["true", "1", "yes"]
+
+# (optional) let Kaldi_NL work in a local/tmpfs dir (e.g. /dev/shm) instead of the ASR
+# output dir: only 1Best.ctm, 1Best.txt and the files matching ASR_KEEP_FILES (comma
+# separated glob patterns, relative to the decode dir) are kept in the output dir
+asr_scratch_dir = os.environ.get("ASR_SCRATCH_DIR", "")
+asr_keep_files = [
+    p.strip() for p in os.environ.get("ASR_KEEP_FILES", "").split(",") if p.strip()
+]
+
+if asr_scratch_dir:
+    assert os.path.isdir(asr_scratch_dir), "ASR_SCRATCH_DIR should be an existing dir"
+assert not any(
+    [os.path.isabs(p) or ".." in p.split("/") for p in asr_keep_files]
+), "ASR_KEEP_FILES should be relative to the decode dir"
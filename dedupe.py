@@ -0,0 +1,183 @@
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+import hashlib
+import logging
+import os
+import subprocess
+from typing import ContextManager, Dict, Optional
+import wave
+
+from base_util import get_asset_info, locked_json_file
+from config import (
+    output_base_dir,
+    transcode_sample_rate,
+    transcode_channels,
+    transcode_timeout,
+)
+from transcript import CTM_FILE, TXT_FILE
+
+logger = logging.getLogger(__name__)
+INDEX_FILE = ".asr_dedupe_index.json"  # in OUTPUT_BASE_DIR, maps audio hashes to output
+PCM_SAMPLE_WIDTH = 2  # bytes, the audio is hashed as 16 bit PCM
+CHUNK_SIZE = 1024 * 1024  # bytes hashed at a time
+
+
+@dataclass
+class DedupeEntry:
+    fingerprint: str
+    asset_id: str
+    output_dir: str  # with the 1Best.ctm and 1Best.txt
+    ctm_size: int
+    txt_size: int
+    asr_wall_time: float = 0  # secs the decode took
+    asr_cpu_time: float = 0  # secs, CPU time of the decode (approximation)
+
+
+# sha256 of the audio decoded to PCM in the sample rate & channels Kaldi_NL is fed
+# with, so a rewrapped or remuxed copy of the same audio gets the same fingerprint
+def fingerprint(audio_path: str) -> Optional[str]:
+    try:
+        stat = os.stat(audio_path)
+    except OSError:
+        logger.exception(f"Cannot fingerprint {audio_path}")
+        return None
+    return _fingerprint(audio_path, stat.st_size, stat.st_mtime_ns)
+
+
+# returns the output of identical audio that was decoded before (if still available)
+def lookup(audio_fingerprint: str) -> Optional[DedupeEntry]:
+    with _locked_index() as index:
+        data = index.get(audio_fingerprint)
+        if not data:
+            return None
+        entry = DedupeEntry(**data)
+        if not _is_intact(entry):
+            logger.info(f"The output of {entry.asset_id} is gone, forgetting it")
+            del index[audio_fingerprint]
+            return None
+    return entry
+
+
+def store(entry: DedupeEntry):
+    with _locked_index() as index:
+        index[entry.fingerprint] = asdict(entry)
+
+
+# copies the 1Best.ctm/1Best.txt of the entry to output_dir, replacing the asset ID
+def materialise(entry: DedupeEntry, output_dir: str, asset_id: str) -> bool:
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        for name in [CTM_FILE, TXT_FILE]:
+            path = os.path.join(output_dir, name)
+            with (
+                open(os.path.join(entry.output_dir, name), encoding="utf-8") as f_in,
+                open(f"{path}.part", "w", encoding="utf-8") as f_out,
+            ):
+                for line in f_in:
+                    f_out.write(_replace_asset_id(line, entry.asset_id, asset_id))
+            os.replace(f"{path}.part", path)
+    except OSError:
+        logger.exception(f"Failed to copy the ASR output of {entry.asset_id}")
+        return False
+    return True
+
+
+def new_entry(
+    audio_fingerprint: str,
+    audio_path: str,
+    output_dir: str,
+    asr_wall_time: float,
+    asr_cpu_time: float,
+) -> DedupeEntry:
+    return DedupeEntry(
+        audio_fingerprint,
+        get_asset_info(audio_path)[0],
+        output_dir,
+        os.path.getsize(os.path.join(output_dir, CTM_FILE)),
+        os.path.getsize(os.path.join(output_dir, TXT_FILE)),
+        asr_wall_time,
+        asr_cpu_time,
+    )
+
+
+# the stat of the file is part of the key, so a changed file is hashed again
+@lru_cache(maxsize=128)
+def _fingerprint(audio_path: str, size: int, mtime_ns: int) -> Optional[str]:
+    sha = hashlib.sha256(f"{transcode_sample_rate}:{transcode_channels}:".encode())
+    if _is_normalised_wav(audio_path):  # just hash the PCM frames
+        with wave.open(audio_path, "rb") as w:
+            for frames in iter(
+                lambda: w.readframes(CHUNK_SIZE // PCM_SAMPLE_WIDTH), b""
+            ):
+                sha.update(frames)
+        return sha.hexdigest()
+
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-i",
+        audio_path,
+        "-map",
+        "0:a:0",
+        "-ac",
+        str(transcode_channels),
+        "-ar",
+        str(transcode_sample_rate),
+        "-f",
+        "s16le",
+        "-",
+    ]
+    try:
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        logger.exception(f"Failed to decode {audio_path} for its fingerprint")
+        return None
+    try:
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):  # type: ignore
+            sha.update(chunk)
+        if process.wait(timeout=transcode_timeout or None) != 0:
+            logger.error(f"Failed to decode {audio_path} for its fingerprint")
+            return None
+    except subprocess.TimeoutExpired:
+        logger.exception(f"Failed to decode {audio_path} for its fingerprint")
+        process.kill()
+        return None
+    return sha.hexdigest()
+
+
+def _is_normalised_wav(audio_path: str) -> bool:
+    if not audio_path.endswith(".wav"):
+        return False
+    try:
+        with wave.open(audio_path, "rb") as w:
+            return (
+                w.getframerate() == transcode_sample_rate
+                and w.getnchannels() == transcode_channels
+                and w.getsampwidth() == PCM_SAMPLE_WIDTH
+            )
+    except (wave.Error, EOFError):
+        return False
+
+
+def _is_intact(entry: DedupeEntry) -> bool:
+    ctm_path = os.path.join(entry.output_dir, CTM_FILE)
+    txt_path = os.path.join(entry.output_dir, TXT_FILE)
+    return (
+        os.path.exists(ctm_path)
+        and os.path.exists(txt_path)
+        and os.path.getsize(ctm_path) == entry.ctm_size
+        and os.path.getsize(txt_path) == entry.txt_size
+    )
+
+
+# e.g. "carrier.0001 1 12.34 0.33 word 1.00" or "words words (carrier.0001 12.340)"
+def _replace_asset_id(line: str, old_asset_id: str, asset_id: str) -> str:
+    if line.startswith(f"{old_asset_id}."):
+        return asset_id + line[len(old_asset_id) :]
+    return line.replace(f"({old_asset_id}.", f"({asset_id}.", 1)
+
+
+def _locked_index() -> ContextManager[Dict[str, dict]]:
+    return locked_json_file(os.path.join(output_base_dir, INDEX_FILE), dict)
@@ -1,14 +1,48 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
 import logging
+import mimetypes
 import os
 import requests
+from requests.adapters import HTTPAdapter
+import struct
+import threading
 import time
-from typing import Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
-from s3_util import S3Store, parse_s3_uri, validate_s3_uri
-from config import output_base_dir, s3_endpoint_url
+from urllib3.util.retry import Retry
+from botocore.exceptions import ClientError
+import download_cache
+from s3_util import (
+    PARTIAL_DOWNLOAD_EXTENSION,
+    get_s3_store,
+    parse_s3_uri,
+    validate_s3_uri,
+)
+from base_util import file_checksum
+from config import (
+    ingest_mode,
+    s3_endpoint_url,
+    transcode_format,
+    http_connect_timeout,
+    http_read_timeout,
+    http_retries,
+    http_backoff_factor,
+    http_chunk_size,
+    http_pool_size,
+)
+
+from transcode import transcode_stream
 
 logger = logging.getLogger(__name__)
+# containers with boxes ("atoms"), which can only be streamed if the moov box (with the
+# index of the media) comes before the mdat box (with the media itself)
+MP4_EXTENSIONS = [".mp4", ".m4v", ".mov", ".3gp", ".3g2", ".mj2"]
+BOX_HEADER_SIZE = 16  # size (4 bytes), type (4) and the optional 64 bit size (8)
+MAX_TOP_LEVEL_BOXES = 16  # checked for the moov box, before giving up
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
 
 
 @dataclass
@@ -17,9 +51,23 @@ class DownloadResult:
     download_time: float = -1  # time (secs) taken to receive data after request
     mime_type: str = "unknown"  # download_data.get("mime_type", "unknown"),
     content_length: int = -1  # download_data.get("content_length", -1),
+    cache_status: str = download_cache.MISS  # hit, revalidated or miss
+
+
+# what the server told about the (streamed) file
+@dataclass
+class _HttpResponseInfo:
+    not_modified: bool = False  # 304 on a conditional GET, nothing was transferred
+    mime_type: str = "unknown"
+    etag: str = ""
+    last_modified: str = ""
 
 
 def download_uri(uri: str) -> Optional[DownloadResult]:
+    if ingest_mode == "stream":
+        result = stream_audio(uri)
+        if result:
+            return result
     logger.info(f"Trying to download {uri}")
     if validate_s3_uri(uri):
         logger.info("URI seems to be an s3 uri")
@@ -30,23 +78,219 @@ def download_uri(uri: str) -> Optional[DownloadResult]:
 def http_download(url: str) -> Optional[DownloadResult]:
     logger.info(f"Checking if {url} was already downloaded")
     fn = os.path.basename(urlparse(url).path)
-    output_file = os.path.join(output_base_dir, fn)
+    output_file = download_cache.file_path_for(url, fn)
+    entry = _cached_entry(url, output_file)
 
-    # download if the file is not present (preventing unnecessary downloads)
+    # download if the file is not present or changed (preventing unnecessary downloads)
     start_time = time.time()
-    if not os.path.exists(output_file):
-        logger.info(f"File {output_file} not downloaded yet")
-        with open(output_file, "wb") as file:
-            response = requests.get(url)
-            file.write(response.content)
-            file.close()
-    download_time = (time.time() - start_time) * 1000  # time in ms
+    if os.path.exists(output_file) and not (
+        entry and (entry.etag or entry.last_modified)
+    ):
+        logger.info(f"File {output_file} already downloaded")
+        cache_status = download_cache.HIT
+        mime_type = mimetypes.guess_type(output_file)[0] or "unknown"
+    else:
+        logger.info(f"File {output_file} not downloaded yet or needs revalidation")
+        info = _stream_to_file(
+            url,
+            output_file,
+            download_cache.conditional_headers(entry) if entry else {},
+        )
+        if not info:
+            logger.error(f"Failed to download {url}")
+            return None
+        mime_type = info.mime_type
+        if info.not_modified:
+            logger.info(f"File {output_file} is still up to date")
+            cache_status = download_cache.REVALIDATED
+            mime_type = mimetypes.guess_type(output_file)[0] or "unknown"
+        else:
+            cache_status = download_cache.MISS
+            _store_entry(url, output_file, info.etag, info.last_modified)
+    download_time = time.time() - start_time
     return DownloadResult(
         output_file,
-        download_time,  # TODO add mime_type and content_length
+        download_time,
+        mime_type,
+        os.path.getsize(output_file),
+        cache_status,
     )
 
 
+# returns the cache entry if the local file still matches it (removing the
+# file if it does not, so it is downloaded again)
+def _cached_entry(uri: str, output_file: str) -> Optional[download_cache.CacheEntry]:
+    entry = download_cache.lookup(uri)
+    if entry and not download_cache.is_intact(entry):
+        logger.warning(f"{output_file} does not match the download cache, removing")
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return None
+    return entry
+
+
+def _store_entry(uri: str, output_file: str, etag: str, last_modified: str):
+    download_cache.store(
+        download_cache.CacheEntry(
+            uri,
+            output_file,
+            etag,
+            last_modified,
+            os.path.getsize(output_file),
+            file_checksum(output_file),
+        )
+    )
+
+
+# shared by all (threaded) downloads, so connections are pooled & reused
+def get_http_session() -> requests.Session:
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=http_retries,
+                backoff_factor=http_backoff_factor,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["HEAD", "GET"],
+            )
+            adapter = HTTPAdapter(
+                pool_connections=http_pool_size,
+                pool_maxsize=http_pool_size,
+                max_retries=retry,
+            )
+            _http_session = requests.Session()
+            _http_session.mount("http://", adapter)
+            _http_session.mount("https://", adapter)
+        return _http_session
+
+
+# streams the url into a .part file, which is renamed to output_file once complete.
+# A .part file left by an earlier (interrupted) attempt is resumed with a Range
+# request. The validators make it a conditional GET for a file that is already there
+def _stream_to_file(
+    url: str, output_file: str, validators: Dict[str, str]
+) -> Optional[_HttpResponseInfo]:
+    part_file = f"{output_file}{PARTIAL_DOWNLOAD_EXTENSION}"
+    # (re)connecting is retried by the session, here only broken transfers are resumed
+    for attempt in range(http_retries + 1):
+        received = _file_size(part_file)
+        try:
+            info = _stream_attempt(url, part_file, validators)
+            if info and info.not_modified:
+                return info
+            if info:
+                os.replace(part_file, output_file)
+                _remove_if_exists(_validator_file(part_file))
+                return info
+        except requests.RequestException:
+            logger.exception(f"Download attempt {attempt + 1} of {url} failed")
+        if received and not os.path.exists(part_file):
+            continue  # the .part file was discarded, the next attempt starts over
+        if _file_size(part_file) <= received:
+            logger.error(f"Download of {url} made no progress, giving up")
+            return None
+    return None
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _remove_if_exists(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# the ETag (or Last-Modified) of the response a .part file was started from, stored
+# next to it so resuming it is an If-Range request
+def _validator_file(part_file: str) -> str:
+    return f"{part_file}.validator"
+
+
+def _read_validator(part_file: str) -> str:
+    path = _validator_file(part_file)
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+# If-Range only works with a strong ETag, otherwise the Last-Modified date is used
+def _write_validator(part_file: str, etag: str, last_modified: str):
+    validator = etag if etag and not etag.startswith("W/") else last_modified
+    if not validator:
+        _remove_if_exists(_validator_file(part_file))
+        return
+    with open(_validator_file(part_file), "w", encoding="utf-8") as f:
+        f.write(validator)
+
+
+# the Range (and If-Range) headers to resume the .part file, if it can be resumed
+def _resume_headers(url: str, part_file: str) -> Dict[str, str]:
+    offset = _file_size(part_file)
+    validator = _read_validator(part_file)
+    if offset and validator:
+        logger.info(f"Resuming download of {url} from byte {offset}")
+        return {"Range": f"bytes={offset}-", "If-Range": validator}
+    if offset:
+        logger.warning(f"No validator stored for {part_file}, starting over")
+        os.remove(part_file)
+    return {}
+
+
+# returns the response info if the .part file is complete (or the file was not
+# modified), None if the transfer was cut
+def _stream_attempt(
+    url: str, part_file: str, validators: Dict[str, str]
+) -> Optional[_HttpResponseInfo]:
+    headers = _resume_headers(url, part_file) or validators
+    offset = _file_size(part_file)
+
+    with get_http_session().get(
+        url,
+        headers=headers,
+        stream=True,
+        timeout=(http_connect_timeout, http_read_timeout),
+    ) as response:
+        info = _HttpResponseInfo(
+            response.status_code == 304,
+            response.headers.get("Content-Type", "unknown").split(";")[0],
+            response.headers.get("ETag", ""),
+            response.headers.get("Last-Modified", ""),
+        )
+        if info.not_modified:
+            return info
+        if response.status_code == 416:  # the .part file already has all the bytes
+            total = response.headers.get("Content-Range", "").split("/")[-1]
+            if total.isdigit() and int(total) == offset:
+                return _HttpResponseInfo(
+                    mime_type=mimetypes.guess_type(url)[0] or "unknown"
+                )
+            logger.warning("Partial download does not match, starting over")
+            os.remove(part_file)
+            return None
+        response.raise_for_status()
+
+        # the server ignored the Range header or (If-Range) the file changed
+        if response.status_code != 206:
+            if offset:
+                logger.info(f"{url} cannot be resumed, downloading it from the start")
+            offset = 0
+            _write_validator(part_file, info.etag, info.last_modified)
+        content_length = response.headers.get("Content-Length")
+        expected = offset + int(content_length) if content_length else -1
+
+        with open(part_file, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size=http_chunk_size):
+                f.write(chunk)
+            received = f.tell()
+
+    if expected >= 0 and received != expected:
+        logger.warning(f"Received {received} of {expected} bytes from {url}")
+        return None
+    return info
+
+
 # e.g. s3://dane-asset-staging-gb/assets/2101608170158176431__NOS_JOURNAAL_-WON01513227.mp4
 def s3_download(s3_uri: str) -> Optional[DownloadResult]:
     logger.info(f"Checking if {s3_uri} was already downloaded")
@@ -58,22 +302,238 @@ def s3_download(s3_uri: str) -> Optional[DownloadResult]:
     # parse S3 URI
     bucket, object_name = parse_s3_uri(s3_uri)
     logger.info(f"OBJECT NAME: {object_name}")
-    output_file = os.path.join(
-        output_base_dir,
+    output_file = download_cache.file_path_for(
+        s3_uri,
         os.path.basename(object_name),  # i.e. visxp_prep__<source_id>.tar.gz
     )
+    entry = _cached_entry(s3_uri, output_file)
+    s3 = get_s3_store(s3_endpoint_url)
+
+    download_time = 0.0
+    cache_status = download_cache.HIT
+    if os.path.exists(output_file) and entry and entry.etag:
+        # a HeadObject is enough to see if the object changed
+        head = s3.head_object(bucket, object_name)
+        if head and head.etag == entry.etag:
+            logger.info(f"File {output_file} is still up to date")
+            cache_status = download_cache.REVALIDATED
+        elif head:
+            logger.info(f"{s3_uri} changed since it was downloaded")
+            os.remove(output_file)
+        else:
+            logger.warning(f"Could not revalidate {s3_uri}, using {output_file}")
 
     if not os.path.exists(output_file):
         # source_id = get_source_id(s3_uri)
-        start_time = time.time()
-        s3 = S3Store(s3_endpoint_url)
-        success = s3.download_file(bucket, object_name, output_base_dir)
+        head = s3.head_object(bucket, object_name)
+        result = s3.download_file(bucket, object_name, os.path.dirname(output_file))
 
-        if not success:
+        if not result.success:
             logger.error("Failed to download input data from S3")
             return None
-    download_time = time.time() - start_time
+        download_time = result.duration
+        cache_status = download_cache.MISS
+        _store_entry(
+            s3_uri,
+            output_file,
+            head.etag if head else "",
+            head.last_modified if head else "",
+        )
+    elif cache_status == download_cache.HIT:
+        logger.info(f"File {output_file} already downloaded")
     return DownloadResult(
         output_file,
         download_time,
+        mimetypes.guess_type(output_file)[0] or "unknown",
+        os.path.getsize(output_file),
+        cache_status,
     )
+
+
+# pipes the (video) input at the URI into ffmpeg, only storing the extracted audio (as
+# <asset ID>.<TRANSCODE_FORMAT>), which is then used as the input. Returns None if the
+# input is not a video, cannot be read without seeking or the stream failed, so it can
+# be downloaded instead
+def stream_audio(uri: str) -> Optional[DownloadResult]:
+    is_s3 = uri.startswith("s3://") and validate_s3_uri(uri)
+    file_name = os.path.basename(parse_s3_uri(uri)[1] if is_s3 else urlparse(uri).path)
+    asset_id, extension = os.path.splitext(file_name)
+    if not (mimetypes.guess_type(file_name)[0] or "").startswith("video/"):
+        logger.info(f"{file_name} is not a video, nothing to gain by streaming it")
+        return None
+
+    audio_name = f"{asset_id}.{transcode_format}"
+    entry = download_cache.lookup(uri)
+    if entry and os.path.basename(entry.file_path) != audio_name:
+        logger.info(f"{uri} was downloaded before, not streaming it")
+        return None
+    audio_path = download_cache.file_path_for(uri, audio_name)
+    if entry and download_cache.is_intact(entry):
+        cache_status = _revalidate(uri, entry, is_s3)
+        if cache_status:
+            logger.info(f"Audio of {uri} already extracted: {audio_path}")
+            return DownloadResult(
+                audio_path,
+                0,
+                mimetypes.guess_type(audio_path)[0] or "unknown",
+                os.path.getsize(audio_path),
+                cache_status,
+            )
+
+    if extension.lower() in MP4_EXTENSIONS and not _index_before_media(uri, is_s3):
+        logger.info(f"{file_name} cannot be read without seeking, downloading it")
+        return None
+
+    logger.info(f"Streaming {uri} into ffmpeg, only keeping the audio")
+    part_file = f"{audio_path}{PARTIAL_DOWNLOAD_EXTENSION}"
+    start_time = time.time()
+    streamed = _stream_into_ffmpeg(uri, is_s3, part_file)
+    if not streamed:
+        logger.warning(f"Streaming {uri} failed, downloading it instead")
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        return None
+    os.replace(part_file, audio_path)
+    received, (etag, last_modified) = streamed
+    _store_entry(uri, audio_path, etag, last_modified)
+    download_time = time.time() - start_time
+    logger.info(
+        f"Extracted the audio from {received} streamed bytes in "
+        f"{download_time:.1f}s: {audio_path}"
+    )
+    return DownloadResult(
+        audio_path,
+        download_time,
+        mimetypes.guess_type(audio_path)[0] or "unknown",
+        os.path.getsize(audio_path),
+        download_cache.MISS,
+    )
+
+
+# returns the number of bytes streamed and the (ETag, Last-Modified) of the input,
+# None if the stream or ffmpeg failed
+def _stream_into_ffmpeg(
+    uri: str, is_s3: bool, output_file: str
+) -> Optional[Tuple[int, Tuple[str, str]]]:
+    received = 0
+
+    def counted(chunks: Iterator[bytes]) -> Iterator[bytes]:
+        nonlocal received
+        for chunk in chunks:
+            received += len(chunk)
+            yield chunk
+
+    try:
+        with _open_stream(uri, is_s3) as (chunks, validators):
+            if not transcode_stream(counted(chunks), output_file):
+                return None
+    except (requests.RequestException, ClientError):
+        logger.exception(f"Could not open {uri}")
+        return None
+    return received, validators
+
+
+# yields the chunks of the object/response and its (ETag, Last-Modified)
+@contextmanager
+def _open_stream(
+    uri: str, is_s3: bool
+) -> Iterator[Tuple[Iterator[bytes], Tuple[str, str]]]:
+    if is_s3:
+        bucket, object_name = parse_s3_uri(uri)
+        response = get_s3_store(s3_endpoint_url).client.get_object(
+            Bucket=bucket, Key=object_name
+        )
+        try:
+            yield response["Body"].iter_chunks(http_chunk_size), (
+                response.get("ETag", ""),
+                str(response.get("LastModified", "")),
+            )
+        finally:
+            response["Body"].close()
+        return
+    with get_http_session().get(
+        uri, stream=True, timeout=(http_connect_timeout, http_read_timeout)
+    ) as response:
+        response.raise_for_status()
+        yield response.iter_content(chunk_size=http_chunk_size), (
+            response.headers.get("ETag", ""),
+            response.headers.get("Last-Modified", ""),
+        )
+
+
+# walks the top level boxes of an MP4/QuickTime file with small range requests
+def _index_before_media(uri: str, is_s3: bool) -> bool:
+    offset = 0
+    for _ in range(MAX_TOP_LEVEL_BOXES):
+        header = _read_range(uri, is_s3, offset, BOX_HEADER_SIZE)
+        if len(header) < 8:
+            return False
+        size, box_type = struct.unpack(">I4s", header[:8])
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1 and len(header) == BOX_HEADER_SIZE:  # 64 bit size
+            size = struct.unpack(">Q", header[8:])[0]
+        if size < 8:  # 0: the box runs until the end of the file
+            return False
+        offset += size
+    return False
+
+
+def _read_range(uri: str, is_s3: bool, offset: int, length: int) -> bytes:
+    byte_range = f"bytes={offset}-{offset + length - 1}"
+    try:
+        if is_s3:
+            bucket, object_name = parse_s3_uri(uri)
+            response = get_s3_store(s3_endpoint_url).client.get_object(
+                Bucket=bucket, Key=object_name, Range=byte_range
+            )
+            return response["Body"].read()
+        with get_http_session().get(
+            uri,
+            headers={"Range": byte_range},
+            stream=True,
+            timeout=(http_connect_timeout, http_read_timeout),
+        ) as response:
+            if response.status_code == 206 or (
+                response.status_code == 200 and offset == 0
+            ):
+                return response.raw.read(length)
+    except (requests.RequestException, ClientError):
+        logger.exception(f"Failed to read {byte_range} of {uri}")
+    return b""
+
+
+# the cache status if the object did not change since the audio was extracted (None
+# if it did). Like for downloads, an entry without validators is a hit
+def _revalidate(
+    uri: str, entry: download_cache.CacheEntry, is_s3: bool
+) -> Optional[str]:
+    if not entry.etag and not entry.last_modified:
+        return download_cache.HIT
+    validators: List[str] = []
+    if is_s3:
+        bucket, object_name = parse_s3_uri(uri)
+        head = get_s3_store(s3_endpoint_url).head_object(bucket, object_name)
+        validators = [head.etag, head.last_modified] if head else []
+    else:
+        try:
+            response = get_http_session().head(
+                uri,
+                allow_redirects=True,
+                timeout=(http_connect_timeout, http_read_timeout),
+            )
+            validators = [
+                response.headers.get("ETag", ""),
+                response.headers.get("Last-Modified", ""),
+            ]
+        except requests.RequestException:
+            logger.exception(f"Could not revalidate {uri}")
+    if validators == [entry.etag, entry.last_modified]:
+        return download_cache.REVALIDATED
+    if not validators:
+        logger.warning(f"Could not revalidate {uri}, using {entry.file_path}")
+        return download_cache.HIT
+    logger.info(f"{uri} changed since its audio was extracted")
+    return None
@@ -0,0 +1,74 @@
+from dataclasses import asdict, dataclass
+import hashlib
+import logging
+import os
+from typing import ContextManager, Dict, Optional
+
+from base_util import locked_json_file
+from config import output_base_dir
+
+logger = logging.getLogger(__name__)
+INDEX_FILE = ".download_index.json"  # in OUTPUT_BASE_DIR, maps URIs to their files
+
+# reported in DownloadResult.cache_status
+HIT = "hit"  # local file used, no validators to check it with upstream
+REVALIDATED = "revalidated"  # local file used, upstream confirmed it is unchanged
+MISS = "miss"  # (re)downloaded
+
+
+@dataclass
+class CacheEntry:
+    uri: str
+    file_path: str
+    etag: str = ""
+    last_modified: str = ""
+    size: int = -1
+    checksum: str = ""  # sha256
+
+
+def lookup(uri: str) -> Optional[CacheEntry]:
+    with _locked_index() as index:
+        entry = index.get(uri)
+    return CacheEntry(**entry) if entry else None
+
+
+def store(entry: CacheEntry):
+    with _locked_index() as index:
+        index[entry.uri] = asdict(entry)
+
+
+# returns where to download the URI to: OUTPUT_BASE_DIR/<file_name>, unless that file
+# belongs to another URI, in which case OUTPUT_BASE_DIR/<URI hash>/<file_name> is used
+# (the file name is kept as is, since it is used as the asset ID)
+def file_path_for(uri: str, file_name: str) -> str:
+    default_path = os.path.join(output_base_dir, file_name)
+    with _locked_index() as index:
+        if uri in index:
+            return index[uri]["file_path"]
+        if not any([e["file_path"] == default_path for e in index.values()]):
+            return default_path
+    uri_hash = hashlib.sha1(uri.encode("utf-8")).hexdigest()[:16]
+    logger.info(f"{file_name} already downloaded from another URI, using {uri_hash}")
+    os.makedirs(os.path.join(output_base_dir, uri_hash), exist_ok=True)
+    return os.path.join(output_base_dir, uri_hash, file_name)
+
+
+# headers for a conditional GET, so unchanged files are not transferred again
+def conditional_headers(entry: CacheEntry) -> Dict[str, str]:
+    headers = {}
+    if entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+
+# the local file still matches what was recorded when it was downloaded
+def is_intact(entry: CacheEntry) -> bool:
+    return os.path.exists(entry.file_path) and (
+        entry.size < 0 or os.path.getsize(entry.file_path) == entry.size
+    )
+
+
+def _locked_index() -> ContextManager[Dict[str, dict]]:
+    return locked_json_file(os.path.join(output_base_dir, INDEX_FILE), dict)
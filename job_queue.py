@@ -0,0 +1,164 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+import logging
+import socket
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# job status
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"  # gave up after the max. number of attempts
+
+
+@dataclass
+class Job:
+    id: int
+    input_uri: str
+    output_uri: Optional[str] = None
+    attempts: int = 0  # including the current one
+
+
+class JobQueue(ABC):
+    """
+    Interface for the queue the worker daemon takes its jobs from. Implement this
+    to consume jobs from another broker.
+    """
+
+    @abstractmethod
+    def put(self, input_uri: str, output_uri: Optional[str] = None) -> int:
+        pass
+
+    # claims the next job that is due, None if there is no such job
+    @abstractmethod
+    def get(self) -> Optional[Job]:
+        pass
+
+    # the job succeeded
+    @abstractmethod
+    def ack(self, job: Job):
+        pass
+
+    # the job failed, but can be retried after the delay (secs)
+    @abstractmethod
+    def retry(self, job: Job, delay: float, error: str = ""):
+        pass
+
+    # the job failed and will not be retried
+    @abstractmethod
+    def fail(self, job: Job, error: str = ""):
+        pass
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Durable job queue in a local SQLite database, which can be shared by several
+    worker processes on the same host. A running job that is not finished within
+    visibility_timeout secs (e.g. because its worker died) is handed out again.
+    """
+
+    def __init__(self, db_path: str, visibility_timeout: float = 86400):
+        self.db_path = db_path
+        self.visibility_timeout = visibility_timeout
+        with self._connection() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    input_uri TEXT NOT NULL,
+                    output_uri TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    claimed_at REAL,
+                    claimed_by TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, available_at)"
+            )
+
+    # one connection per call, so the queue can be used from multiple threads
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        db = self._connect()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def put(self, input_uri: str, output_uri: Optional[str] = None) -> int:
+        now = time.time()
+        with self._connection() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (input_uri, output_uri, status, available_at, "
+                "created_at) VALUES (?, ?, ?, ?, ?)",
+                (input_uri, output_uri, QUEUED, now, now),
+            )
+        logger.info(f"Queued job {cursor.lastrowid}: {input_uri}")
+        return cursor.lastrowid or -1
+
+    def get(self) -> Optional[Job]:
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")  # no other worker can claim the same job
+            row = db.execute(
+                "SELECT id, input_uri, output_uri, attempts FROM jobs "
+                "WHERE (status = ? AND available_at <= ?) "
+                "OR (status = ? AND claimed_at <= ?) "
+                "ORDER BY available_at, id LIMIT 1",
+                (QUEUED, now, RUNNING, now - self.visibility_timeout),
+            ).fetchone()
+            if not row:
+                db.execute("COMMIT")
+                return None
+            job = Job(row[0], row[1], row[2], row[3] + 1)
+            db.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, claimed_at = ?, "
+                "claimed_by = ? WHERE id = ?",
+                (RUNNING, job.attempts, now, socket.gethostname(), job.id),
+            )
+            db.execute("COMMIT")
+            return job
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def ack(self, job: Job):
+        self._update(job, DONE, time.time(), "")
+
+    def retry(self, job: Job, delay: float, error: str = ""):
+        self._update(job, QUEUED, time.time() + delay, error)
+
+    def fail(self, job: Job, error: str = ""):
+        self._update(job, FAILED, time.time(), error)
+
+    def _update(self, job: Job, status: str, available_at: float, error: str):
+        with self._connection() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, available_at = ?, error = ? WHERE id = ?",
+                (status, available_at, error, job.id),
+            )
+
+    def count(self, status: str) -> int:
+        with self._connection() as db:
+            row = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)
+            ).fetchone()
+        return row[0]
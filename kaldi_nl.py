@@ -1,20 +1,157 @@
+import atexit
+import glob
 import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from typing import List, Optional
+
+from asr_admission import admit
+from asr_backend import AsrBackend, PersistentBackend
 from base_util import run_shell_command
+from config import (
+    asr_backend,
+    asr_cpu_affinity,
+    asr_keep_files,
+    asr_decoder_cmd,
+    asr_decoder_pool_size,
+    asr_decoder_max_jobs,
+    asr_decoder_max_rss_mb,
+    asr_decoder_startup_timeout,
+    asr_nice,
+    asr_scratch_dir,
+    asr_segment_minutes,
+    asr_timeout,
+)
+from segmented_asr import get_duration, run_segmented_asr
+from transcript import CTM_FILE, TXT_FILE
 
 logger = logging.getLogger(__name__)
+KALDI_NL_DIR = "/opt/Kaldi_NL"
+STUB_DECODER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stub_decoder.py"
+)
+
+_backend: Optional[AsrBackend] = None
+_backend_lock = threading.Lock()
+
+
+class DecodeScriptBackend(AsrBackend):
+    """
+    Runs decode_OH.sh for every file, so Kaldi_NL loads its models every time.
+    """
+
+    def decode(
+        self, input_path: str, output_dir: str, cpus: Optional[List[int]] = None
+    ) -> bool:
+        return decode(input_path, output_dir, cpus)
 
 
 def run_asr(input_path, output_dir) -> bool:
     logger.info(f"Starting ASR on {input_path}")
-    cmd = 'cd {}; ./{} "{}" "{}"'.format(
-        "/opt/Kaldi_NL",
+    if asr_segment_minutes > 0:
+        return run_segmented_asr(input_path, output_dir, admitted_decode)
+    return admitted_decode(input_path, output_dir)
+
+
+# decodes once the node has the memory and cores for it (see asr_admission.py)
+def admitted_decode(input_path: str, output_dir: str) -> bool:
+    with admit(get_duration(input_path)) as slot:
+        cpus = slot.cpus if asr_cpu_affinity else None
+        if not asr_scratch_dir:
+            return get_asr_backend().decode(input_path, output_dir, cpus)
+        return scratch_decode(input_path, output_dir, cpus)
+
+
+# decodes in a new dir in ASR_SCRATCH_DIR and only keeps the files the pipeline uses
+# (and ASR_KEEP_FILES), so the lattices etc. never reach the (network) output volume.
+# The scratch dir is removed whether the decode succeeded or not
+def scratch_decode(
+    input_path: str, output_dir: str, cpus: Optional[List[int]] = None
+) -> bool:
+    scratch_dir = tempfile.mkdtemp(prefix="kaldi_nl_", dir=asr_scratch_dir)
+    try:
+        if not get_asr_backend().decode(input_path, scratch_dir, cpus):
+            return False
+        return _keep_files(scratch_dir, output_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+# the backend configured with ASR_BACKEND, shared by all jobs of this process
+def get_asr_backend() -> AsrBackend:
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if asr_backend == "oneshot":
+                _backend = DecodeScriptBackend()
+            else:
+                _backend = PersistentBackend(
+                    (
+                        _nice_prefix() + asr_decoder_cmd
+                        if asr_backend == "persistent"
+                        else f'{_nice_prefix()}"{sys.executable}" "{STUB_DECODER}"'
+                    ),
+                    pool_size=asr_decoder_pool_size,
+                    max_jobs=asr_decoder_max_jobs,
+                    max_rss=asr_decoder_max_rss_mb * 1024 * 1024,
+                    startup_timeout=asr_decoder_startup_timeout,
+                    decode_timeout=asr_timeout,
+                    cwd=KALDI_NL_DIR if asr_backend == "persistent" else None,
+                )
+                atexit.register(_backend.close)  # do not leave decoders behind
+            logger.info(f"Using the {asr_backend} ASR backend")
+        return _backend
+
+
+# runs Kaldi_NL on a single audio file, optionally pinned to the given cores
+def decode(input_path, output_dir, cpus: Optional[List[int]] = None) -> bool:
+    cmd = '{}./{} "{}" "{}"'.format(
+        _nice_prefix(),
         "decode_OH.sh",
         input_path,
         output_dir,
     )
+    if cpus:
+        cmd = f"taskset -c {','.join([str(c) for c in cpus])} {cmd}"
+    result = run_shell_command(cmd, asr_timeout, cwd=KALDI_NL_DIR)
+    if not result.success:
+        logger.error(f"Kaldi command failed: {result}")
+        return False
+    logger.info(
+        f"Kaldi_NL done in {result.wall_time:.1f}s "
+        f"(CPU: {result.cpu_time:.1f}s, max RSS: {result.max_rss} bytes)"
+    )
+    return True
+
+
+# copies the output files from the scratch dir (the 1Best.* last, as these mark the
+# decode as done), each via a .part file so a half copied file is never picked up
+def _keep_files(scratch_dir: str, output_dir: str) -> bool:
+    paths = []
+    for pattern in asr_keep_files:
+        paths += sorted(glob.glob(os.path.join(scratch_dir, pattern), recursive=True))
+    for name in [TXT_FILE, CTM_FILE]:
+        path = os.path.join(scratch_dir, name)
+        if not os.path.exists(path):
+            logger.error(f"The decode did not write {name}")
+            return False
+        paths.append(path)
+    paths = [p for p in dict.fromkeys(paths) if os.path.isfile(p)]  # no duplicates
     try:
-        run_shell_command(cmd)
-    except Exception:
-        logger.exception("Kaldi command failed")
+        for path in paths:
+            dest = os.path.join(output_dir, os.path.relpath(path, scratch_dir))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(path, f"{dest}.part")
+            os.replace(f"{dest}.part", dest)
+    except OSError:
+        logger.exception(f"Failed to copy the ASR output to {output_dir}")
         return False
+    logger.info(f"Kept {len(paths)} file(s) of the decode in {output_dir}")
     return True
+
+
+def _nice_prefix() -> str:
+    return f"nice -n {asr_nice} " if asr_nice else ""
@@ -0,0 +1,257 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Iterator, Optional
+import uuid
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from base_util import locked_json_file
+from config import (
+    lease_backend,
+    lease_dir,
+    lease_s3_bucket,
+    lease_s3_prefix,
+    lease_ttl,
+    lease_conflict,
+    lease_max_wait,
+    lease_poll_interval,
+    s3_endpoint_url,
+)
+from s3_util import get_s3_store
+
+logger = logging.getLogger(__name__)
+HEARTBEATS_PER_TTL = 3  # renewals within the TTL, so one missed heartbeat is fine
+
+# S3 error codes of a failed conditional write
+S3_CONDITION_FAILED = ["PreconditionFailed", "ConditionalRequestConflict"]
+
+_backend: Optional["LeaseBackend"] = None
+_backend_lock = threading.Lock()
+
+
+@dataclass
+class Lease:
+    key: str
+    owner: str
+    expires_at: float  # time.time() of the expiry (clocks of the nodes must be in sync)
+    token: str = ""  # backend specific, e.g. the ETag of the S3 lease object
+
+
+class LeaseBackend(ABC):
+    """
+    Stores the leases shared by the workers. Implement this to use another store.
+    """
+
+    # returns None if a valid lease of another owner exists
+    @abstractmethod
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Lease]:
+        pass
+
+    # extends the lease, returns False if it was lost (expired and taken over)
+    @abstractmethod
+    def renew(self, lease: Lease, ttl: float) -> bool:
+        pass
+
+    @abstractmethod
+    def release(self, lease: Lease):
+        pass
+
+
+class FileLeaseBackend(LeaseBackend):
+    """
+    A JSON file per lease in a dir on the shared volume, updated under a file lock
+    (which NFS v4 clients pass on to the server).
+    """
+
+    def __init__(self, lease_dir: str):
+        self.lease_dir = lease_dir
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Lease]:
+        with locked_json_file(self._path(key), dict) as data:
+            if _held_by_other(data, owner):
+                return None
+            lease = Lease(key, owner, time.time() + ttl, owner)
+            data.update({"key": key, "owner": owner, "expires_at": lease.expires_at})
+            return lease
+
+    def renew(self, lease: Lease, ttl: float) -> bool:
+        with locked_json_file(self._path(lease.key), dict) as data:
+            if data.get("owner") != lease.owner:
+                return False
+            lease.expires_at = data["expires_at"] = time.time() + ttl
+            return True
+
+    # removes the lease file (and its lock file), so the dir does not keep a file for
+    # every stage of every asset ever processed
+    def release(self, lease: Lease):
+        with locked_json_file(
+            self._path(lease.key), dict, remove_if_empty=True
+        ) as data:
+            if data.get("owner") == lease.owner:
+                data.clear()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.lease_dir, f"{_key_hash(key)}.json")
+
+
+class S3LeaseBackend(LeaseBackend):
+    """
+    A JSON object per lease, created with a conditional put (If-None-Match) and
+    renewed/taken over with a conditional put on its ETag (If-Match). Any client with
+    the boto3 S3 client interface can be passed, e.g. a local fake.
+    """
+
+    def __init__(self, bucket: str, prefix: str, client: Any):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+    def acquire(self, key: str, owner: str, ttl: float) -> Optional[Lease]:
+        lease = Lease(key, owner, time.time() + ttl)
+        try:
+            if self._put(lease, IfNoneMatch="*"):
+                return lease
+            # there is a lease object, which can be taken over if it expired
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._object_key(key)
+            )
+            data = json.loads(response["Body"].read())
+            if _held_by_other(data, owner):
+                return None
+            return lease if self._put(lease, IfMatch=response["ETag"]) else None
+        except (BotoCoreError, ClientError, ValueError):
+            logger.exception(f"Failed to acquire the lease {key}")
+            return None
+
+    def renew(self, lease: Lease, ttl: float) -> bool:
+        expires_at = lease.expires_at
+        lease.expires_at = time.time() + ttl
+        try:
+            if self._put(lease, IfMatch=lease.token):
+                return True
+        except (BotoCoreError, ClientError):
+            logger.exception(f"Failed to renew the lease {lease.key}")
+        lease.expires_at = expires_at
+        return False
+
+    def release(self, lease: Lease):
+        try:
+            self.client.delete_object(
+                Bucket=self.bucket, Key=self._object_key(lease.key), IfMatch=lease.token
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in S3_CONDITION_FAILED:
+                logger.warning(f"The lease {lease.key} was taken over meanwhile")
+            else:
+                logger.exception(f"Failed to release the lease {lease.key}")
+        except BotoCoreError:  # e.g. a connection error, the lease will expire
+            logger.exception(f"Failed to release the lease {lease.key}")
+
+    # returns False if the condition failed, sets the token of the lease otherwise
+    def _put(self, lease: Lease, **condition) -> bool:
+        body = json.dumps(
+            {"key": lease.key, "owner": lease.owner, "expires_at": lease.expires_at}
+        )
+        try:
+            response = self.client.put_object(
+                Bucket=self.bucket,
+                Key=self._object_key(lease.key),
+                Body=body.encode("utf-8"),
+                ContentType="application/json",
+                **condition,
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in S3_CONDITION_FAILED:
+                return False
+            raise
+        lease.token = response["ETag"]
+        return True
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix.strip('/')}/{_key_hash(key)}.json"
+
+
+class _Heartbeat(threading.Thread):
+    def __init__(self, backend: LeaseBackend, lease: Lease):
+        super().__init__(name=f"lease-{lease.key}", daemon=True)
+        self.backend = backend
+        self.lease = lease
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(lease_ttl / HEARTBEATS_PER_TTL):
+            if not self.backend.renew(self.lease, lease_ttl):
+                # the work goes on, the other worker will find its outputs
+                logger.error(f"Lost the lease {self.lease.key}")
+                return
+
+
+# holds the lease on key (e.g. "asr:<asset ID>") while in the with block, renewing it
+# in the background. Yields False if another worker holds it and LEASE_CONFLICT is
+# skip (with wait, it waits until the lease is released or expired, but at most
+# LEASE_MAX_WAIT secs, after which it skips as well)
+@contextmanager
+def hold(key: str) -> Iterator[bool]:
+    backend = get_lease_backend()
+    if backend is None:
+        yield True
+        return
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    lease = backend.acquire(key, owner, lease_ttl)
+    if lease is None:
+        logger.info(f"Another worker holds the lease {key} ({lease_conflict})")
+    if lease is None and lease_conflict == "wait":
+        lease = _wait_for_lease(backend, key, owner)
+    if lease is None:
+        yield False
+        return
+    heartbeat = _Heartbeat(backend, lease)
+    heartbeat.start()
+    try:
+        yield True
+    finally:
+        heartbeat.stop_event.set()
+        heartbeat.join()
+        backend.release(lease)
+
+
+# polls until the lease is acquired, None if that did not happen within LEASE_MAX_WAIT
+def _wait_for_lease(backend: LeaseBackend, key: str, owner: str) -> Optional[Lease]:
+    deadline = time.time() + lease_max_wait if lease_max_wait > 0 else None
+    while deadline is None or time.time() < deadline:
+        time.sleep(lease_poll_interval)
+        lease = backend.acquire(key, owner, lease_ttl)
+        if lease:
+            return lease
+    logger.warning(f"Waited {lease_max_wait}s for the lease {key}, skipping")
+    return None
+
+
+# the backend configured with LEASE_BACKEND (None if leasing is disabled)
+def get_lease_backend() -> Optional[LeaseBackend]:
+    global _backend
+    with _backend_lock:
+        if _backend is None and lease_backend == "file":
+            _backend = FileLeaseBackend(lease_dir)
+        elif _backend is None and lease_backend == "s3":
+            _backend = S3LeaseBackend(
+                lease_s3_bucket, lease_s3_prefix, get_s3_store(s3_endpoint_url).client
+            )
+        return _backend
+
+
+def _held_by_other(data: dict, owner: str) -> bool:
+    return bool(data) and data["owner"] != owner and data["expires_at"] > time.time()
+
+
+def _key_hash(key: str) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
@@ -1,7 +1,10 @@
+from argparse import Namespace
 import logging
+import os
+import signal
 import sys
 
-from base_util import LOG_FORMAT
+from base_util import LOG_FORMAT, cancel_running_commands
 from config import audio_sample_url
 import simple_asr
 
@@ -15,6 +18,46 @@ logging.basicConfig(
 logger = logging.getLogger()
 
 
+# make sure Kaldi_NL/ffmpeg do not keep running after the worker is stopped
+def stop(signum, frame):
+    logger.warning(f"Received signal {signum}, stopping")
+    cancel_running_commands(wait=True)
+    sys.exit(128 + signum)
+
+
+# adds the --input (or --batch) URIs to the job queue (--enqueue) and/or processes
+# the jobs in it (--daemon)
+def run_job_queue(args: Namespace):
+    from config import job_queue_db, job_visibility_timeout
+    from job_queue import SQLiteJobQueue
+    import pipeline
+
+    queue = SQLiteJobQueue(job_queue_db, job_visibility_timeout)
+    if args.enqueue:
+        input_uris = (
+            pipeline.read_uri_list(args.batch_file)
+            if args.batch_file
+            else [args.input_uri]
+        )
+        for input_uri in input_uris:
+            queue.put(input_uri, args.output_uri)
+    if args.daemon:
+        from worker_daemon import WorkerDaemon
+
+        WorkerDaemon(queue).run()  # installs its own signal handlers
+
+
+# merges the word indexes of all assets in OUTPUT_BASE_DIR into output_file
+def merge_word_indexes(output_file: str) -> bool:
+    from regenerate_transcripts import find_asr_output_dirs
+    import word_index
+
+    index_files = [word_index.word_index_file(d) for d in find_asr_output_dirs()]
+    return word_index.merge_word_indexes(
+        sorted([f for f in index_files if os.path.exists(f)]), output_file
+    )
+
+
 # Start the worker
 if __name__ == "__main__":
     from argparse import ArgumentParser
@@ -26,6 +69,42 @@ if __name__ == "__main__":
         "--input", action="store", dest="input_uri", default=audio_sample_url
     )
     parser.add_argument("--output", action="store", dest="output_uri", default=None)
+    parser.add_argument(
+        "--batch",
+        action="store",
+        dest="batch_file",
+        default=None,
+        help="file with one input URI per line (processed as a pipeline)",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="add the --input (or --batch) URIs to the job queue instead of running",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep processing jobs from the job queue (see JOB_QUEUE_DB)",
+    )
+    parser.add_argument(
+        "--regenerate-transcripts",
+        nargs="?",
+        const="stale",
+        choices=["stale", "all"],
+        default=None,
+        help="regenerate the missing/outdated (or all) transcripts in OUTPUT_BASE_DIR",
+    )
+    parser.add_argument(
+        "--merge-word-indexes",
+        metavar="OUTPUT_FILE",
+        default=None,
+        help="merge the word indexes in OUTPUT_BASE_DIR into one (collection) index",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile the stages of every job (see PROFILE_EVERY_N_JOBS)",
+    )
     parser.add_argument("--log", action="store", dest="loglevel", default="INFO")
     args = parser.parse_args()
 
@@ -41,8 +120,38 @@ if __name__ == "__main__":
     logger.info(f"Logger initialized (log level: {log_level})")
     logger.info(f"Got the following CMD line arguments: {args}")
 
+    if args.profile:
+        import profiling
+
+        profiling.enable()
+
+    if args.enqueue or args.daemon:
+        run_job_queue(args)
+        sys.exit(0)
+
+    if args.regenerate_transcripts:
+        from regenerate_transcripts import regenerate_transcripts
+
+        summary = regenerate_transcripts(
+            regenerate_all=args.regenerate_transcripts == "all"
+        )
+        sys.exit(1 if summary.failed else 0)
+
+    if args.merge_word_indexes:
+        sys.exit(0 if merge_word_indexes(args.merge_word_indexes) else 1)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
     logger.info("very good, running Kaldi_NL")
-    if args.input_uri:
-        simple_asr.run(args.input_uri, args.output_uri)
+    if args.batch_file:
+        import pipeline
+
+        items = pipeline.run_batch(
+            pipeline.read_uri_list(args.batch_file), args.output_uri
+        )
+        sys.exit(0 if all([item.success for item in items]) else 1)
+    elif args.input_uri:
+        sys.exit(0 if simple_asr.run(args.input_uri, args.output_uri) else 1)
     else:
         logger.error("Please supply the --input and --output params")
@@ -0,0 +1,143 @@
+import logging
+import os
+import time
+from typing import Any, ContextManager, Dict, List, Optional
+
+from base_util import file_checksum, locked_json_file
+from transcript import CTM_FILE, TXT_FILE, JSON_FILE, NDJSON_FILE
+
+logger = logging.getLogger(__name__)
+MANIFEST_FILE = "manifest.json"  # in the ASR output dir of each asset
+# written by versions without a manifest: a dir with any of these is "legacy"
+LEGACY_OUTPUTS = [CTM_FILE, TXT_FILE, JSON_FILE, NDJSON_FILE]
+
+# the stages recorded in the manifest, in order: when a stage is run again the
+# stages after it have to be run again as well
+TRANSCODE = "transcode"
+VAD = "vad"
+ASR = "asr"
+TRANSCRIPT = "transcript"
+STAGES = [TRANSCODE, VAD, ASR, TRANSCRIPT]
+
+# stage status
+RUNNING = "running"  # started, but not finished (e.g. the worker crashed)
+DONE = "done"
+FAILED = "failed"
+
+
+class StageManifest:
+    """
+    Records for each stage of an asset its status, inputs and outputs (size, mtime &
+    checksum), so a restarted job only redoes the stages that did not finish or whose
+    inputs/outputs changed since. For ASR output dirs created before there were
+    manifests ("legacy"), existing outputs are adopted as they are, until the first
+    stage is run (or recorded) again.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_FILE)
+
+    # the output dir has outputs of a version without manifests and no stage was run
+    # since the manifest was created
+    @property
+    def legacy(self) -> bool:
+        with self._locked() as manifest:
+            return manifest["legacy"]
+
+    # the stage finished for exactly these inputs and its outputs are still intact.
+    # For a legacy output dir the given outputs are adopted if they all exist
+    def is_done(
+        self, stage: str, inputs: List[str], outputs: Optional[List[str]] = None
+    ) -> bool:
+        if self.legacy:
+            if outputs and all([os.path.exists(p) for p in outputs]):
+                logger.info(f"Adopting the existing {stage} output: {outputs}")
+                self.finish(stage, inputs, outputs, adopted=True)
+                return True
+            return False
+        with self._locked() as manifest:
+            entry = manifest["stages"].get(stage)
+        if not entry or entry["status"] != DONE:
+            return False
+        if sorted(entry["inputs"].keys()) != sorted(inputs):
+            logger.info(f"The inputs of the {stage} stage changed")
+            return False
+        for path, info in list(entry["inputs"].items()) + list(
+            entry["outputs"].items()
+        ):
+            if not _matches(path, info):
+                logger.warning(f"{path} changed since the {stage} stage, redoing it")
+                return False
+        return True
+
+    # the outputs recorded for a finished stage
+    def outputs(self, stage: str) -> List[str]:
+        with self._locked() as manifest:
+            entry = manifest["stages"].get(stage)
+        return list(entry["outputs"].keys()) if entry else []
+
+    # marks the stage as running and forgets about the stages after it
+    def start(self, stage: str):
+        with self._locked() as manifest:
+            manifest["legacy"] = False
+            for later_stage in STAGES[STAGES.index(stage) + 1 :]:
+                manifest["stages"].pop(later_stage, None)
+            manifest["stages"][stage] = {
+                "status": RUNNING,
+                "started": time.time(),
+                "inputs": {},
+                "outputs": {},
+            }
+
+    def finish(
+        self,
+        stage: str,
+        inputs: List[str],
+        outputs: List[str],
+        success: bool = True,
+        adopted: bool = False,  # legacy output, the dir stays legacy
+    ):
+        # the checksums are calculated before taking the lock
+        entry = {
+            "status": DONE if success else FAILED,
+            "finished": time.time(),
+            "inputs": {p: _file_info(p) for p in inputs} if success else {},
+            "outputs": {p: _file_info(p) for p in outputs} if success else {},
+        }
+        with self._locked() as manifest:
+            manifest["stages"][stage] = entry
+            if not adopted:
+                manifest["legacy"] = False
+
+    def _locked(self) -> ContextManager[Dict[str, Any]]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        return locked_json_file(self.path, self._new_manifest)
+
+    def _new_manifest(self) -> Dict[str, Any]:
+        legacy = any(
+            [os.path.exists(os.path.join(self.output_dir, f)) for f in LEGACY_OUTPUTS]
+        )
+        return {"legacy": legacy, "stages": {}}
+
+
+def _file_info(path: str) -> dict:
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "checksum": file_checksum(path),
+    }
+
+
+# only calculates the checksum again if the size is the same, but the file was touched
+def _matches(path: str, info: dict) -> bool:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != info["size"]:
+        return False
+    if stat.st_mtime_ns == info["mtime_ns"]:
+        return True
+    return file_checksum(path) == info["checksum"]
@@ -0,0 +1,184 @@
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import subprocess
+from typing import List, Optional, Tuple
+import wave
+
+from config import transcode_format, transcode_sample_rate, transcode_channels
+
+logger = logging.getLogger(__name__)
+PROBE_FILE = "probe.json"  # in the ASR output dir of the asset
+PROBE_TIMEOUT = 60  # secs, ffprobe only reads the headers (and maybe a few packets)
+
+# how the input is turned into the audio fed to Kaldi_NL, cheapest first
+AS_IS = "as_is"  # already in the right format
+STREAM_COPY = "stream_copy"  # the audio stream is copied into the right container
+DECODE = "decode"  # the audio is decoded (and resampled)
+
+
+@dataclass
+class StreamInfo:
+    index: int
+    codec_type: str  # audio, video, subtitle or data
+    codec_name: str  # e.g. pcm_s16le, mp3 or aac
+    sample_rate: int = 0  # Hz, audio only
+    channels: int = 0  # audio only
+
+
+@dataclass
+class MediaInfo:
+    input_path: str
+    size: int  # bytes, with mtime_ns to tell if the cached probe is still valid
+    mtime_ns: int
+    format_name: str  # as reported by ffprobe, e.g. "wav" or "mov,mp4,m4a,3gp,3g2,mj2"
+    duration: float  # secs
+    streams: List[StreamInfo] = field(default_factory=list)
+
+    # the stream that is transcoded (ffmpeg is told to use the first audio stream)
+    @property
+    def audio(self) -> Optional[StreamInfo]:
+        audio_streams = [s for s in self.streams if s.codec_type == "audio"]
+        return audio_streams[0] if audio_streams else None
+
+
+# reads the container & streams of the input, or the result of an earlier probe of the
+# same file stored in the ASR output dir. Returns None if the input cannot be read
+def probe(input_path: str, output_dir: str = "") -> Optional[MediaInfo]:
+    try:
+        stat = os.stat(input_path)
+    except OSError:
+        logger.exception(f"Cannot probe {input_path}")
+        return None
+    probe_path = os.path.join(output_dir, PROBE_FILE) if output_dir else ""
+    info = _load(probe_path) if probe_path else None
+    if (
+        info
+        and info.input_path == input_path
+        and (info.size, info.mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+    ):
+        return info
+
+    info = _probe_pcm_wav(input_path) or _ffprobe(input_path)
+    if not info:
+        return None
+    info.size, info.mtime_ns = stat.st_size, stat.st_mtime_ns
+    audio = info.audio
+    logger.info(
+        f"Probed {input_path}: {info.format_name}, {info.duration:.1f}s, "
+        + (
+            f"audio: {audio.codec_name} {audio.sample_rate}Hz {audio.channels}ch"
+            if audio
+            else "no audio"
+        )
+    )
+    if probe_path:
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(f"{probe_path}.part", "w", encoding="utf-8") as f:
+                json.dump(asdict(info), f, indent=4)
+            os.replace(f"{probe_path}.part", probe_path)
+        except OSError:
+            logger.exception(f"Could not save {probe_path}")  # just probe again later
+    return info
+
+
+# the cheapest way to get the audio Kaldi_NL needs (see TRANSCODE_FORMAT) from the
+# input, or None (and the reason) if the input cannot be used at all
+def choose_route(info: MediaInfo) -> Tuple[Optional[str], str]:
+    audio = info.audio
+    if audio is None:
+        return None, "the input has no audio stream"
+    if info.duration <= 0:
+        return None, "the input has no duration"
+
+    containers = info.format_name.split(",")
+    if transcode_format == "wav":
+        if (
+            audio.codec_name == "pcm_s16le"
+            and audio.sample_rate == transcode_sample_rate
+            and audio.channels == transcode_channels
+        ):
+            if "wav" in containers and len(info.streams) == 1:
+                return AS_IS, "the input is PCM audio in the right format"
+            return STREAM_COPY, "the audio stream is PCM in the right format"
+        return DECODE, f"the {audio.codec_name} audio needs to be decoded to PCM"
+
+    # mp3: Kaldi_NL decodes the (mp3 or wav) audio itself
+    if len(info.streams) == 1 and (
+        ("mp3" in containers and audio.codec_name == "mp3")
+        or ("wav" in containers and audio.codec_name.startswith("pcm_"))
+    ):
+        return AS_IS, "the input is audio Kaldi_NL can read"
+    if audio.codec_name == "mp3":
+        return STREAM_COPY, "the audio stream is mp3"
+    return DECODE, f"the {audio.codec_name} audio needs to be encoded to mp3"
+
+
+# a PCM wav is read with the wave module, so no ffprobe needs to be started
+def _probe_pcm_wav(input_path: str) -> Optional[MediaInfo]:
+    if not input_path.endswith(".wav"):
+        return None
+    try:
+        with wave.open(input_path, "rb") as w:
+            rate, width = w.getframerate(), w.getsampwidth()
+            codec_name = "pcm_u8" if width == 1 else f"pcm_s{8 * width}le"
+            audio = StreamInfo(0, "audio", codec_name, rate, w.getnchannels())
+            duration = w.getnframes() / rate if rate else 0
+    except (wave.Error, EOFError, OSError):  # e.g. compressed audio in a wav container
+        return None
+    return MediaInfo(input_path, 0, 0, "wav", duration, [audio])
+
+
+def _ffprobe(input_path: str) -> Optional[MediaInfo]:
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_format",
+        "-show_streams",
+        "-of",
+        "json",
+        input_path,
+    ]
+    try:
+        result = subprocess.run(
+            cmd, capture_output=True, text=True, check=True, timeout=PROBE_TIMEOUT
+        )
+        data = json.loads(result.stdout)
+        return MediaInfo(
+            input_path,
+            0,
+            0,
+            data["format"].get("format_name", ""),
+            float(data["format"].get("duration", 0)),
+            [
+                StreamInfo(
+                    s["index"],
+                    s.get("codec_type", ""),
+                    s.get("codec_name", ""),
+                    int(s.get("sample_rate", 0)),
+                    s.get("channels", 0),
+                )
+                for s in data.get("streams", [])
+            ],
+        )
+    except subprocess.CalledProcessError as e:
+        logger.error(f"ffprobe cannot read {input_path}: {e.stderr.strip()}")
+    except (subprocess.TimeoutExpired, ValueError, KeyError, OSError):
+        logger.exception(f"Failed to probe {input_path}")
+    return None
+
+
+def _load(path: str) -> Optional[MediaInfo]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        data["streams"] = [StreamInfo(**s) for s in data["streams"]]
+        return MediaInfo(**data)
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.exception(f"Could not read {path}")
+        return None
@@ -0,0 +1,203 @@
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from base_util import CommandLog, command_log
+from config import metrics_textfile_dir, metrics_pushgateway_url
+from download import get_http_session  # reuses the pooled HTTP session
+from profiling import JobProfiler, sample_job
+
+logger = logging.getLogger(__name__)
+METRICS_FILE = "metrics.json"  # written to the ASR output dir of each asset
+PROMETHEUS_FILE = "dane_asr_worker.prom"  # written to METRICS_TEXTFILE_DIR
+PROMETHEUS_JOB = "dane_asr_worker"
+
+# totals since the start of this process (exported as Prometheus counters)
+_totals: Dict[str, float] = {}
+_totals_lock = threading.Lock()
+
+
+@dataclass
+class StageMetrics:
+    stage: str
+    success: bool = True
+    skipped: bool = False  # e.g. output was already there
+    wall_time: float = 0  # secs
+    cpu_time: float = 0  # secs, this process + its child processes
+    bytes_in: int = 0
+    bytes_out: int = 0
+    peak_child_rss: int = 0  # bytes, max. RSS of the child processes (e.g. Kaldi_NL)
+    commands: int = 0  # child processes run by the stage (see base_util.command_log)
+    command_cpu_time: float = 0  # secs, CPU time of those child processes
+    command_time: float = 0  # secs at least one of those child processes was running
+    audio_duration: float = -1  # secs (ASR only)
+    real_time_factor: float = -1  # ASR decode time / audio duration (ASR only)
+    skipped_audio: float = -1  # secs of non-speech not decoded (VAD only)
+    speech_ratio: float = -1  # speech / audio duration (VAD only)
+
+
+@dataclass
+class AssetMetrics:
+    """
+    Collects the metrics of each stage processing a single asset. Note that the CPU
+    time is measured for the whole process, so it includes the work of other assets
+    when running them in parallel (batch mode).
+    """
+
+    input_uri: str
+    asset_id: str = ""
+    output_dir: str = ""  # ASR output dir, where the metrics.json is written
+    stages: List[StageMetrics] = field(default_factory=list)
+    start_time: float = field(default_factory=time.time)
+    # profiles the stages of 1 in PROFILE_EVERY_N_JOBS assets (see profiling.py)
+    profiler: Optional[JobProfiler] = field(default_factory=sample_job, repr=False)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        metrics = StageMetrics(name)
+        start_time = time.time()
+        cpu_start = _cpu_time()
+        commands = CommandLog()  # the Kaldi_NL/ffmpeg etc. commands of this stage
+        try:
+            with (
+                command_log(commands),
+                self.profiler.stage(name) if self.profiler else nullcontext(),
+            ):
+                yield metrics
+        except Exception:
+            metrics.success = False
+            raise
+        finally:
+            metrics.wall_time = time.time() - start_time
+            metrics.cpu_time = _cpu_time() - cpu_start
+            metrics.commands = len(commands.results)
+            metrics.command_cpu_time = sum([r.cpu_time for r in commands.results])
+            metrics.command_time = commands.busy_time()
+            metrics.peak_child_rss = max([r.max_rss for r in commands.results] + [0])
+            if metrics.audio_duration > 0 and not metrics.skipped:
+                # only the time spent decoding, not waiting for admission or a lease
+                decode_time = metrics.command_time or metrics.wall_time
+                metrics.real_time_factor = decode_time / metrics.audio_duration
+            self.stages.append(metrics)
+            logger.info(f"Stage metrics: {metrics}")
+
+    # writes metrics.json (if there is an output dir) and exports to Prometheus
+    def finish(self, success: bool):
+        _add_to_totals(self, success)
+        if self.output_dir and os.path.exists(self.output_dir):
+            try:
+                with open(
+                    os.path.join(self.output_dir, METRICS_FILE), "w", encoding="utf-8"
+                ) as f:
+                    json.dump(
+                        {
+                            "input_uri": self.input_uri,
+                            "asset_id": self.asset_id,
+                            "success": success,
+                            "total_time": time.time() - self.start_time,
+                            "stages": [asdict(s) for s in self.stages],
+                        },
+                        f,
+                        indent=4,
+                    )
+            except OSError:
+                logger.exception(f"Failed to write {METRICS_FILE}")
+            if self.profiler:
+                self.profiler.save(self.output_dir)
+        if metrics_textfile_dir or metrics_pushgateway_url:
+            export_prometheus(self)
+
+
+def _cpu_time() -> float:
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    return self_usage.ru_utime + self_usage.ru_stime + _children_cpu_time()
+
+
+def _children_cpu_time() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+
+def _add_to_totals(asset_metrics: AssetMetrics, success: bool):
+    with _totals_lock:
+        key = f'jobs_total{{status="{"success" if success else "failure"}"}}'
+        _totals[key] = _totals.get(key, 0) + 1
+        for s in asset_metrics.stages:
+            for name, value in [
+                ("stage_wall_seconds_total", s.wall_time),
+                ("stage_cpu_seconds_total", s.cpu_time),
+                ("stage_bytes_in_total", s.bytes_in),
+                ("stage_bytes_out_total", s.bytes_out),
+            ]:
+                key = f'{name}{{stage="{s.stage}"}}'
+                _totals[key] = _totals.get(key, 0) + value
+            if s.audio_duration > 0:
+                key = "audio_seconds_total"
+                _totals[key] = _totals.get(key, 0) + s.audio_duration
+
+
+# Prometheus text format: the stage metrics of the last asset as gauges, plus
+# the totals of this process as counters
+def to_prometheus_text(asset_metrics: AssetMetrics) -> str:
+    lines = []
+    gauges = [
+        ("stage_wall_seconds", "wall_time"),
+        ("stage_cpu_seconds", "cpu_time"),
+        ("stage_bytes_in", "bytes_in"),
+        ("stage_bytes_out", "bytes_out"),
+        ("stage_peak_child_rss_bytes", "peak_child_rss"),
+        ("asr_audio_duration_seconds", "audio_duration"),
+        ("asr_real_time_factor", "real_time_factor"),
+        ("vad_skipped_audio_seconds", "skipped_audio"),
+        ("vad_speech_ratio", "speech_ratio"),
+    ]
+    for name, attr in gauges:
+        values = [
+            (s.stage, getattr(s, attr))
+            for s in asset_metrics.stages
+            if getattr(s, attr) >= 0
+        ]
+        if not values:
+            continue
+        lines.append(f"# TYPE {PROMETHEUS_JOB}_{name} gauge")
+        for stage, value in values:
+            lines.append(f'{PROMETHEUS_JOB}_{name}{{stage="{stage}"}} {value}')
+    with _totals_lock:
+        names = sorted(set([key.split("{")[0] for key in _totals]))
+        for name in names:
+            lines.append(f"# TYPE {PROMETHEUS_JOB}_{name} counter")
+            for key, value in sorted(_totals.items()):
+                if key.split("{")[0] == name:
+                    lines.append(f"{PROMETHEUS_JOB}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(asset_metrics: AssetMetrics):
+    text = to_prometheus_text(asset_metrics)
+    if metrics_textfile_dir:
+        path = os.path.join(metrics_textfile_dir, PROMETHEUS_FILE)
+        try:
+            with open(f"{path}.part", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(f"{path}.part", path)  # never expose a half written file
+        except OSError:
+            logger.exception(f"Failed to write {path}")
+    if metrics_pushgateway_url:
+        url = (
+            f"{metrics_pushgateway_url.rstrip('/')}/metrics/job/{PROMETHEUS_JOB}"
+            f"/instance/{socket.gethostname()}"
+        )
+        try:
+            response = get_http_session().put(
+                url, data=text.encode("utf-8"), timeout=10
+            )
+            response.raise_for_status()
+        except Exception:
+            logger.exception(f"Failed to push metrics to {url}")
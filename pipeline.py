@@ -0,0 +1,246 @@
+from dataclasses import dataclass, field
+from itertools import count
+import logging
+import math
+from queue import PriorityQueue, Queue
+import threading
+import time
+from typing import Callable, List, Optional
+
+from cache_manager import CacheLease, INPUT, INTERMEDIATE, OUTPUT
+from metrics import AssetMetrics
+from config import (
+    asr_dedupe,
+    pipeline_download_workers,
+    pipeline_transcode_workers,
+    pipeline_asr_workers,
+    pipeline_upload_workers,
+    pipeline_queue_depth,
+    pipeline_longest_first,
+    pipeline_longest_first_depth,
+    vad_enabled,
+)
+from media_probe import probe
+import simple_asr
+from vad import SpeechAudio
+
+logger = logging.getLogger(__name__)
+_STOP = None  # sentinel telling a stage worker there is no more work
+
+
+@dataclass
+class BatchItem:
+    input_uri: str
+    output_uri: Optional[str] = None
+    input_path: str = ""  # downloaded (and later transcoded) input file
+    asset_id: str = ""
+    output_path: str = ""  # Kaldi_NL output dir
+    speech: Optional[SpeechAudio] = None  # decoded instead of the input (VAD)
+    duration: float = -1  # secs of audio, known after the transcode
+    success: bool = True
+    failed_stage: str = ""  # name of the stage where processing stopped
+    start_time: float = -1  # time the item entered the first stage
+    processing_time: float = -1  # time (secs) taken to pass through the pipeline
+    lease: CacheLease = field(default_factory=CacheLease)  # files in use
+    metrics: AssetMetrics = field(init=False)
+
+    def __post_init__(self):
+        self.metrics = AssetMetrics(self.input_uri)
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    func: Callable[[BatchItem], bool]  # returns False if the item failed
+    workers: int = 1
+    queue_depth: int = 1  # max. number of items waiting for this stage
+    # if given, the waiting item with the lowest value is processed first
+    priority: Optional[Callable[[BatchItem], float]] = None
+    queue: Queue = field(init=False)
+    threads: List[threading.Thread] = field(default_factory=list, init=False)
+    _counter: count = field(default_factory=count, init=False)
+
+    def __post_init__(self):
+        if self.priority:
+            self.queue = PriorityQueue(maxsize=self.queue_depth)
+        else:
+            self.queue = Queue(maxsize=self.queue_depth)
+
+    def put(self, item: Optional[BatchItem]):
+        if not self.priority:
+            self.queue.put(item)
+            return
+        # _STOP goes after the items, the counter keeps items of equal priority in order
+        value = math.inf if item is None else self.priority(item)
+        self.queue.put((value, next(self._counter), item))
+
+    def get(self) -> Optional[BatchItem]:
+        item = self.queue.get()
+        return item[2] if self.priority else item
+
+
+# reads a file with one input URI per line (empty lines and # comments are skipped)
+def read_uri_list(uri_list_file: str) -> List[str]:
+    with open(uri_list_file, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+# runs simple_asr.run for each input URI, overlapping the different stages,
+# i.e. while item N is in the ASR, item N+1 is downloaded/transcoded and
+# item N-1 is uploaded
+def run_batch(input_uris: List[str], output_uri: Optional[str]) -> List[BatchItem]:
+    logger.info(f"Processing batch of {len(input_uris)} input URIs")
+    items = [BatchItem(input_uri, output_uri) for input_uri in input_uris]
+    stages = [
+        PipelineStage(
+            "download", _download, pipeline_download_workers, pipeline_queue_depth
+        ),
+        PipelineStage(
+            "transcode", _transcode, pipeline_transcode_workers, pipeline_queue_depth
+        ),
+        _asr_stage(),
+        PipelineStage("upload", _upload, pipeline_upload_workers, pipeline_queue_depth),
+    ]
+    start_time = time.time()
+    run_pipeline(items, stages)
+    succeeded = len([item for item in items if item.success])
+    logger.info(
+        f"Batch done in {time.time() - start_time:.1f}s: "
+        f"{succeeded} succeeded, {len(items) - succeeded} failed"
+    )
+    for item in items:
+        if not item.success:
+            logger.error(f"{item.input_uri} failed in stage: {item.failed_stage}")
+    return items
+
+
+# with PIPELINE_LONGEST_FIRST the ASR queue is a (larger) priority buffer, the
+# transcode stage fills it while the ASR is busy, so there is something to reorder
+def _asr_stage() -> PipelineStage:
+    if not pipeline_longest_first:
+        return PipelineStage("asr", _asr, pipeline_asr_workers, pipeline_queue_depth)
+    return PipelineStage(
+        "asr",
+        _asr,
+        pipeline_asr_workers,
+        pipeline_longest_first_depth,
+        lambda item: -item.duration,
+    )
+
+
+# feeds the items through the stages; each stage has its own worker threads and a
+# bounded input queue, so a slow stage blocks the ones before it (backpressure)
+def run_pipeline(items: List[BatchItem], stages: List[PipelineStage]) -> None:
+    for i, stage in enumerate(stages):
+        next_stage = stages[i + 1] if i + 1 < len(stages) else None
+        for n in range(stage.workers):
+            t = threading.Thread(
+                target=_stage_worker,
+                args=(stage, next_stage),
+                name=f"{stage.name}-{n}",
+                daemon=True,
+            )
+            t.start()
+            stage.threads.append(t)
+
+    for item in items:
+        stages[0].put(item)
+
+    # shut down stage by stage, so each stage can finish the work still queued
+    for stage in stages:
+        for _ in stage.threads:
+            stage.put(_STOP)
+        for t in stage.threads:
+            t.join()
+
+
+def _stage_worker(stage: PipelineStage, next_stage: Optional[PipelineStage]):
+    while True:
+        item = stage.get()
+        if item is _STOP:
+            return
+        if item.start_time < 0:
+            item.start_time = time.time()
+        try:
+            success = stage.func(item)
+        except Exception:
+            logger.exception(f"Stage {stage.name} failed for {item.input_uri}")
+            success = False
+
+        if not success:
+            item.success = False
+            item.failed_stage = stage.name
+        if next_stage and item.success:
+            next_stage.put(item)
+        else:
+            item.lease.release()
+            item.metrics.finish(item.success)
+            item.processing_time = time.time() - item.start_time
+            logger.info(
+                f"Done with {item.input_uri} (success={item.success}) "
+                f"in {item.processing_time:.1f}s"
+            )
+
+
+def _download(item: BatchItem) -> bool:
+    input_path = simple_asr.download_input(item.input_uri, item.metrics)
+    if not input_path:
+        logger.error(f"Could not obtain input: {item.input_uri}")
+        return False
+    item.input_path = input_path
+    item.lease.add(input_path, INPUT)
+    item.asset_id, item.output_path = simple_asr.get_output_info(input_path)
+    item.metrics.asset_id, item.metrics.output_dir = item.asset_id, item.output_path
+    item.lease.add(item.output_path, OUTPUT)
+    return True
+
+
+def _transcode(item: BatchItem) -> bool:
+    # probed once (or read from the probe.json of an earlier run), for the transcode
+    # and the duration the ASR queue is ordered by
+    info = probe(item.input_path, item.output_path)
+    item.duration = info.duration if info else -1
+    transcoded_file_path = simple_asr.transcode_input(
+        item.input_path, item.output_path, item.metrics, info
+    )
+    if not transcoded_file_path:
+        logger.error("The transcode failed to yield a valid file to continue with")
+        return False
+    item.input_path = transcoded_file_path
+    item.lease.add(transcoded_file_path, INTERMEDIATE)
+    # looking for identical audio & skipping the non-speech here keeps it out of the
+    # (busy) ASR stage
+    if asr_dedupe and not simple_asr.asr_already_done(
+        item.output_path, item.input_path
+    ):
+        simple_asr.deduplicate_asr_if_possible(
+            item.input_path, item.output_path, item.metrics
+        )
+    if vad_enabled and not simple_asr.asr_already_done(
+        item.output_path, item.input_path
+    ):
+        item.speech = simple_asr.filter_speech_if_needed(
+            item.input_path, item.output_path, item.metrics
+        )
+    return True
+
+
+def _asr(item: BatchItem) -> bool:
+    success = simple_asr.run_asr_if_needed(
+        item.input_path, item.output_path, item.metrics, item.speech
+    )
+    item.lease.add(item.output_path, OUTPUT)
+    return success
+
+
+def _upload(item: BatchItem) -> bool:
+    if not simple_asr.generate_transcript_if_needed(item.output_path, item.metrics):
+        logger.error(f"Failed to generate the transcript of {item.input_uri}")
+        return False
+    if not item.output_uri:
+        logger.info("No output_uri specified, so all is done")
+        return True
+    return simple_asr.transfer_asr_output(
+        item.output_path, item.asset_id, item.metrics
+    ).success
@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+import cProfile
+from dataclasses import dataclass
+from itertools import count
+import logging
+import os
+import threading
+import tracemalloc
+from typing import Iterator, List, Optional
+
+from config import profile_every_n_jobs, profile_top_n
+
+logger = logging.getLogger(__name__)
+PROFILE_DIR = "profile"  # in the ASR output dir, with a <stage>.prof per stage
+ALLOCATIONS_EXTENSION = ".allocations.txt"  # the top allocations of a stage
+TRACEMALLOC_FRAMES = 10  # of the stack kept per allocation, for the tracebacks
+TRACEBACK_LIMIT = 5  # frames shown for each of the top allocations
+IGNORED_FRAMES = [  # allocations of tracemalloc & imports are not of interest
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+_every_n_jobs = profile_every_n_jobs  # --profile sets it to 1
+_jobs = count()
+_jobs_lock = threading.Lock()
+_tracing = 0  # stages being profiled, tracemalloc only runs while there are any
+_started_tracing = False  # tracemalloc may also have been started with -X tracemalloc
+_tracing_lock = threading.Lock()
+
+
+@dataclass
+class StageProfile:
+    stage: str
+    profile: Optional[cProfile.Profile]  # None if another profiler was active
+    allocations: str  # report of the top PROFILE_TOP_N allocations
+
+
+class JobProfiler:
+    """
+    Profiles each stage of a job with cProfile (only the thread running the stage,
+    so time spent in e.g. boto3's transfer threads or a subprocess shows up as
+    waiting) and tracemalloc. As tracemalloc traces the whole process, the
+    allocations of a stage include those of other jobs running at the same time.
+    """
+
+    def __init__(self):
+        self.profiles: List[StageProfile] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        _start_tracing()
+        before = _snapshot()
+        tracemalloc.reset_peak()
+        profile: Optional[cProfile.Profile] = _enabled_profile()
+        if not profile:
+            logger.warning(f"Cannot profile the {name} stage, already profiling")
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            peak = tracemalloc.get_traced_memory()[1]
+            after = _snapshot()
+            _stop_tracing()
+            self.profiles.append(
+                StageProfile(
+                    name, profile, _allocation_report(name, before, after, peak)
+                )
+            )
+
+    # writes the <stage>.prof (open with e.g. snakeviz or python -m pstats) and
+    # <stage>.allocations.txt files to the profile dir in output_dir
+    def save(self, output_dir: str):
+        profile_dir = os.path.join(output_dir, PROFILE_DIR)
+        try:
+            os.makedirs(profile_dir, exist_ok=True)
+            for p in self.profiles:
+                if p.profile:
+                    p.profile.dump_stats(os.path.join(profile_dir, f"{p.stage}.prof"))
+                with open(
+                    os.path.join(profile_dir, f"{p.stage}{ALLOCATIONS_EXTENSION}"),
+                    "w",
+                    encoding="utf-8",
+                ) as f:
+                    f.write(p.allocations)
+        except OSError:
+            logger.exception(f"Failed to save the profiles to {profile_dir}")
+            return
+        logger.info(
+            f"Saved the profiles of {len(self.profiles)} stages to {profile_dir}"
+        )
+
+
+# profile every job from now on (--profile)
+def enable():
+    global _every_n_jobs
+    _every_n_jobs = 1
+
+
+# a JobProfiler for 1 in PROFILE_EVERY_N_JOBS jobs, None for all others (or if off)
+def sample_job() -> Optional[JobProfiler]:
+    if _every_n_jobs <= 0:
+        return None
+    with _jobs_lock:
+        job = next(_jobs)
+    return JobProfiler() if job % _every_n_jobs == 0 else None
+
+
+def _start_tracing():
+    global _tracing, _started_tracing
+    with _tracing_lock:
+        if _tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _started_tracing = True
+        _tracing += 1
+
+
+# stops tracemalloc (which slows down every allocation) after the last stage
+def _stop_tracing():
+    global _tracing, _started_tracing
+    with _tracing_lock:
+        _tracing -= 1
+        if _tracing == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+# None if the thread is already profiled (e.g. by a debugger or another tool)
+def _enabled_profile() -> Optional[cProfile.Profile]:
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return None
+    return profile
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(IGNORED_FRAMES)
+
+
+# the allocations the stage left behind (largest first), i.e. what it added to the
+# memory use, and the peak of the traced memory during the stage
+def _allocation_report(
+    stage: str, before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, peak: int
+) -> str:
+    lines = [
+        f"Stage: {stage}",
+        f"Peak traced memory: {peak / 1024:.1f} KiB",
+        f"Top {profile_top_n} allocations still held at the end of the stage:",
+        "",
+    ]
+    for i, diff in enumerate(after.compare_to(before, "traceback")[:profile_top_n]):
+        lines.append(
+            f"#{i + 1}: {diff.size_diff / 1024:+.1f} KiB in {diff.count_diff:+d} "
+            f"blocks (total: {diff.size / 1024:.1f} KiB)"
+        )
+        lines += [f"    {line}" for line in diff.traceback.format(TRACEBACK_LIMIT)]
+    return "\n".join(lines) + "\n"
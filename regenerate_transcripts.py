@@ -0,0 +1,145 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+import logging
+import os
+import time
+from typing import Iterator, List, Set, Tuple
+
+from config import output_base_dir, transcript_workers
+from manifest import StageManifest, TRANSCRIPT
+from transcript import CTM_FILE, TXT_FILE, generate_transcript, transcript_files
+
+logger = logging.getLogger(__name__)
+TASKS_PER_WORKER = 4  # dirs queued per worker process, so the queue stays small
+
+
+@dataclass
+class RegenerationSummary:
+    scanned: int = 0  # ASR output dirs found
+    regenerated: int = 0
+    failed: List[str] = field(default_factory=list)  # the output dirs
+    bytes_in: int = 0  # of the 1Best.* files that were read
+    duration: float = -1  # secs
+
+    @property
+    def dirs_per_second(self) -> float:
+        total = self.regenerated + len(self.failed)
+        return total / self.duration if self.duration > 0 else -1
+
+    @property
+    def throughput(self) -> float:  # bytes per second
+        return self.bytes_in / self.duration if self.duration > 0 else -1
+
+    def __str__(self) -> str:
+        return (
+            f"{self.regenerated} transcript(s) regenerated and {len(self.failed)} "
+            f"failed of {self.scanned} output dir(s) in {self.duration:.1f}s "
+            f"({self.dirs_per_second:.1f} dirs/s, "
+            f"{self.throughput / (1024 * 1024):.1f} MB/s)"
+        )
+
+
+# the ASR output dirs (OUTPUT_BASE_DIR/output/<asset ID>, or .../<URI hash>/<asset ID>
+# if the file name is shared by several URIs) with a 1Best.ctm & 1Best.txt
+def find_asr_output_dirs(base_dir: str = output_base_dir) -> Iterator[str]:
+    output_dir = os.path.join(base_dir, "output")
+    if not os.path.isdir(output_dir):
+        return
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            if _has_asr_output(entry.path):
+                yield entry.path
+                continue
+            with os.scandir(entry.path) as sub_entries:
+                for sub_entry in sub_entries:
+                    if sub_entry.is_dir() and _has_asr_output(sub_entry.path):
+                        yield sub_entry.path
+
+
+def _has_asr_output(path: str) -> bool:
+    return os.path.exists(os.path.join(path, CTM_FILE)) and os.path.exists(
+        os.path.join(path, TXT_FILE)
+    )
+
+
+# there is no transcript (or word index) or one of the 1Best.* files is newer than it
+def is_stale(asr_output_dir: str) -> bool:
+    try:
+        transcript_mtime = min(
+            [os.stat(f).st_mtime_ns for f in transcript_files(asr_output_dir)]
+        )
+    except FileNotFoundError:
+        return True
+    return any(
+        [
+            os.stat(os.path.join(asr_output_dir, f)).st_mtime_ns > transcript_mtime
+            for f in [CTM_FILE, TXT_FILE]
+        ]
+    )
+
+
+# regenerates the stale transcripts (or all, e.g. after changing TRANSCRIPT_FORMAT)
+# under base_dir in TRANSCRIPT_WORKERS processes. The transcripts are generated one
+# segment at a time and only a few dirs per worker are queued, so the memory use
+# stays the same for any number of output dirs
+def regenerate_transcripts(
+    base_dir: str = output_base_dir, regenerate_all: bool = False
+) -> RegenerationSummary:
+    summary = RegenerationSummary()
+    start_time = time.time()
+    workers = transcript_workers or os.cpu_count() or 1
+    logger.info(f"Regenerating transcripts under {base_dir} ({workers} workers)")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        pending: Set[Future] = set()
+        for asr_output_dir in find_asr_output_dirs(base_dir):
+            summary.scanned += 1
+            if not regenerate_all and not is_stale(asr_output_dir):
+                continue
+            if len(pending) >= workers * TASKS_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _add_results(summary, done)
+            pending.add(executor.submit(_regenerate, asr_output_dir))
+        _add_results(summary, wait(pending).done)
+    summary.duration = time.time() - start_time
+    logger.info(str(summary))
+    for asr_output_dir in summary.failed:
+        logger.error(f"Failed to regenerate the transcript of {asr_output_dir}")
+    return summary
+
+
+def _add_results(summary: RegenerationSummary, done: Set[Future]):
+    for future in done:
+        asr_output_dir, success, bytes_in = future.result()
+        summary.bytes_in += bytes_in
+        if success:
+            summary.regenerated += 1
+        else:
+            summary.failed.append(asr_output_dir)
+
+
+# runs in the worker processes: the per dir logging would drown out the summary
+def _init_worker():
+    logging.getLogger("transcript").setLevel(logging.WARNING)
+
+
+# also records the transcript in the manifest, unless the output dir predates the
+# manifests (marking a stage there would make the next run redo the ASR)
+def _regenerate(asr_output_dir: str) -> Tuple[str, bool, int]:
+    asr_output_files = [os.path.join(asr_output_dir, f) for f in [TXT_FILE, CTM_FILE]]
+    try:
+        bytes_in = sum([os.path.getsize(f) for f in asr_output_files])
+        manifest = StageManifest(asr_output_dir)
+        legacy = manifest.legacy
+        if not legacy:
+            manifest.start(TRANSCRIPT)
+        success = generate_transcript(asr_output_dir)
+        if not legacy:
+            manifest.finish(
+                TRANSCRIPT, asr_output_files, transcript_files(asr_output_dir), success
+            )
+    except Exception:
+        logger.exception(f"Failed to process {asr_output_dir}")
+        return asr_output_dir, False, 0
+    return asr_output_dir, success, bytes_in
@@ -1,14 +1,77 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+import bz2
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import gzip
+import hashlib
+import json
 import logging
 import ntpath
 import os
 from pathlib import Path
+import subprocess
 import tarfile
-from typing import List, Tuple, Optional
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Optional
+
+from base_util import file_checksum
+from config import (
+    s3_archive_compression,
+    s3_archive_compression_level,
+    s3_multipart_chunksize,
+    s3_max_concurrency,
+    s3_max_pool_connections,
+    s3_parallel_uploads,
+    s3_skip_unchanged,
+)
 
 
 logger = logging.getLogger(__name__)
 COMPRESSED_TAR_EXTENSION = ".tar.gz"
+PARTIAL_DOWNLOAD_EXTENSION = ".part"  # incomplete downloads, renamed when done
+MANIFEST_EXTENSION = ".manifest.json"  # lists the contents of a streamed archive
+
+# archive extension per S3_ARCHIVE_COMPRESSION
+ARCHIVE_EXTENSIONS = {
+    "none": ".tar",
+    "gz": ".tar.gz",
+    "bz2": ".tar.bz2",
+    "pigz": ".tar.gz",
+    "zstd": ".tar.zst",
+}
+# compressors run as a separate (multi threaded) process, reading the tar from stdin
+EXTERNAL_COMPRESSORS = {"pigz": ["pigz", "-c"], "zstd": ["zstd", "-c", "-q", "-T0"]}
+
+_s3_stores: Dict[Optional[str], "S3Store"] = {}  # shared S3Store per endpoint
+_s3_stores_lock = threading.Lock()
+
+
+@dataclass
+class TransferResult:
+    success: bool
+    bytes_transferred: int = 0
+    duration: float = -1  # time (secs) taken by the transfer
+
+    @property
+    def throughput(self) -> float:  # bytes per second
+        return self.bytes_transferred / self.duration if self.duration > 0 else -1
+
+    def __str__(self) -> str:
+        return (
+            f"{self.bytes_transferred} bytes in {self.duration:.2f}s "
+            f"({self.throughput / (1024 * 1024):.1f} MB/s)"
+        )
+
+
+@dataclass
+class ObjectInfo:
+    etag: str
+    last_modified: str
+    size: int
 
 
 # the file name without extension is used as an asset ID by the ASR container to save the results
@@ -82,9 +145,17 @@ def download_s3_uri(s3_uri: str, output_folder: str) -> bool:
     if not validate_s3_uri(s3_uri):
         logger.error("Invalid S3 URI")
         return False
-    s3_store = S3Store()
+    s3_store = get_s3_store()
     bucket, object_name = parse_s3_uri(s3_uri)
-    return s3_store.download_file(bucket, object_name, output_folder)
+    return s3_store.download_file(bucket, object_name, output_folder).success
+
+
+# boto3 clients are thread safe, so one (pooled) client per endpoint is shared
+def get_s3_store(s3_endpoint_url: Optional[str] = None) -> "S3Store":
+    with _s3_stores_lock:
+        if s3_endpoint_url not in _s3_stores:
+            _s3_stores[s3_endpoint_url] = S3Store(s3_endpoint_url)
+        return _s3_stores[s3_endpoint_url]
 
 
 class S3Store:
@@ -98,11 +169,27 @@ class S3Store:
     """
 
     def __init__(self, s3_endpoint_url: Optional[str] = None, unit_testing=False):
-        self.client = boto3.client("s3", endpoint_url=s3_endpoint_url)
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=s3_endpoint_url or None,
+            config=Config(max_pool_connections=s3_max_pool_connections),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=s3_multipart_chunksize,
+            multipart_chunksize=s3_multipart_chunksize,
+            max_concurrency=s3_max_concurrency,
+        )
 
+    # the files are uploaded relative to base_dir (or by file name), so files in sub
+    # dirs (e.g. of S3_UPLOAD_EXTRA_FILES) keep their path like in an archive
     def transfer_to_s3(
-        self, bucket: str, path: str, file_list: List[str], tar_archive_path: str = ""
-    ) -> bool:
+        self,
+        bucket: str,
+        path: str,
+        file_list: List[str],
+        tar_archive_path: str = "",
+        base_dir: str = "",
+    ) -> TransferResult:
         # first check if the file_list needs to be compressed (into tar)
         if tar_archive_path:
             tar_location = tar_list_of_files(tar_archive_path, file_list)
@@ -110,38 +197,332 @@ class S3Store:
                 logger.error(
                     "Could not archive the file list before transferring to S3"
                 )
-                return False
+                return TransferResult(False)
 
             file_list = [tar_archive_path]  # now the file_list just has the tar
+            base_dir = ""
 
-        # now go ahead and upload whatever is in the file list
-        for f in file_list:
-            try:
-                self.client.upload_file(
-                    Filename=f,
-                    Bucket=bucket,
-                    Key=os.path.join(
-                        path,
-                        generate_asset_id_from_input_file(  # file name with extension
-                            f, True
-                        ),
-                    ),
+        # now go ahead and upload whatever is in the file list (in parallel)
+        start_time = time.time()
+        with ThreadPoolExecutor(
+            max_workers=min(s3_parallel_uploads, max(len(file_list), 1))
+        ) as executor:
+            results = list(
+                executor.map(
+                    lambda f: self._upload_file(bucket, path, f, base_dir), file_list
                 )
-            except Exception:  # TODO figure out which Exception to catch specifically
-                logger.exception(f"Failed to upload {f}")
-                return False
-        return True
+            )
+        result = TransferResult(
+            all([r is not None for r in results]),
+            sum([r or 0 for r in results]),
+            time.time() - start_time,
+        )
+        logger.info(f"Uploaded {len(file_list)} file(s) to {bucket}: {result}")
+        return result
+
+    # writes the files into a tar that is compressed and uploaded while it is written
+    # (so without a local archive), as path/archive_name + the archive extension. A
+    # manifest with the name, size and checksum of each file is uploaded next to it
+    # (after the archive), which is also used to skip the upload if nothing changed.
+    # The files are stored relative to base_dir (or by file name)
+    def stream_archive_to_s3(
+        self,
+        bucket: str,
+        path: str,
+        archive_name: str,
+        file_list: List[str],
+        base_dir: str = "",
+        compression: str = s3_archive_compression,
+        level: int = s3_archive_compression_level,
+    ) -> TransferResult:
+        archive_key = os.path.join(
+            path, f"{archive_name}{ARCHIVE_EXTENSIONS[compression]}"
+        )
+        manifest_key = f"{archive_key}{MANIFEST_EXTENSION}"
+        start_time = time.time()
+        try:
+            arcnames = [
+                os.path.relpath(f, base_dir) if base_dir else os.path.basename(f)
+                for f in file_list
+            ]
+            manifest = json.dumps(
+                {
+                    "archive": os.path.basename(archive_key),
+                    "compression": compression,
+                    "files": [
+                        {
+                            "name": name,
+                            "size": os.path.getsize(f),
+                            "sha256": file_checksum(f),
+                        }
+                        for f, name in zip(file_list, arcnames)
+                    ],
+                },
+                indent=4,
+                sort_keys=True,
+            ).encode("utf-8")
+        except OSError:
+            logger.exception(f"Failed to read the files for {archive_key}")
+            return TransferResult(False)
+
+        if (
+            s3_skip_unchanged
+            and self._remote_etag(bucket, manifest_key)
+            == hashlib.md5(manifest).hexdigest()
+            and self._remote_etag(bucket, archive_key)
+        ):
+            logger.info(f"{archive_key} is up to date, skipping the upload")
+            return TransferResult(True, 0, time.time() - start_time)
+
+        upload = _MultipartUpload(self.client, bucket, archive_key)
+        try:
+            _write_archive(upload, file_list, arcnames, compression, level)
+            upload.complete()
+            self.client.put_object(
+                Bucket=bucket,
+                Key=manifest_key,
+                Body=manifest,
+                ContentType="application/json",
+            )
+        except (BotoCoreError, ClientError, OSError, tarfile.TarError):
+            logger.exception(f"Failed to stream {archive_key} to {bucket}")
+            upload.abort()
+            return TransferResult(False)
+        result = TransferResult(
+            True, upload.size + len(manifest), time.time() - start_time
+        )
+        logger.info(f"Streamed {len(file_list)} file(s) to {archive_key}: {result}")
+        return result
+
+    # returns the bytes uploaded, 0 if the object was up to date, None on failure
+    def _upload_file(
+        self, bucket: str, path: str, f: str, base_dir: str = ""
+    ) -> Optional[int]:
+        key = os.path.join(
+            path,
+            (
+                os.path.relpath(f, base_dir)
+                if base_dir
+                else generate_asset_id_from_input_file(f, True)  # with extension
+            ),
+        )
+        try:
+            if s3_skip_unchanged and self._remote_etag(bucket, key) == _local_etag(
+                f, self.transfer_config
+            ):
+                logger.info(f"{key} is up to date, skipping the upload")
+                return 0
+            self.client.upload_file(
+                Filename=f,
+                Bucket=bucket,
+                Key=key,
+                Config=self.transfer_config,
+            )
+        except Exception:  # TODO figure out which Exception to catch specifically
+            logger.exception(f"Failed to upload {f}")
+            return None
+        return os.path.getsize(f)
+
+    # the ETag (without quotes) of the object, empty if it does not exist (or cannot
+    # be reached, the upload will then fail as well)
+    def _remote_etag(self, bucket: str, object_name: str) -> str:
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=object_name)
+        except (BotoCoreError, ClientError):
+            return ""
+        return head.get("ETag", "").strip('"')
+
+    # cheap metadata request, e.g. to check if an object changed
+    def head_object(self, bucket: str, object_name: str) -> Optional[ObjectInfo]:
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=object_name)
+        except Exception:
+            logger.exception(f"Failed to retrieve metadata of {object_name}")
+            return None
+        return ObjectInfo(
+            head.get("ETag", ""),
+            str(head.get("LastModified", "")),
+            head.get("ContentLength", -1),
+        )
 
-    def download_file(self, bucket: str, object_name: str, output_folder: str) -> bool:
+    def download_file(
+        self, bucket: str, object_name: str, output_folder: str
+    ) -> TransferResult:
         logger.info(f"Downloading {bucket}:{object_name} into {output_folder}")
         if not os.path.exists(output_folder):
             logger.info("Output folder does not exist, creating it...")
             os.makedirs(output_folder)
         output_file = os.path.join(output_folder, os.path.basename(object_name))
+        part_file = f"{output_file}{PARTIAL_DOWNLOAD_EXTENSION}"
+        start_time = time.time()
         try:
-            with open(output_file, "wb") as f:
-                self.client.download_fileobj(bucket, object_name, f)
+            # uses parallel ranged GETs for large objects (see transfer_config)
+            self.client.download_file(
+                bucket, object_name, part_file, Config=self.transfer_config
+            )
+            os.replace(part_file, output_file)
         except Exception:
             logger.exception(f"Failed to download {object_name}")
-            return False
-        return True
+            return TransferResult(False)
+        result = TransferResult(
+            True, os.path.getsize(output_file), time.time() - start_time
+        )
+        logger.info(f"Downloaded {object_name}: {result}")
+        return result
+
+
+class _MultipartUpload:
+    """
+    Write only file object that uploads what is written to it as the parts of a
+    multipart upload (S3_MULTIPART_CHUNKSIZE each, up to S3_MAX_CONCURRENCY parts in
+    flight). Small objects that fit in a single part are uploaded with one put instead.
+    """
+
+    def __init__(self, client: Any, bucket: str, key: str):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = 0  # bytes written
+        self.upload_id = ""
+        self.buffer = bytearray()
+        self.parts: List[Future] = []
+        self.executor = ThreadPoolExecutor(max_workers=s3_max_concurrency)
+        self.in_flight = threading.BoundedSemaphore(s3_max_concurrency)
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= s3_multipart_chunksize:
+            self._upload_part(bytes(self.buffer[:s3_multipart_chunksize]))
+            del self.buffer[:s3_multipart_chunksize]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def complete(self):
+        try:
+            if not self.upload_id:
+                self.client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer)
+                )
+                return
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            parts = [f.result() for f in self.parts]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        if not self.upload_id:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        except (BotoCoreError, ClientError):
+            logger.exception(f"Failed to abort the upload of {self.key}")
+
+    def _upload_part(self, data: bytes):
+        if not self.upload_id:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        self.in_flight.acquire()  # bounds the memory used by the buffered parts
+        part_number = len(self.parts) + 1
+        self.parts.append(self.executor.submit(self._put_part, part_number, data))
+
+    def _put_part(self, part_number: int, data: bytes) -> dict:
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            self.in_flight.release()
+
+
+# writes a tar of the files, compressed in this process or by an external compressor
+def _write_archive(
+    out: Any,
+    file_list: List[str],
+    arcnames: List[str],
+    compression: str,
+    level: int,
+):
+    if compression in EXTERNAL_COMPRESSORS:
+        _write_externally_compressed_archive(
+            out, file_list, arcnames, EXTERNAL_COMPRESSORS[compression] + [f"-{level}"]
+        )
+        return
+    compressed: Any = out
+    if compression == "gz":
+        compressed = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=level, mtime=0)
+    elif compression == "bz2":
+        compressed = bz2.BZ2File(out, "wb", compresslevel=level)
+    with tarfile.open(fileobj=compressed, mode="w|") as tar:
+        for item, arcname in zip(file_list, arcnames):
+            tar.add(item, arcname=arcname)
+    if compressed is not out:
+        compressed.close()  # writes the trailer, leaves out open
+
+
+def _write_externally_compressed_archive(
+    out: Any, file_list: List[str], arcnames: List[str], cmd: List[str]
+):
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors: List[Exception] = []
+
+    def copy_output():  # from the compressor to out, while the tar is written
+        try:
+            for chunk in iter(lambda: process.stdout.read(1024 * 1024), b""):  # type: ignore
+                out.write(chunk)
+        except Exception as e:
+            errors.append(e)
+            process.kill()
+
+    reader = threading.Thread(target=copy_output, daemon=True)
+    reader.start()
+    try:
+        with tarfile.open(fileobj=process.stdin, mode="w|") as tar:
+            for item, arcname in zip(file_list, arcnames):
+                tar.add(item, arcname=arcname)
+    except BrokenPipeError:
+        pass  # the compressor died, reported below
+    finally:
+        process.stdin.close()  # type: ignore
+        reader.join()
+    if errors:
+        raise errors[0]
+    if process.wait() != 0:
+        raise OSError(f"{cmd[0]} failed with exit code {process.returncode}")
+
+
+# the ETag S3 gives the file when uploaded with the transfer config: the MD5 of the
+# file, or for a multipart upload the MD5 of the MD5s of the parts + "-<parts>"
+def _local_etag(path: str, transfer_config: TransferConfig) -> str:
+    size = os.path.getsize(path)
+    if size < transfer_config.multipart_threshold:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+    part_md5s = b""
+    parts = 0
+    with open(path, "rb") as f:
+        for part in iter(lambda: f.read(transfer_config.multipart_chunksize), b""):
+            part_md5s += hashlib.md5(part).digest()
+            parts += 1
+    return f"{hashlib.md5(part_md5s).hexdigest()}-{parts}"
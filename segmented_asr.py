@@ -0,0 +1,296 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import wave
+from typing import Callable, Dict, List, Tuple
+
+from base_util import (
+    command_log,
+    current_command_log,
+    get_asset_info,
+    run_shell_command,
+)
+from config import (
+    asr_keep_files,
+    asr_segment_minutes,
+    asr_parallelism,
+    asr_silence_threshold_db,
+    asr_min_silence,
+    transcode_sample_rate,
+    transcode_channels,
+    transcode_timeout,
+)
+from transcript import CTM_FILE, TXT_FILE
+
+logger = logging.getLogger(__name__)
+SEGMENTS_DIR = "segments"  # subdir of the ASR output dir with the per segment output
+SPLIT_WINDOW = 0.25  # look for silences within 25% of the segment length of a split
+
+
+@dataclass
+class Segment:
+    index: int
+    start: float  # secs
+    end: float  # secs
+    audio_path: str
+    output_dir: str
+
+
+# splits the input at silences into segments of about ASR_SEGMENT_MINUTES, decodes
+# the segments in parallel (each decode is a separate Kaldi_NL process) and merges
+# the 1Best.ctm/1Best.txt of the segments into output_dir
+def run_segmented_asr(
+    input_path: str, output_dir: str, decode: Callable[[str, str], bool]
+) -> bool:
+    segment_length = asr_segment_minutes * 60
+    duration = get_duration(input_path)
+    if duration <= segment_length * (1 + SPLIT_WINDOW):
+        logger.info(f"Duration {duration}s too short for splitting, decoding as is")
+        return decode(input_path, output_dir)
+
+    asset_id, _ = get_asset_info(input_path)
+    split_points = choose_split_points(
+        duration, detect_silences(input_path), segment_length
+    )
+    segments_dir = os.path.join(output_dir, SEGMENTS_DIR)
+    os.makedirs(segments_dir, exist_ok=True)
+    segments = [
+        Segment(
+            i,
+            start,
+            end,
+            os.path.join(segments_dir, f"{asset_id}_seg{i:04d}.wav"),
+            os.path.join(segments_dir, f"{asset_id}_seg{i:04d}"),
+        )
+        for i, (start, end) in enumerate(zip(split_points[:-1], split_points[1:]))
+    ]
+    logger.info(
+        f"Decoding {len(segments)} segments of {input_path} "
+        f"with parallelism {asr_parallelism}"
+    )
+
+    log = current_command_log()  # so the decodes count for the stage (see metrics)
+
+    def decode_segment(segment: Segment) -> bool:
+        with command_log(log) if log else nullcontext():
+            return _decode_segment(input_path, segment, decode)
+
+    with ThreadPoolExecutor(max_workers=asr_parallelism) as executor:
+        results = list(executor.map(decode_segment, segments))
+    if not all(results):
+        logger.error(f"Failed to decode {results.count(False)} segment(s)")
+        return False
+    if not merge_segment_outputs(segments, output_dir, asset_id):
+        return False
+    # the decodes of the segments are kept (for resuming) until they are merged, and
+    # after that only if files of the decodes should be kept (see ASR_KEEP_FILES)
+    if not asr_keep_files:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+    return True
+
+
+def _decode_segment(
+    input_path: str, segment: Segment, decode: Callable[[str, str], bool]
+) -> bool:
+    if _has_asr_output(segment.output_dir):
+        logger.info(f"Segment {segment.index} was already decoded")
+        return True
+    if not cut_segment(input_path, segment):
+        return False
+    success = decode(segment.audio_path, segment.output_dir)
+    if success and _has_asr_output(segment.output_dir):
+        os.remove(segment.audio_path)
+        return True
+    logger.error(f"No Kaldi_NL output for segment {segment.index}")
+    return False
+
+
+def _has_asr_output(output_dir: str) -> bool:
+    return all(
+        [os.path.exists(os.path.join(output_dir, f)) for f in [CTM_FILE, TXT_FILE]]
+    )
+
+
+# returns the duration in secs (or -1 if it cannot be determined)
+def get_duration(input_path: str) -> float:
+    if input_path.endswith(".wav"):  # PCM wav: no need to start ffprobe
+        try:
+            with wave.open(input_path, "rb") as w:
+                return w.getnframes() / w.getframerate()
+        except (wave.Error, EOFError, OSError):
+            pass
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        input_path,
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        return float(result.stdout.strip())
+    except (subprocess.CalledProcessError, ValueError, OSError):
+        logger.exception(f"Could not determine the duration of {input_path}")
+        return -1
+
+
+# returns the (start, end) of all silences found by ffmpeg's silencedetect filter (the
+# end is inf for a silence lasting until the end), optionally after applying the
+# given audio filter (e.g. a band-pass)
+def detect_silences(
+    input_path: str,
+    threshold_db: float = asr_silence_threshold_db,
+    min_silence: float = asr_min_silence,
+    audio_filter: str = "",
+) -> List[Tuple[float, float]]:
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-i",
+        input_path,
+        "-vn",
+        "-af",
+        f"{audio_filter}{',' if audio_filter else ''}"
+        f"silencedetect=noise={threshold_db}dB:d={min_silence}",
+        "-f",
+        "null",
+        "-",
+    ]
+    try:
+        result = subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=transcode_timeout or None,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        logger.exception(f"Silence detection failed for {input_path}")
+        return []
+    starts = re.findall(r"silence_start: (-?[\d.]+)", result.stderr)
+    ends = [float(e) for e in re.findall(r"silence_end: ([\d.]+)", result.stderr)]
+    ends += [float("inf")] * (len(starts) - len(ends))
+    return [(float(s), e) for s, e in zip(starts, ends)]
+
+
+# returns the segment boundaries (including 0 and the duration), where each split is
+# placed in the middle of the silence closest to the targeted segment length
+def choose_split_points(
+    duration: float, silences: List[Tuple[float, float]], segment_length: float
+) -> List[float]:
+    midpoints = [(start + end) / 2 for start, end in silences]
+    window = segment_length * SPLIT_WINDOW
+    points = [0.0]
+    while duration - points[-1] > segment_length * (1 + SPLIT_WINDOW):
+        target = points[-1] + segment_length
+        candidates = [m for m in midpoints if abs(m - target) <= window]
+        points.append(min(candidates, key=lambda m: abs(m - target), default=target))
+    points.append(duration)
+    return points
+
+
+def cut_segment(input_path: str, segment: Segment) -> bool:
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-y",
+        "-ss",
+        f"{segment.start:.3f}",
+        "-t",
+        f"{segment.end - segment.start:.3f}",
+        "-i",
+        input_path,
+        "-vn",
+        "-ac",
+        str(transcode_channels),
+        "-ar",
+        str(transcode_sample_rate),
+        "-c:a",
+        "pcm_s16le",
+        segment.audio_path,
+    ]
+    if not run_shell_command(shlex.join(cmd), transcode_timeout).success:
+        logger.error(f"Failed to cut segment {segment.index} from {input_path}")
+        return False
+    return True
+
+
+# concatenates the 1Best.txt and 1Best.ctm of the segments, shifting all times by the
+# start of the segment, replacing the segment name with the asset ID and renumbering
+# the fragments so they stay unique
+def merge_segment_outputs(
+    segments: List[Segment], output_dir: str, asset_id: str
+) -> bool:
+    fragment_ids: Dict[Tuple[int, str], str] = {}
+
+    def rename(segment: Segment, utterance_id: str) -> str:
+        _, _, fragment_id = utterance_id.partition(".")
+        if not fragment_id:
+            return asset_id
+        key = (segment.index, fragment_id)
+        if key not in fragment_ids:
+            fragment_ids[key] = f"{len(fragment_ids) + 1:0{len(fragment_id)}d}"
+        return f"{asset_id}.{fragment_ids[key]}"
+
+    txt_path = os.path.join(output_dir, TXT_FILE)
+    ctm_path = os.path.join(output_dir, CTM_FILE)
+    try:
+        with (
+            open(f"{txt_path}.part", "w", encoding="utf-8") as txt_out,
+            open(f"{ctm_path}.part", "w", encoding="utf-8") as ctm_out,
+        ):
+            for segment in segments:
+                with open(
+                    os.path.join(segment.output_dir, TXT_FILE), encoding="utf-8"
+                ) as f:
+                    for line in f:
+                        txt_out.write(_shift_txt_line(line, segment, rename))
+                with open(
+                    os.path.join(segment.output_dir, CTM_FILE), encoding="utf-8"
+                ) as f:
+                    for line in f:
+                        ctm_out.write(_shift_ctm_line(line, segment, rename))
+        os.replace(f"{txt_path}.part", txt_path)
+        os.replace(f"{ctm_path}.part", ctm_path)
+    except (OSError, IndexError, ValueError):
+        logger.exception(f"Failed to merge the segment output into {output_dir}")
+        return False
+    logger.info(f"Merged the output of {len(segments)} segments into {output_dir}")
+    return True
+
+
+# e.g. "words words (carrier.0001 12.340)"
+def _shift_txt_line(
+    line: str, segment: Segment, rename: Callable[[Segment, str], str]
+) -> str:
+    words, info = line.rstrip("\n").split("(", 1)
+    fields = info.split(" ")
+    start = fields[1].rstrip(")")
+    fields[0] = rename(segment, fields[0])
+    fields[1] = _shift(start, segment.start) + fields[1][len(start) :]
+    return f"{words}({' '.join(fields)}\n"
+
+
+# e.g. "carrier.0001 1 12.34 0.33 word 1.00"
+def _shift_ctm_line(
+    line: str, segment: Segment, rename: Callable[[Segment, str], str]
+) -> str:
+    fields = line.rstrip("\n").split(" ")
+    fields[0] = rename(segment, fields[0])
+    fields[2] = _shift(fields[2], segment.start)
+    return f"{' '.join(fields)}\n"
+
+
+# adds the offset, keeping the number of decimals of the original value
+def _shift(value: str, offset: float) -> str:
+    decimals = len(value.split(".")[1]) if "." in value else 0
+    return f"{float(value) + offset:.{decimals}f}"
@@ -1,64 +1,335 @@
+import glob
 import logging
 import os
+from typing import List, Optional, Tuple
 
-from base_util import get_asset_info, asr_output_dir
-from config import s3_endpoint_url, s3_bucket, s3_folder_in_bucket
+from base_util import asset_key, get_asset_info, asr_output_dir
+from cache_manager import CacheLease, INPUT, INTERMEDIATE, OUTPUT
+from config import (
+    asr_dedupe,
+    s3_endpoint_url,
+    s3_bucket,
+    s3_folder_in_bucket,
+    s3_upload_mode,
+    s3_upload_transcript,
+    s3_upload_extra_files,
+    vad_enabled,
+)
+import dedupe
 from download import download_uri
+from download_cache import MISS
 from kaldi_nl import run_asr  # import whisper
-from s3_util import S3Store
+from leasing import hold
+from manifest import StageManifest, TRANSCODE, VAD, ASR, TRANSCRIPT
+from media_probe import MediaInfo, choose_route, probe
+from metrics import AssetMetrics, StageMetrics
+from s3_util import TransferResult, get_s3_store
+from segmented_asr import get_duration
 from transcode import try_transcode
-from transcript import TXT_FILE, CTM_FILE, JSON_FILE, generate_transcript
+from transcript import TXT_FILE, CTM_FILE, generate_transcript, transcript_files
+from vad import SpeechAudio, decode_speech, filter_speech, time_map_file
 
 logger = logging.getLogger(__name__)
 
 
 def run(input_uri: str, output_uri: str) -> bool:
+    metrics = AssetMetrics(input_uri)
+    # keeps the files of this run from being evicted from OUTPUT_BASE_DIR meanwhile
+    with CacheLease() as lease:
+        success = _run(input_uri, output_uri, lease, metrics)
+    metrics.finish(success)
+    return success
+
+
+def _run(
+    input_uri: str, output_uri: str, lease: CacheLease, metrics: AssetMetrics
+) -> bool:
     logger.info(f"Processing {input_uri} (save to --> {output_uri})")
     # 1. download input
-    result = download_uri(input_uri)
-    logger.info(result)
-    if not result:
+    input_path = download_input(input_uri, metrics)
+    if not input_path:
         logger.error("Could not obtain input, quitting...")
         return False
+    lease.add(input_path, INPUT)
 
-    input_path = result.file_path
-    asset_id, extension = get_asset_info(input_path)
-    output_path = asr_output_dir(input_path)
+    asset_id, output_path = get_output_info(input_path)
+    metrics.asset_id, metrics.output_dir = asset_id, output_path
+    lease.add(output_path, OUTPUT)
 
     # 2. Check if the input file is suitable for processing any further
-    transcoded_file_path = try_transcode(input_path, asset_id, extension)
+    transcoded_file_path = transcode_input(input_path, output_path, metrics)
     if not transcoded_file_path:
         logger.error("The transcode failed to yield a valid file to continue with")
         return False
     else:
         input_path = transcoded_file_path
+        lease.add(input_path, INTERMEDIATE)
 
-    # 3. run ASR
-    if not asr_already_done(output_path):
-        logger.info("No Kaldi_NL output found")
-        run_asr(input_path, output_path)
-    else:
-        logger.info(f"Kaldi_NL output already present in {output_path}")
-
-    # 4. generate JSON transcript
-    if not transcript_already_done(output_path):
-        logger.info("No transcript.json found")
-        success = generate_transcript(output_path)
-        if not success:
-            logger.warning("Could not generate transcript.json")
-    else:
-        logger.info(f"transcript.json already present in {output_path}")
+    # 3. reuse the ASR output of identical audio (optional)
+    if asr_dedupe and not asr_already_done(output_path, input_path):
+        deduplicate_asr_if_possible(input_path, output_path, metrics)
 
-    # 5. transfer output
-    if output_uri:
-        transfer_asr_output(output_path, asset_id)
-    else:
+    # 4. skip the non-speech (optional)
+    speech = None
+    if vad_enabled and not asr_already_done(output_path, input_path):
+        speech = filter_speech_if_needed(input_path, output_path, metrics)
+
+    # 5. run ASR
+    asr_success = run_asr_if_needed(input_path, output_path, metrics, speech)
+    lease.add(output_path, OUTPUT)
+    if not asr_success:
+        logger.error("No ASR output to continue with")
+        return False
+
+    # 6. generate JSON transcript
+    if not generate_transcript_if_needed(output_path, metrics):
+        logger.error("Failed to generate the transcript")
+        return False
+
+    # 7. transfer output
+    if not output_uri:
         logger.info("No output_uri specified, so all is done")
+        return True
+    if not transfer_asr_output(output_path, asset_id, metrics).success:
+        logger.error("Failed to transfer the ASR output")
+        return False
     return True
 
 
+# returns the local path of the downloaded input (or None if the download failed)
+def download_input(input_uri: str, metrics: AssetMetrics) -> Optional[str]:
+    with metrics.stage("download") as stage, hold(f"download:{input_uri}") as leased:
+        if not leased:  # another worker is on it
+            stage.success = False
+            return None
+        result = download_uri(input_uri)
+        logger.info(result)
+        if not result:
+            stage.success = False
+            return None
+        stage.skipped = result.cache_status != MISS
+        stage.bytes_in = 0 if stage.skipped else result.content_length
+        stage.bytes_out = result.content_length
+        return result.file_path
+
+
+# returns the path to the file that can be fed to the ASR (or None if not possible).
+# info: the probe of the input, if the caller already has it
+def transcode_input(
+    input_path: str,
+    output_path: str,
+    metrics: AssetMetrics,
+    info: Optional[MediaInfo] = None,
+) -> Optional[str]:
+    with (
+        metrics.stage("transcode") as stage,
+        hold(_lease_key("transcode", output_path)) as leased,
+    ):
+        if not leased:  # another worker is on it
+            stage.success = False
+            return None
+        asset_id, extension = get_asset_info(input_path)
+        stage.bytes_in = _file_size(input_path)
+        manifest = StageManifest(output_path)
+        if manifest.is_done(TRANSCODE, [input_path]):
+            logger.info("Transcoded file is still valid, no new transcode needed")
+            stage.skipped = True
+            valid_file_path = manifest.outputs(TRANSCODE)[0]
+            stage.bytes_out = _file_size(valid_file_path)
+            return valid_file_path
+
+        # unusable inputs are rejected here, before any of the heavy stages
+        info = info or probe(input_path, output_path)
+        route, reason = choose_route(info) if info else (None, "it cannot be read")
+        if route is None:
+            logger.error(f"Cannot use {input_path}: {reason}")
+            stage.success = False
+            return None
+
+        # transcodes made before there was a manifest are reused as they are
+        legacy = manifest.legacy
+        if not legacy:
+            manifest.start(TRANSCODE)
+        transcoded_file_path = try_transcode(
+            input_path, asset_id, extension, reuse=legacy, info=info
+        )
+        manifest.finish(
+            TRANSCODE,
+            [input_path],
+            [transcoded_file_path] if transcoded_file_path else [],
+            success=transcoded_file_path is not None,
+            adopted=legacy,
+        )
+        if not transcoded_file_path:
+            stage.success = False
+            return None
+        stage.skipped = transcoded_file_path == input_path
+        stage.bytes_out = _file_size(transcoded_file_path)
+        return transcoded_file_path
+
+
+# returns the speech only audio to decode instead of the input (None: use the input)
+def filter_speech_if_needed(
+    input_path: str, output_path: str, metrics: AssetMetrics
+) -> Optional[SpeechAudio]:
+    with metrics.stage("vad") as stage, hold(_lease_key("vad", output_path)) as leased:
+        if not leased:  # another worker is on it
+            stage.success = False
+            return None
+        stage.bytes_in = _file_size(input_path)
+        manifest = StageManifest(output_path)
+        reuse = manifest.is_done(VAD, [input_path])
+        if not reuse:
+            manifest.start(VAD)
+        speech = filter_speech(input_path, output_path, reuse)
+        if not reuse:
+            # also when there is nothing to skip, see filter_speech
+            time_map = time_map_file(output_path)
+            manifest.finish(
+                VAD, [input_path], [time_map] if os.path.exists(time_map) else []
+            )
+        if not speech:
+            stage.skipped = True
+            return None
+        stage.audio_duration = speech.duration
+        stage.skipped_audio = speech.skipped_duration
+        stage.speech_ratio = speech.speech_ratio
+        stage.bytes_out = _file_size(speech.audio_path)
+        return speech
+
+
+# copies the ASR output of identical audio that was decoded before (see dedupe.py),
+# returns False if there is none
+def deduplicate_asr_if_possible(
+    input_path: str, output_path: str, metrics: AssetMetrics
+) -> bool:
+    with (
+        metrics.stage("dedupe") as stage,
+        hold(_lease_key("asr", output_path)) as leased,
+    ):
+        if not leased:  # another worker is on it
+            stage.success = False
+            return False
+        stage.bytes_in = _file_size(input_path)
+        audio_fingerprint = dedupe.fingerprint(input_path)
+        entry = dedupe.lookup(audio_fingerprint) if audio_fingerprint else None
+        if not entry or entry.output_dir == output_path:
+            logger.info("No ASR output of identical audio found")
+            stage.skipped = True
+            return False
+        manifest = StageManifest(output_path)
+        manifest.start(ASR)
+        stage.success = dedupe.materialise(
+            entry, output_path, get_asset_info(input_path)[0]
+        )
+        manifest.finish(
+            ASR, [input_path], _asr_output_files(output_path), stage.success
+        )
+        if stage.success:
+            logger.info(
+                f"Reused the ASR output of {entry.asset_id} (identical audio), "
+                f"saving {entry.asr_wall_time:.0f}s of decoding "
+                f"({entry.asr_cpu_time / 3600:.2f} CPU-hours)"
+            )
+        stage.bytes_out = sum([_file_size(f) for f in _asr_output_files(output_path)])
+        return stage.success
+
+
+# decodes the speech only audio instead of the input, if there is one
+def run_asr_if_needed(
+    input_path: str,
+    output_path: str,
+    metrics: AssetMetrics,
+    speech: Optional[SpeechAudio] = None,
+) -> bool:
+    with metrics.stage("asr") as stage, hold(_lease_key("asr", output_path)) as leased:
+        if not leased:  # another worker is on it
+            stage.success = False
+            return False
+        stage.bytes_in = _file_size(speech.audio_path if speech else input_path)
+        stage.audio_duration = get_duration(input_path)
+        if not asr_already_done(output_path, input_path):
+            logger.info("No (valid) Kaldi_NL output found")
+            manifest = StageManifest(output_path)
+            manifest.start(ASR)
+            if speech:
+                stage.success = decode_speech(speech, output_path, run_asr)
+            else:
+                stage.success = run_asr(input_path, output_path)
+            manifest.finish(
+                ASR, [input_path], _asr_output_files(output_path), stage.success
+            )
+        else:
+            logger.info(f"Kaldi_NL output already present in {output_path}")
+            stage.skipped = True
+        stage.bytes_out = sum(
+            [_file_size(os.path.join(output_path, f)) for f in [CTM_FILE, TXT_FILE]]
+        )
+    # the stage metrics are complete after the with block
+    if asr_dedupe and stage.success and not stage.skipped:
+        _register_asr_output(input_path, output_path, stage)
+    return stage.success
+
+
+def generate_transcript_if_needed(output_path: str, metrics: AssetMetrics) -> bool:
+    with (
+        metrics.stage("transcript") as stage,
+        hold(_lease_key("transcript", output_path)) as leased,
+    ):
+        if not leased:  # another worker is on it
+            stage.success = False
+            return False
+        stage.bytes_in = sum(
+            [_file_size(os.path.join(output_path, f)) for f in [CTM_FILE, TXT_FILE]]
+        )
+        if not transcript_already_done(output_path):
+            logger.info("No (valid) transcript.json found")
+            manifest = StageManifest(output_path)
+            manifest.start(TRANSCRIPT)
+            stage.success = generate_transcript(output_path)
+            manifest.finish(
+                TRANSCRIPT,
+                _asr_output_files(output_path),
+                transcript_files(output_path),
+                stage.success,
+            )
+            if not stage.success:
+                logger.error("Could not generate transcript.json")
+        else:
+            logger.info(f"transcript.json already present in {output_path}")
+            stage.skipped = True
+        stage.bytes_out = sum([_file_size(f) for f in transcript_files(output_path)])
+        return stage.success
+
+
+# returns the asset key (the asset ID, unless its file name is shared by another
+# URI) and ASR output dir for a (downloaded) input file
+def get_output_info(input_path: str) -> Tuple[str, str]:
+    return asset_key(input_path), asr_output_dir(input_path)
+
+
 # if (S3) output_uri is supplied transfers data to S3 location
-def transfer_asr_output(output_path: str, asset_id: str) -> bool:
+def transfer_asr_output(
+    output_path: str, asset_id: str, metrics: AssetMetrics
+) -> TransferResult:
+    with (
+        metrics.stage("upload") as stage,
+        hold(_lease_key("upload", output_path)) as leased,
+    ):
+        if not leased:  # another worker is on it
+            stage.success = False
+            return TransferResult(False)
+        file_list = _upload_files(output_path)
+        result = _transfer_asr_output(output_path, asset_id, file_list)
+        stage.success = result.success
+        stage.bytes_in = sum([_file_size(f) for f in file_list])
+        stage.bytes_out = result.bytes_transferred
+        return result
+
+
+def _transfer_asr_output(
+    output_path: str, asset_id: str, file_list: List[str]
+) -> TransferResult:
     logger.info(f"Transferring {output_path} to S3 (asset={asset_id})")
     if any(
         [
@@ -73,31 +344,72 @@ def transfer_asr_output(output_path: str, asset_id: str) -> bool:
         logger.warning(
             "TRANSFER_ON_COMPLETION configured without all the necessary S3 settings"
         )
-        return False
+        return TransferResult(False)
 
-    s3 = S3Store(s3_endpoint_url)
-    return s3.transfer_to_s3(
-        s3_bucket,
-        os.path.join(
-            s3_folder_in_bucket, asset_id
-        ),  # assets/<program ID>__<carrier ID>
-        [
-            os.path.join(output_path, CTM_FILE),
-            os.path.join(output_path, TXT_FILE),
-        ],
-    )
+    s3 = get_s3_store(s3_endpoint_url)
+    # assets/<program ID>__<carrier ID>
+    path = os.path.join(s3_folder_in_bucket, asset_id)
+    if s3_upload_mode == "archive":
+        return s3.stream_archive_to_s3(
+            s3_bucket, path, os.path.basename(asset_id), file_list, base_dir=output_path
+        )
+    return s3.transfer_to_s3(s3_bucket, path, file_list, base_dir=output_path)
 
 
-# check if there is both a 1Best.txt and 1Best.ctm
-def asr_already_done(output_dir):
-    return all(
-        [
-            os.path.exists(os.path.join(output_dir, output_file))
-            for output_file in [TXT_FILE, CTM_FILE]
-        ]
+# the ASR output, optionally with the transcript and S3_UPLOAD_EXTRA_FILES
+def _upload_files(output_path: str) -> List[str]:
+    extra_files = transcript_files(output_path) if s3_upload_transcript else []
+    for pattern in s3_upload_extra_files:
+        extra_files += sorted(
+            glob.glob(os.path.join(output_path, pattern), recursive=True)
+        )
+    file_list = _asr_output_files(output_path)
+    return file_list + [
+        f
+        for f in dict.fromkeys(extra_files)
+        if os.path.isfile(f) and f not in file_list
+    ]
+
+
+# check if the 1Best.txt and 1Best.ctm in the output dir are (still) the complete
+# ASR output of the input (see manifest.py)
+def asr_already_done(output_dir, input_path):
+    return StageManifest(output_dir).is_done(
+        ASR, [input_path], _asr_output_files(output_dir)
     )
 
 
-# check if there is a transcript.json
+# check if the transcript.json (or transcript.ndjson) was generated from the current
+# ASR output
 def transcript_already_done(output_dir):
-    return os.path.exists(os.path.join(output_dir, JSON_FILE))
+    return StageManifest(output_dir).is_done(
+        TRANSCRIPT, _asr_output_files(output_dir), transcript_files(output_dir)
+    )
+
+
+# makes the ASR output available for identical audio (see dedupe.py)
+def _register_asr_output(input_path: str, output_path: str, stage: StageMetrics):
+    audio_fingerprint = dedupe.fingerprint(input_path)
+    if audio_fingerprint:
+        dedupe.store(
+            dedupe.new_entry(
+                audio_fingerprint,
+                input_path,
+                output_path,
+                stage.wall_time,
+                stage.cpu_time,
+            )
+        )
+
+
+def _asr_output_files(output_dir: str) -> List[str]:
+    return [os.path.join(output_dir, f) for f in [TXT_FILE, CTM_FILE]]
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+# leases are per stage and asset, so the stages of different assets never wait
+def _lease_key(stage: str, output_path: str) -> str:
+    return f"{stage}:{os.path.basename(output_path)}"
@@ -0,0 +1,53 @@
+import json
+import ntpath
+import os
+import sys
+import time
+import wave
+
+# Fake decoder speaking the protocol of the persistent ASR backend (see
+# asr_backend.py), so the decoder pool can be used without Kaldi_NL (ASR_BACKEND=stub).
+# Writes a single fragment with a word per second of audio.
+LOAD_TIME = float(os.environ.get("STUB_DECODER_LOAD_TIME", "1"))  # secs
+DECODE_TIME = float(os.environ.get("STUB_DECODER_DECODE_TIME", "0"))  # secs per job
+WORD = "stub"
+
+
+def main():
+    time.sleep(LOAD_TIME)  # i.e. loading the models
+    _send({"status": "ready"})
+    for line in sys.stdin:
+        try:
+            job = json.loads(line)
+            time.sleep(DECODE_TIME)
+            _decode(job["input"], job["output"])
+            _send({"status": "ok"})
+        except Exception as e:
+            _send({"status": "error", "message": repr(e)})
+
+
+def _decode(input_path: str, output_dir: str):
+    asset_id = os.path.splitext(ntpath.basename(input_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    num_words = max(1, int(_duration(input_path)))
+    with open(os.path.join(output_dir, "1Best.txt"), "w", encoding="utf-8") as f:
+        f.write(f"{' '.join([WORD] * num_words)} ({asset_id}.0001 0.000)\n")
+    with open(os.path.join(output_dir, "1Best.ctm"), "w", encoding="utf-8") as f:
+        for i in range(num_words):
+            f.write(f"{asset_id}.0001 1 {i:.2f} 0.50 {WORD} 1.00\n")
+
+
+def _duration(input_path: str) -> float:
+    try:
+        with wave.open(input_path, "rb") as w:
+            return w.getnframes() / w.getframerate()
+    except (wave.Error, EOFError):
+        return 1  # e.g. mp3
+
+
+def _send(message: dict):
+    print(json.dumps(message), flush=True)
+
+
+if __name__ == "__main__":
+    main()
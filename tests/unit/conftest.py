@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# config.py asserts on the environment when it is imported (by most modules), so
+# this has to be set before the tests import anything
+os.environ.setdefault("OUTPUT_BASE_DIR", tempfile.mkdtemp(prefix="asr-tests-"))
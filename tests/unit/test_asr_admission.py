@@ -0,0 +1,74 @@
+import json
+import os
+import socket
+import time
+
+import pytest
+
+import asr_admission
+from asr_admission import RESERVATIONS_FILE, admit
+
+
+@pytest.fixture
+def admission_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(asr_admission, "asr_admission_control", True)
+    monkeypatch.setattr(asr_admission, "asr_admission_dir", str(tmp_path))
+    monkeypatch.setattr(asr_admission, "asr_admission_poll_interval", 0.05)
+    monkeypatch.setattr(asr_admission, "asr_memory_limit_mb", 1024)
+    monkeypatch.setattr(asr_admission, "asr_memory_base_mb", 600)
+    monkeypatch.setattr(asr_admission, "asr_memory_per_minute_mb", 0)
+    monkeypatch.setattr(asr_admission, "asr_cpus_per_job", 1)
+    monkeypatch.setattr(asr_admission, "_available_memory", lambda: 1 << 40)
+    monkeypatch.setattr(asr_admission, "lease_ttl", 60)
+    return str(tmp_path)
+
+
+def _reservations(admission_dir: str) -> dict:
+    path = os.path.join(admission_dir, RESERVATIONS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _reserve_from_other_host(admission_dir: str, expires_at: float):
+    reservation = {"memory": 600 * asr_admission.MB, "cpus": [], "since": 0}
+    with open(os.path.join(admission_dir, RESERVATIONS_FILE), "w") as f:
+        json.dump({"other-host:1:abcd": {**reservation, "expires_at": expires_at}}, f)
+
+
+def test_reservation_is_released(admission_dir):
+    with admit(60) as slot:
+        assert slot.key.startswith(f"{socket.gethostname()}:{os.getpid()}:")
+        assert list(_reservations(admission_dir)) == [slot.key]
+    assert _reservations(admission_dir) == {}
+
+
+def test_expired_reservation_of_other_host_is_removed(admission_dir):
+    _reserve_from_other_host(admission_dir, time.time() - 1)
+
+    with admit(60) as slot:
+        assert list(_reservations(admission_dir)) == [slot.key]
+
+
+def test_live_reservation_of_other_host_is_counted(admission_dir):
+    _reserve_from_other_host(admission_dir, time.time() + 60)
+
+    assert asr_admission._try_reserve(600 * asr_admission.MB, 1) is None
+
+
+def test_reservation_without_expiry_is_removed(admission_dir):
+    with open(os.path.join(admission_dir, RESERVATIONS_FILE), "w") as f:
+        json.dump({"123-1": {"pid": 123, "memory": 1, "cpus": [], "since": 0}}, f)
+
+    assert asr_admission._try_reserve(600 * asr_admission.MB, 1) is not None
+    assert "123-1" not in _reservations(admission_dir)
+
+
+def test_reservation_is_renewed(admission_dir, monkeypatch):
+    monkeypatch.setattr(asr_admission, "lease_ttl", 0.3)
+
+    with admit(60) as slot:
+        first = _reservations(admission_dir)[slot.key]["expires_at"]
+        time.sleep(0.35)
+        assert _reservations(admission_dir)[slot.key]["expires_at"] > first
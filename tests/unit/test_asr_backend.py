@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import wave
+
+import pytest
+
+from asr_backend import PersistentBackend
+from kaldi_nl import STUB_DECODER
+from transcript import CTM_FILE, TXT_FILE
+
+STUB_DECODER_CMD = f'"{sys.executable}" "{STUB_DECODER}"'
+
+
+@pytest.fixture
+def audio_file(tmp_path) -> str:
+    path = str(tmp_path / "test_asset.wav")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b"\0" * 16000 * 2 * 3)  # 3 secs of silence
+    return path
+
+
+@pytest.fixture
+def backend_factory(monkeypatch):
+    monkeypatch.setenv("STUB_DECODER_LOAD_TIME", "0")
+    backends = []
+
+    def create(**kwargs) -> PersistentBackend:
+        backend = PersistentBackend(STUB_DECODER_CMD, startup_timeout=30, **kwargs)
+        backends.append(backend)
+        return backend
+
+    yield create
+    for backend in backends:
+        backend.close()
+
+
+def _decoded(output_dir: str) -> bool:
+    return all(
+        [os.path.exists(os.path.join(output_dir, f)) for f in [CTM_FILE, TXT_FILE]]
+    )
+
+
+def _decoder_pids(backend: PersistentBackend):
+    return [decoder.pid for decoder in backend._started]
+
+
+def test_decodes_with_stub_decoder(backend_factory, audio_file, tmp_path):
+    backend = backend_factory()
+    output_dir = str(tmp_path / "output")
+    assert backend.decode(audio_file, output_dir)
+    assert _decoded(output_dir)
+    with open(os.path.join(output_dir, TXT_FILE), "r", encoding="utf-8") as f:
+        assert f.read() == "stub stub stub (test_asset.0001 0.000)\n"
+
+
+def test_reuses_decoder_process(backend_factory, audio_file, tmp_path):
+    backend = backend_factory()
+    assert backend.decode(audio_file, str(tmp_path / "output1"))
+    pids = _decoder_pids(backend)
+    assert backend.decode(audio_file, str(tmp_path / "output2"))
+    assert _decoder_pids(backend) == pids
+    assert backend._started[0].jobs == 2
+
+
+def test_concurrent_jobs(backend_factory, audio_file, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_DECODER_DECODE_TIME", "0.2")
+    backend = backend_factory(pool_size=2)
+    output_dirs = [str(tmp_path / f"output{i}") for i in range(6)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(lambda d: backend.decode(audio_file, d), output_dirs)
+        )
+    assert all(results)
+    assert all([_decoded(d) for d in output_dirs])
+    # never more processes than the pool size, each doing a share of the jobs
+    assert len(backend._started) == 2
+    assert sum([decoder.jobs for decoder in backend._started]) == 6
+
+
+def test_recycles_after_max_jobs(backend_factory, audio_file, tmp_path):
+    backend = backend_factory(max_jobs=2)
+    assert backend.decode(audio_file, str(tmp_path / "output1"))
+    first_pids = _decoder_pids(backend)
+    assert backend.decode(audio_file, str(tmp_path / "output2"))
+    assert _decoder_pids(backend) == []  # stopped after its 2nd job
+    assert backend.decode(audio_file, str(tmp_path / "output3"))
+    assert _decoder_pids(backend) != first_pids
+    assert backend._started[0].jobs == 1
+
+
+def test_recycles_after_failed_job(backend_factory, audio_file, tmp_path):
+    backend = backend_factory()
+    assert backend.decode(audio_file, str(tmp_path / "output1"))
+    first_pids = _decoder_pids(backend)
+    # the stub decoder reports an error for an input it cannot read
+    missing_file = str(tmp_path / "missing.wav")
+    assert not backend.decode(missing_file, str(tmp_path / "output2"))
+    assert _decoder_pids(backend) == []
+    assert backend.decode(audio_file, str(tmp_path / "output3"))
+    assert _decoder_pids(backend) != first_pids
+
+
+def test_recycles_after_timeout(backend_factory, audio_file, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_DECODER_DECODE_TIME", "5")
+    backend = backend_factory(decode_timeout=0.5)
+    assert not backend.decode(audio_file, str(tmp_path / "output1"))
+    assert _decoder_pids(backend) == []  # the hanging decoder was stopped
+
+    monkeypatch.setenv("STUB_DECODER_DECODE_TIME", "0")
+    assert backend.decode(audio_file, str(tmp_path / "output2"))
+    assert _decoded(str(tmp_path / "output2"))
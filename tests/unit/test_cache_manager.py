@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+import pytest
+
+import cache_manager
+from cache_manager import INDEX_FILE, INPUT, OUTPUT, CacheLease
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def base_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(cache_manager, "output_base_dir", str(tmp_path))
+    monkeypatch.setattr(cache_manager, "quota_bytes", 3 * MB)
+    monkeypatch.setattr(cache_manager, "lease_ttl", 60)
+    return str(tmp_path)
+
+
+def _artifact(base_dir: str, name: str, size_mb: int = 1) -> str:
+    path = os.path.join(base_dir, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size_mb * MB)
+    return path
+
+
+def _index(base_dir: str) -> dict:
+    with open(os.path.join(base_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _pin_from_other_host(base_dir: str, path: str, expires_at: float):
+    index = _index(base_dir)
+    index[path]["pins"] = [{"owner": "other-host:1:abcd", "expires_at": expires_at}]
+    with open(os.path.join(base_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(index, f)
+
+
+def test_evicts_least_recently_used_unpinned(base_dir):
+    paths = [_artifact(base_dir, f"input{i}.mp4") for i in range(3)]
+    with CacheLease() as lease:
+        for path in paths:
+            lease.add(path, INPUT)
+            time.sleep(0.01)
+    with CacheLease() as lease:
+        lease.add(_artifact(base_dir, "input3.mp4"), INPUT)
+        assert not os.path.exists(paths[0])  # the least recently used
+        assert all([os.path.exists(p) for p in paths[1:]])
+
+
+def test_pinned_artifacts_are_not_evicted(base_dir):
+    with CacheLease() as lease:
+        pinned = _artifact(base_dir, "pinned.mp4", 2)
+        lease.add(pinned, INPUT)
+        with CacheLease() as other_lease:
+            other_lease.add(_artifact(base_dir, "other.mp4", 2), INPUT)
+        assert os.path.exists(pinned)
+        assert [p["owner"] for p in _index(base_dir)[pinned]["pins"]] == [lease.owner]
+    assert _index(base_dir)[pinned]["pins"] == []
+
+
+def test_pins_of_other_hosts_are_kept_until_they_expire(base_dir):
+    with CacheLease() as lease:
+        remote = _artifact(base_dir, "remote.mp4", 2)
+        lease.add(remote, INPUT)
+    _pin_from_other_host(base_dir, remote, time.time() + 60)
+    with CacheLease() as lease:
+        lease.add(_artifact(base_dir, "local.mp4", 2), INPUT)
+    assert os.path.exists(remote)  # in use on the other host
+
+    _pin_from_other_host(base_dir, remote, time.time() - 1)
+    with CacheLease() as lease:
+        lease.add(_artifact(base_dir, "local2.mp4", 2), INPUT)
+    assert not os.path.exists(remote)  # the other worker died
+
+
+def test_outputs_are_evicted_last(base_dir):
+    output_dir = os.path.join(base_dir, "output", "asset1")
+    os.makedirs(output_dir)
+    _artifact(output_dir, "1Best.ctm", 2)
+    with CacheLease() as lease:
+        lease.add(output_dir, OUTPUT)
+    time.sleep(0.01)
+    with CacheLease() as lease:
+        lease.add(_artifact(base_dir, "input.mp4", 1), INPUT)
+    with CacheLease() as lease:
+        lease.add(_artifact(base_dir, "input2.mp4", 1), INPUT)
+    assert os.path.exists(output_dir)
+    assert not os.path.exists(os.path.join(base_dir, "input.mp4"))
+
+
+def test_pins_are_renewed(base_dir, monkeypatch):
+    monkeypatch.setattr(cache_manager, "lease_ttl", 0.3)
+    with CacheLease() as lease:
+        path = _artifact(base_dir, "input.mp4")
+        lease.add(path, INPUT)
+        first_expiry = _index(base_dir)[path]["pins"][0]["expires_at"]
+        time.sleep(0.5)
+        assert _index(base_dir)[path]["pins"][0]["expires_at"] > first_expiry
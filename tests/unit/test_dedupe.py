@@ -0,0 +1,90 @@
+import os
+import wave
+
+import pytest
+
+import dedupe
+from transcript import CTM_FILE, TXT_FILE
+
+TXT = "goedemorgen nederland (first.0001 1.200)\n"
+CTM = (
+    "first.0001 1 1.20 0.50 goedemorgen 1.00\n"
+    "first.0001 1 1.70 0.60 nederland 0.98\n"
+)
+
+
+@pytest.fixture
+def base_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(dedupe, "output_base_dir", str(tmp_path))
+    monkeypatch.setattr(dedupe, "transcode_sample_rate", 16000)
+    monkeypatch.setattr(dedupe, "transcode_channels", 1)
+    return str(tmp_path)
+
+
+def _wav(path: str, frames: bytes, rate: int = 16000) -> str:
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(frames)
+    return path
+
+
+def _asr_output(output_dir: str) -> str:
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, TXT_FILE), "w", encoding="utf-8") as f:
+        f.write(TXT)
+    with open(os.path.join(output_dir, CTM_FILE), "w", encoding="utf-8") as f:
+        f.write(CTM)
+    return output_dir
+
+
+def test_same_audio_has_same_fingerprint(base_dir):
+    first = _wav(os.path.join(base_dir, "first.wav"), b"\x01\x02" * 1000)
+    second = _wav(os.path.join(base_dir, "second.wav"), b"\x01\x02" * 1000)
+    other = _wav(os.path.join(base_dir, "other.wav"), b"\x02\x01" * 1000)
+
+    assert dedupe.fingerprint(first) == dedupe.fingerprint(second)
+    assert dedupe.fingerprint(first) != dedupe.fingerprint(other)
+
+
+def test_changed_file_is_fingerprinted_again(base_dir):
+    path = _wav(os.path.join(base_dir, "first.wav"), b"\x01\x02" * 1000)
+    before = dedupe.fingerprint(path)
+    _wav(path, b"\x01\x02" * 1001)
+
+    assert dedupe.fingerprint(path) != before
+
+
+def test_output_of_identical_audio_is_reused(base_dir):
+    audio = _wav(os.path.join(base_dir, "first.wav"), b"\x01\x02" * 1000)
+    output_dir = _asr_output(os.path.join(base_dir, "output", "first"))
+    fingerprint = dedupe.fingerprint(audio)
+    assert fingerprint
+    dedupe.store(dedupe.new_entry(fingerprint, audio, output_dir, 10, 20))
+
+    entry = dedupe.lookup(fingerprint)
+    assert entry and entry.asset_id == "first"
+    copy_dir = os.path.join(base_dir, "output", "second")
+    assert dedupe.materialise(entry, copy_dir, "second")
+
+    with open(os.path.join(copy_dir, TXT_FILE), encoding="utf-8") as f:
+        assert f.read() == TXT.replace("(first.", "(second.")
+    with open(os.path.join(copy_dir, CTM_FILE), encoding="utf-8") as f:
+        assert f.read() == CTM.replace("first.", "second.")
+
+
+def test_entry_of_removed_output_is_forgotten(base_dir):
+    audio = _wav(os.path.join(base_dir, "first.wav"), b"\x01\x02" * 1000)
+    output_dir = _asr_output(os.path.join(base_dir, "output", "first"))
+    fingerprint = dedupe.fingerprint(audio)
+    assert fingerprint
+    dedupe.store(dedupe.new_entry(fingerprint, audio, output_dir, 10, 20))
+    os.remove(os.path.join(output_dir, CTM_FILE))
+
+    assert dedupe.lookup(fingerprint) is None
+    assert dedupe.lookup(fingerprint) is None  # also removed from the index
+
+
+def test_missing_file_has_no_fingerprint(base_dir):
+    assert dedupe.fingerprint(os.path.join(base_dir, "missing.wav")) is None
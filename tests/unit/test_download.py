@@ -0,0 +1,165 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+from typing import List, Optional
+
+import pytest
+
+import base_util
+from base_util import get_asset_info
+import download
+import download_cache
+
+CONTENT = bytes(range(256)) * 64  # 16 KiB
+
+
+class _Server:
+    content = CONTENT
+    etag = '"v1"'
+    cut_after: Optional[int] = None  # drop the connection after this many bytes (once)
+    requests: List[dict] = []
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        headers = dict(self.headers.items())
+        _Server.requests.append(headers)
+        if headers.get("If-None-Match") == _Server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        byte_range = headers.get("Range", "")
+        if byte_range and headers.get("If-Range", _Server.etag) == _Server.etag:
+            start = int(byte_range[len("bytes=") :].rstrip("-"))
+        if start >= len(_Server.content) and start:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(_Server.content)}")
+            self.end_headers()
+            return
+        body = _Server.content[start:]
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", _Server.etag)
+        self.end_headers()
+        if _Server.cut_after is not None:
+            body, _Server.cut_after = body[: _Server.cut_after], None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def url(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_cache, "output_base_dir", str(tmp_path))
+    monkeypatch.setattr(download, "http_retries", 2)
+    monkeypatch.setattr(download, "http_chunk_size", 256)
+    _Server.content, _Server.etag, _Server.cut_after = CONTENT, '"v1"', None
+    _Server.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/asset.wav"
+    server.shutdown()
+    server.server_close()
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_interrupted_download_is_resumed_with_if_range(url):
+    _Server.cut_after = 1024
+
+    result = download.http_download(url)
+
+    assert result and _read(result.file_path) == CONTENT
+    assert _Server.requests[-1]["Range"] == "bytes=1024-"
+    assert _Server.requests[-1]["If-Range"] == '"v1"'
+    assert not os.path.exists(f"{result.file_path}.part.validator")
+
+
+def test_changed_file_is_downloaded_from_the_start(url, tmp_path):
+    part_file = os.path.join(tmp_path, "asset.wav.part")
+    with open(part_file, "wb") as f:
+        f.write(b"x" * 1000)  # from an older version of the file
+    with open(f"{part_file}.validator", "w", encoding="utf-8") as f:
+        f.write('"v0"')
+
+    result = download.http_download(url)
+
+    assert result and _read(result.file_path) == CONTENT
+
+
+def test_part_file_without_validator_is_not_resumed(url, tmp_path):
+    with open(os.path.join(tmp_path, "asset.wav.part"), "wb") as f:
+        f.write(b"x" * 1000)
+
+    result = download.http_download(url)
+
+    assert result and _read(result.file_path) == CONTENT
+    assert "Range" not in _Server.requests[-1]
+
+
+def test_mismatching_416_starts_over(url, tmp_path):
+    part_file = os.path.join(tmp_path, "asset.wav.part")
+    with open(part_file, "wb") as f:
+        f.write(b"x" * (len(CONTENT) + 10))  # larger than the file
+    with open(f"{part_file}.validator", "w", encoding="utf-8") as f:
+        f.write('"v1"')
+
+    result = download.http_download(url)
+
+    assert result and _read(result.file_path) == CONTENT
+    assert len(_Server.requests) == 2
+
+
+def test_complete_part_file_is_accepted_on_416(url, tmp_path):
+    part_file = os.path.join(tmp_path, "asset.wav.part")
+    with open(part_file, "wb") as f:
+        f.write(CONTENT)
+    with open(f"{part_file}.validator", "w", encoding="utf-8") as f:
+        f.write('"v1"')
+
+    result = download.http_download(url)
+
+    assert result and _read(result.file_path) == CONTENT
+    assert len(_Server.requests) == 1
+
+
+def test_conditional_get_revalidates_the_cached_file(url):
+    first = download.http_download(url)
+    second = download.http_download(url)
+
+    assert first and first.cache_status == download_cache.MISS
+    assert second and second.cache_status == download_cache.REVALIDATED
+    assert _Server.requests[-1]["If-None-Match"] == '"v1"'
+
+
+def test_changed_file_is_downloaded_again(url):
+    download.http_download(url)
+    _Server.content, _Server.etag = CONTENT[::-1], '"v2"'
+
+    result = download.http_download(url)
+
+    assert result and result.cache_status == download_cache.MISS
+    assert _read(result.file_path) == CONTENT[::-1]
+
+
+def test_same_file_name_from_other_uri_gets_its_own_output_dir(url, monkeypatch):
+    monkeypatch.setattr(base_util, "output_base_dir", download_cache.output_base_dir)
+    first = download.http_download(url)
+    second = download.http_download(url.replace("/asset.wav", "/other/asset.wav"))
+
+    assert first and second and first.file_path != second.file_path
+    assert base_util.asset_key(first.file_path) == "asset"
+    assert base_util.asset_key(second.file_path).endswith("/asset")
+    assert base_util.asr_output_dir(first.file_path) != base_util.asr_output_dir(
+        second.file_path
+    )
+    assert get_asset_info(second.file_path)[0] == "asset"  # the carrierId
@@ -0,0 +1,79 @@
+import pytest
+
+import worker_daemon
+from job_queue import DONE, FAILED, QUEUED, RUNNING, Job, SQLiteJobQueue
+from worker_daemon import WorkerDaemon
+
+
+@pytest.fixture
+def queue(tmp_path) -> SQLiteJobQueue:
+    return SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), visibility_timeout=60)
+
+
+def test_jobs_are_handed_out_once_in_order(queue):
+    first = queue.put("http://example.com/1.mp4", "s3://bucket/out")
+    second = queue.put("http://example.com/2.mp4")
+
+    assert queue.get() == Job(first, "http://example.com/1.mp4", "s3://bucket/out", 1)
+    assert queue.get() == Job(second, "http://example.com/2.mp4", None, 1)
+    assert queue.get() is None
+    assert queue.count(RUNNING) == 2
+
+
+def test_acked_job_is_done(queue):
+    queue.put("http://example.com/1.mp4")
+    job = queue.get()
+    assert job
+
+    queue.ack(job)
+
+    assert queue.count(DONE) == 1 and queue.get() is None
+
+
+def test_unfinished_job_is_handed_out_after_the_visibility_timeout(tmp_path):
+    queue = SQLiteJobQueue(str(tmp_path / "jobs.sqlite"), visibility_timeout=0)
+    job_id = queue.put("http://example.com/1.mp4")
+    assert queue.get()
+
+    job = queue.get()  # its worker died
+
+    assert job and job.id == job_id and job.attempts == 2
+
+
+def test_retried_job_waits_for_its_delay(queue):
+    queue.put("http://example.com/1.mp4")
+    job = queue.get()
+    assert job
+
+    queue.retry(job, 3600, "boom")
+    assert queue.get() is None and queue.count(QUEUED) == 1
+
+    queue.retry(job, 0, "boom")
+    retried = queue.get()
+    assert retried and retried.attempts == 2
+
+
+def test_daemon_retries_and_then_fails_the_job(queue, monkeypatch):
+    monkeypatch.setattr(worker_daemon, "job_max_attempts", 2)
+    monkeypatch.setattr(worker_daemon, "job_retry_backoff", 0)
+    monkeypatch.setattr(worker_daemon.simple_asr, "run", lambda uri, out: False)
+    daemon = WorkerDaemon(queue, 1)
+    queue.put("http://example.com/1.mp4")
+
+    for attempts in [1, 2]:
+        job = queue.get()
+        assert job and job.attempts == attempts
+        daemon._process(job)
+
+    assert queue.count(FAILED) == 1 and queue.get() is None
+
+
+def test_daemon_acks_a_successful_job(queue, monkeypatch):
+    monkeypatch.setattr(worker_daemon.simple_asr, "run", lambda uri, out: True)
+    queue.put("http://example.com/1.mp4")
+    job = queue.get()
+    assert job
+
+    WorkerDaemon(queue, 1)._process(job)
+
+    assert queue.count(DONE) == 1
@@ -0,0 +1,128 @@
+import os
+import time
+
+import boto3
+from botocore.config import Config
+from moto import mock_aws
+import pytest
+
+import leasing
+from leasing import FileLeaseBackend, S3LeaseBackend
+
+BUCKET = "leases-bucket"
+KEY = "asr:test_asset"
+
+
+@pytest.fixture
+def file_backend(tmp_path) -> FileLeaseBackend:
+    return FileLeaseBackend(str(tmp_path / "leases"))
+
+
+@pytest.fixture
+def s3_backend(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield S3LeaseBackend(BUCKET, "leases", client)
+
+
+def test_file_lease_excludes_other_owner(file_backend):
+    lease = file_backend.acquire(KEY, "worker1", 60)
+    assert lease is not None
+    assert file_backend.acquire(KEY, "worker2", 60) is None
+    assert file_backend.renew(lease, 60)
+
+
+def test_file_lease_expired_is_taken_over(file_backend):
+    lease = file_backend.acquire(KEY, "worker1", -1)
+    assert lease is not None
+    assert file_backend.acquire(KEY, "worker2", 60) is not None
+    assert not file_backend.renew(lease, 60)
+
+
+def test_file_lease_release_removes_files(file_backend):
+    lease = file_backend.acquire(KEY, "worker1", 60)
+    assert lease is not None
+    assert len(os.listdir(file_backend.lease_dir)) == 2  # the lease & its lock file
+    file_backend.release(lease)
+    assert os.listdir(file_backend.lease_dir) == []
+    assert file_backend.acquire(KEY, "worker2", 60) is not None
+
+
+def test_file_lease_release_keeps_lease_of_other_owner(file_backend):
+    lease = file_backend.acquire(KEY, "worker1", -1)
+    assert lease is not None
+    assert file_backend.acquire(KEY, "worker2", 60) is not None
+    file_backend.release(lease)  # was taken over, so not released
+    assert file_backend.acquire(KEY, "worker3", 60) is None
+
+
+def test_s3_lease_conditional_create(s3_backend):
+    lease = s3_backend.acquire(KEY, "worker1", 60)
+    assert lease is not None and lease.token
+    # If-None-Match: * fails as the lease object exists and it did not expire
+    assert s3_backend.acquire(KEY, "worker2", 60) is None
+
+
+def test_s3_lease_renew_needs_matching_etag(s3_backend):
+    lease = s3_backend.acquire(KEY, "worker1", 60)
+    assert lease is not None
+    token = lease.token
+    assert s3_backend.renew(lease, 60)
+    assert lease.token != token  # the new ETag
+    stale_lease = leasing.Lease(KEY, "worker1", lease.expires_at, token)
+    assert not s3_backend.renew(stale_lease, 60)  # If-Match on the old ETag fails
+
+
+def test_s3_lease_expired_is_taken_over(s3_backend):
+    lease = s3_backend.acquire(KEY, "worker1", -1)
+    assert lease is not None
+    taken_over = s3_backend.acquire(KEY, "worker2", 60)
+    assert taken_over is not None
+    assert not s3_backend.renew(lease, 60)
+    s3_backend.release(lease)  # If-Match fails, so the new lease is kept
+    assert s3_backend.acquire(KEY, "worker3", 60) is None
+    s3_backend.release(taken_over)
+    assert s3_backend.acquire(KEY, "worker3", 60) is not None
+
+
+def test_hold_skips_after_max_wait(file_backend, monkeypatch):
+    monkeypatch.setattr(leasing, "_backend", file_backend)
+    monkeypatch.setattr(leasing, "lease_conflict", "wait")
+    monkeypatch.setattr(leasing, "lease_poll_interval", 0.1)
+    monkeypatch.setattr(leasing, "lease_max_wait", 0.5)
+    assert file_backend.acquire(KEY, "other worker", 60) is not None
+    start_time = time.time()
+    with leasing.hold(KEY) as leased:
+        assert not leased
+    assert 0.5 <= time.time() - start_time < 5
+
+
+def test_hold_waits_for_release(file_backend, monkeypatch):
+    monkeypatch.setattr(leasing, "_backend", file_backend)
+    monkeypatch.setattr(leasing, "lease_conflict", "wait")
+    monkeypatch.setattr(leasing, "lease_poll_interval", 0.1)
+    monkeypatch.setattr(leasing, "lease_max_wait", 0)
+    assert file_backend.acquire(KEY, "other worker", 0.3) is not None  # expires
+    with leasing.hold(KEY) as leased:
+        assert leased
+    assert os.listdir(file_backend.lease_dir) == []
+
+
+def test_s3_lease_connection_errors_are_handled(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    client = boto3.client(
+        "s3",
+        region_name="us-east-1",
+        endpoint_url="http://127.0.0.1:9",  # nothing listens there
+        config=Config(retries={"max_attempts": 1}, connect_timeout=1),
+    )
+    backend = S3LeaseBackend(BUCKET, "leases", client)
+    assert backend.acquire(KEY, "worker1", 60) is None
+    lease = leasing.Lease(KEY, "worker1", time.time() + 60, '"etag"')
+    assert not backend.renew(lease, 60)
+    backend.release(lease)  # logged, the lease expires by itself
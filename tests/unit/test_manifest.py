@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+from manifest import ASR, TRANSCODE, TRANSCRIPT, StageManifest
+from transcript import CTM_FILE
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = {}
+    for name, content in [("input", "audio"), ("ctm", "words"), ("txt", "text")]:
+        paths[name] = str(tmp_path / name)
+        with open(paths[name], "w") as f:
+            f.write(content)
+    return paths
+
+
+@pytest.fixture
+def manifest(tmp_path, files) -> StageManifest:
+    manifest = StageManifest(str(tmp_path))
+    manifest.start(ASR)
+    manifest.finish(ASR, [files["input"]], [files["ctm"], files["txt"]])
+    return manifest
+
+
+def _rewrite(path: str, content: str):
+    stat = os.stat(path)
+    with open(path, "w") as f:
+        f.write(content)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+def test_is_done(manifest, files):
+    assert manifest.is_done(ASR, [files["input"]], [files["ctm"], files["txt"]])
+    assert not manifest.is_done(TRANSCRIPT, [files["ctm"], files["txt"]])
+
+
+def test_not_done_with_other_inputs(manifest, files):
+    assert not manifest.is_done(ASR, [files["ctm"]])
+
+
+def test_changed_output_with_same_size_is_detected_by_checksum(manifest, files):
+    _rewrite(files["ctm"], "sword")
+    assert not manifest.is_done(ASR, [files["input"]])
+
+
+def test_touched_output_with_same_content_is_still_done(manifest, files):
+    _rewrite(files["txt"], "text")
+    assert manifest.is_done(ASR, [files["input"]])
+
+
+def test_changed_input_is_detected(manifest, files):
+    _rewrite(files["input"], "audi0")
+    assert not manifest.is_done(ASR, [files["input"]])
+
+
+def test_removed_output_is_detected(manifest, files):
+    os.remove(files["txt"])
+    assert not manifest.is_done(ASR, [files["input"]])
+
+
+def test_failed_stage_is_not_done(manifest, files):
+    manifest.start(ASR)
+    manifest.finish(ASR, [files["input"]], [files["ctm"]], success=False)
+    assert not manifest.is_done(ASR, [files["input"]])
+
+
+def test_start_forgets_later_stages(manifest, files):
+    manifest.start(TRANSCRIPT)
+    manifest.finish(TRANSCRIPT, [files["ctm"], files["txt"]], [])
+    manifest.start(TRANSCODE)
+    assert not manifest.is_done(ASR, [files["input"]])
+    assert not manifest.is_done(TRANSCRIPT, [files["ctm"], files["txt"]])
+
+
+def test_legacy_output_is_adopted(tmp_path, files):
+    (tmp_path / CTM_FILE).write_text("words")
+    manifest = StageManifest(str(tmp_path))
+    assert manifest.legacy
+    assert not manifest.is_done(ASR, [files["input"]], [str(tmp_path / "missing")])
+    assert manifest.is_done(ASR, [files["input"]], [files["ctm"], files["txt"]])
+    assert manifest.outputs(ASR) == [files["ctm"], files["txt"]]
+
+
+def test_new_output_dir_is_not_legacy(tmp_path):
+    manifest = StageManifest(str(tmp_path / "new"))
+    assert not manifest.legacy
+
+
+def test_legacy_dir_stays_legacy_while_adopting(tmp_path, files):
+    (tmp_path / CTM_FILE).write_text("words")
+    manifest = StageManifest(str(tmp_path))
+    manifest.finish(TRANSCODE, [files["input"]], [files["input"]], adopted=True)
+    assert manifest.legacy
+    manifest.finish(TRANSCRIPT, [files["ctm"]], [files["txt"]])
+    assert not manifest.legacy
@@ -0,0 +1,108 @@
+import os
+import wave
+
+import pytest
+
+import media_probe
+from media_probe import (
+    AS_IS,
+    DECODE,
+    PROBE_FILE,
+    STREAM_COPY,
+    MediaInfo,
+    StreamInfo,
+    choose_route,
+    probe,
+)
+
+
+@pytest.fixture
+def wav_format(monkeypatch):
+    monkeypatch.setattr(media_probe, "transcode_format", "wav")
+    monkeypatch.setattr(media_probe, "transcode_sample_rate", 16000)
+    monkeypatch.setattr(media_probe, "transcode_channels", 1)
+
+
+@pytest.fixture
+def mp3_format(monkeypatch):
+    monkeypatch.setattr(media_probe, "transcode_format", "mp3")
+
+
+def _info(format_name: str, *streams: StreamInfo, duration: float = 10) -> MediaInfo:
+    return MediaInfo("input", 0, 0, format_name, duration, list(streams))
+
+
+def _audio(codec: str, rate: int = 16000, channels: int = 1) -> StreamInfo:
+    return StreamInfo(0, "audio", codec, rate, channels)
+
+
+VIDEO = StreamInfo(1, "video", "h264")
+
+
+@pytest.mark.parametrize(
+    "info, route",
+    [
+        (_info("wav", _audio("pcm_s16le")), AS_IS),
+        (_info("mov,mp4,m4a,3gp,3g2,mj2", _audio("pcm_s16le"), VIDEO), STREAM_COPY),
+        (_info("wav", _audio("pcm_s16le", 48000, 2)), DECODE),
+        (_info("mov,mp4,m4a,3gp,3g2,mj2", _audio("aac"), VIDEO), DECODE),
+        (_info("mp3", _audio("mp3")), DECODE),
+    ],
+)
+def test_wav_routes(wav_format, info, route):
+    assert choose_route(info)[0] == route
+
+
+@pytest.mark.parametrize(
+    "info, route",
+    [
+        (_info("mp3", _audio("mp3", 44100, 2)), AS_IS),
+        (_info("wav", _audio("pcm_s24le", 48000, 2)), AS_IS),
+        (_info("mov,mp4,m4a,3gp,3g2,mj2", _audio("mp3"), VIDEO), STREAM_COPY),
+        (_info("mov,mp4,m4a,3gp,3g2,mj2", _audio("aac"), VIDEO), DECODE),
+    ],
+)
+def test_mp3_routes(mp3_format, info, route):
+    assert choose_route(info)[0] == route
+
+
+def test_unusable_inputs(wav_format):
+    assert choose_route(_info("mov,mp4,m4a,3gp,3g2,mj2", VIDEO))[0] is None
+    assert choose_route(_info("wav", _audio("pcm_s16le"), duration=0))[0] is None
+
+
+def test_pcm_wav_is_probed_without_ffprobe(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_probe, "_ffprobe", lambda path: pytest.fail("ffprobe"))
+    path = str(tmp_path / "input.wav")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b"\0\0" * 32000)
+
+    info = probe(path)
+
+    assert info and info.duration == 2.0
+    assert info.audio == StreamInfo(0, "audio", "pcm_s16le", 16000, 1)
+
+
+def test_probe_is_cached_until_the_input_changes(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_ffprobe(path: str) -> MediaInfo:
+        calls.append(path)
+        return MediaInfo(path, 0, 0, "mp3", 10, [_audio("mp3")])
+
+    monkeypatch.setattr(media_probe, "_ffprobe", fake_ffprobe)
+    path = str(tmp_path / "input.mp3")
+    with open(path, "wb") as f:
+        f.write(b"mp3")
+    output_dir = str(tmp_path / "output")
+
+    assert probe(path, output_dir) == probe(path, output_dir)
+    assert len(calls) == 1 and os.path.exists(os.path.join(output_dir, PROBE_FILE))
+
+    with open(path, "ab") as f:
+        f.write(b"more")
+    probe(path, output_dir)
+    assert len(calls) == 2
@@ -0,0 +1,86 @@
+import threading
+from typing import List
+
+import pipeline
+from pipeline import BatchItem, PipelineStage, run_pipeline
+
+
+def _items(durations: List[float]) -> List[BatchItem]:
+    items = [BatchItem(f"http://example.com/{i}.wav") for i in range(len(durations))]
+    for item, duration in zip(items, durations):
+        item.duration = duration
+    return items
+
+
+def test_items_pass_all_stages_in_order():
+    done: List[str] = []
+    stages = [
+        PipelineStage("first", lambda item: True),
+        PipelineStage("second", lambda item: done.append(item.input_uri) or True),
+    ]
+    items = _items([1, 2, 3])
+
+    run_pipeline(items, stages)
+
+    assert done == [item.input_uri for item in items]
+    assert all([item.success and item.processing_time >= 0 for item in items])
+
+
+def test_failed_item_does_not_reach_the_next_stage():
+    done: List[str] = []
+    stages = [
+        PipelineStage("first", lambda item: item.duration != 2),
+        PipelineStage("second", lambda item: done.append(item.input_uri) or True),
+    ]
+    items = _items([1, 2, 3])
+
+    run_pipeline(items, stages)
+
+    assert done == [items[0].input_uri, items[2].input_uri]
+    assert not items[1].success and items[1].failed_stage == "first"
+
+
+def test_exception_fails_the_item():
+    def fail(item: BatchItem) -> bool:
+        raise RuntimeError("boom")
+
+    items = _items([1])
+
+    run_pipeline(items, [PipelineStage("first", fail)])
+
+    assert not items[0].success and items[0].failed_stage == "first"
+
+
+def test_longest_item_is_decoded_first(monkeypatch):
+    monkeypatch.setattr(pipeline, "pipeline_longest_first", True)
+    monkeypatch.setattr(pipeline, "pipeline_longest_first_depth", 8)
+    decoded: List[float] = []
+    busy = threading.Event()
+    queued = threading.Semaphore(0)
+
+    def transcode(item: BatchItem) -> bool:
+        queued.release()
+        return True
+
+    def asr(item: BatchItem) -> bool:
+        if not decoded:
+            busy.wait(5)  # the other items are queued in the meantime
+        decoded.append(item.duration)
+        return True
+
+    monkeypatch.setattr(pipeline, "_asr", asr)
+    items = _items([10, 1, 30, 20])
+    asr_stage = pipeline._asr_stage()
+    stages = [PipelineStage("transcode", transcode), asr_stage]
+
+    def release_when_queued():
+        for _ in items:
+            queued.acquire()
+        while asr_stage.queue.qsize() < len(items) - 1:
+            threading.Event().wait(0.01)
+        busy.set()
+
+    threading.Thread(target=release_when_queued, daemon=True).start()
+    run_pipeline(items, stages)
+
+    assert decoded == [10, 30, 20, 1]
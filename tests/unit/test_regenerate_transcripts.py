@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import regenerate_transcripts
+from regenerate_transcripts import (
+    find_asr_output_dirs,
+    is_stale,
+    regenerate_transcripts as regenerate,
+)
+import transcript
+from transcript import CTM_FILE, JSON_FILE, TXT_FILE
+
+TXT = "goedemorgen nederland ({asset}.0001 1.200)\n"
+CTM = (
+    "{asset}.0001 1 1.20 0.50 goedemorgen 1.00\n"
+    "{asset}.0001 1 1.70 0.60 nederland 0.98\n"
+)
+
+
+@pytest.fixture
+def base_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(regenerate_transcripts, "transcript_workers", 1)
+    monkeypatch.setattr(transcript, "transcript_format", "pretty")
+    monkeypatch.setattr(transcript, "word_index", False)
+    return str(tmp_path)
+
+
+def _asr_output(base_dir: str, *path: str, txt: str = TXT) -> str:
+    output_dir = os.path.join(base_dir, "output", *path)
+    os.makedirs(output_dir)
+    asset = path[-1]
+    with open(os.path.join(output_dir, TXT_FILE), "w", encoding="utf-8") as f:
+        f.write(txt.format(asset=asset))
+    with open(os.path.join(output_dir, CTM_FILE), "w", encoding="utf-8") as f:
+        f.write(CTM.format(asset=asset))
+    return output_dir
+
+
+def test_finds_output_dirs_also_under_a_uri_hash(base_dir):
+    first = _asr_output(base_dir, "first")
+    second = _asr_output(base_dir, "0123456789abcdef", "first")
+    os.makedirs(os.path.join(base_dir, "output", "no_asr_output"))
+
+    assert sorted(find_asr_output_dirs(base_dir)) == sorted([first, second])
+
+
+def test_only_stale_transcripts_are_regenerated(base_dir):
+    first = _asr_output(base_dir, "first")
+    _asr_output(base_dir, "second")
+
+    summary = regenerate(base_dir)
+    assert (summary.scanned, summary.regenerated, summary.failed) == (2, 2, [])
+    assert os.path.exists(os.path.join(first, JSON_FILE))
+    assert not is_stale(first)
+
+    stat = os.stat(os.path.join(first, JSON_FILE))
+    os.utime(os.path.join(first, CTM_FILE), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert is_stale(first)
+
+    summary = regenerate(base_dir)
+    assert (summary.scanned, summary.regenerated) == (2, 1)
+    assert regenerate(base_dir, regenerate_all=True).regenerated == 2
+
+
+def test_failures_are_reported(base_dir):
+    _asr_output(base_dir, "first")
+    broken = _asr_output(base_dir, "broken", txt="no fragment id\n")
+
+    summary = regenerate(base_dir)
+
+    assert summary.regenerated == 1 and summary.failed == [broken]
+    assert not os.path.exists(os.path.join(broken, JSON_FILE))
@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import tarfile
+from typing import Iterator
+
+import boto3
+from moto import mock_aws
+import pytest
+
+import s3_util
+from s3_util import MANIFEST_EXTENSION, S3Store
+
+BUCKET = "output-bucket"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def store(monkeypatch) -> Iterator[S3Store]:
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(s3_util, "s3_multipart_chunksize", 5 * MB)  # S3's minimum
+    monkeypatch.setattr(s3_util, "s3_max_concurrency", 2)
+    monkeypatch.setattr(s3_util, "s3_skip_unchanged", True)
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket=BUCKET)
+        yield S3Store()
+
+
+def _files(tmp_path, sizes) -> list:
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmp_path / f"file{i}.bin"
+        path.write_bytes(os.urandom(size))
+        paths.append(str(path))
+    return paths
+
+
+def _archive(store: S3Store, key: str) -> tarfile.TarFile:
+    body = store.client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+    return tarfile.open(fileobj=io.BytesIO(body), mode="r:*")
+
+
+def test_large_archive_is_uploaded_in_parts(store, tmp_path):
+    files = _files(tmp_path, [7 * MB, 4 * MB])
+
+    result = store.stream_archive_to_s3(
+        BUCKET, "assets/a", "a", files, base_dir=str(tmp_path), compression="none"
+    )
+
+    assert result.success
+    head = store.client.head_object(Bucket=BUCKET, Key="assets/a/a.tar")
+    assert head["ETag"].strip('"').endswith("-3")  # 11 MB in parts of 5 MB
+    with _archive(store, "assets/a/a.tar") as tar:
+        for path in files:
+            member = tar.extractfile(os.path.basename(path))
+            with open(path, "rb") as f:
+                assert member and member.read() == f.read()
+
+
+def test_small_archive_is_uploaded_at_once(store, tmp_path):
+    files = _files(tmp_path, [1000])
+
+    result = store.stream_archive_to_s3(BUCKET, "assets/b", "b", files)
+
+    assert result.success
+    head = store.client.head_object(Bucket=BUCKET, Key="assets/b/b.tar.gz")
+    assert "-" not in head["ETag"]
+    with _archive(store, "assets/b/b.tar.gz") as tar:
+        assert tar.getnames() == ["file0.bin"]
+    manifest = store.client.get_object(
+        Bucket=BUCKET, Key=f"assets/b/b.tar.gz{MANIFEST_EXTENSION}"
+    )["Body"].read()
+    assert json.loads(manifest)["files"][0]["size"] == 1000
+
+
+def test_unchanged_archive_is_not_uploaded_again(store, tmp_path):
+    files = _files(tmp_path, [1000])
+    store.stream_archive_to_s3(BUCKET, "assets/c", "c", files)
+
+    result = store.stream_archive_to_s3(BUCKET, "assets/c", "c", files)
+
+    assert result.success and result.bytes_transferred == 0
+
+
+def test_failed_upload_is_aborted(store, tmp_path):
+    files = _files(tmp_path, [11 * MB])
+
+    result = store.stream_archive_to_s3(
+        "missing-bucket", "assets/d", "d", files, compression="none"
+    )
+
+    assert not result.success
+
+
+def test_files_are_uploaded_relative_to_base_dir(store, tmp_path):
+    (tmp_path / "sub").mkdir()
+    files = _files(tmp_path, [100]) + [str(tmp_path / "sub" / "extra.txt")]
+    (tmp_path / "sub" / "extra.txt").write_text("extra")
+
+    result = store.transfer_to_s3(BUCKET, "assets/e", files, base_dir=str(tmp_path))
+
+    assert result.success and result.bytes_transferred == 105
+    keys = store.client.list_objects_v2(Bucket=BUCKET, Prefix="assets/e/")["Contents"]
+    assert sorted([o["Key"] for o in keys]) == [
+        "assets/e/file0.bin",
+        "assets/e/sub/extra.txt",
+    ]
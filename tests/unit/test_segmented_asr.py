@@ -0,0 +1,64 @@
+import os
+
+from segmented_asr import Segment, merge_segment_outputs
+from transcript import CTM_FILE, TXT_FILE
+
+ASSET_ID = "test_asset"
+
+
+def _segment(tmp_path, index: int, start: float, end: float, txt: str, ctm: str):
+    output_dir = tmp_path / "segments" / f"{ASSET_ID}_seg{index:04d}"
+    output_dir.mkdir(parents=True)
+    (output_dir / TXT_FILE).write_text(txt, encoding="utf-8")
+    (output_dir / CTM_FILE).write_text(ctm, encoding="utf-8")
+    return Segment(index, start, end, str(output_dir) + ".wav", str(output_dir))
+
+
+def test_merge_shifts_times_and_renumbers_fragments(tmp_path):
+    segments = [
+        _segment(
+            tmp_path,
+            0,
+            0,
+            600.5,
+            f"goedemorgen nederland ({ASSET_ID}_seg0000.0001 1.200)\n"
+            f"het nieuws ({ASSET_ID}_seg0000.0002 300.000)\n",
+            f"{ASSET_ID}_seg0000.0001 1 1.20 0.50 goedemorgen 1.00\n"
+            f"{ASSET_ID}_seg0000.0001 1 1.70 0.60 nederland 0.98\n"
+            f"{ASSET_ID}_seg0000.0002 1 300.00 0.20 het 1.00\n"
+            f"{ASSET_ID}_seg0000.0002 1 300.20 0.40 nieuws 0.95\n",
+        ),
+        _segment(
+            tmp_path,
+            1,
+            600.5,
+            1200,
+            f"het weer ({ASSET_ID}_seg0001.0001 2.250)\n",
+            f"{ASSET_ID}_seg0001.0001 1 2.25 0.20 het 1.00\n"
+            f"{ASSET_ID}_seg0001.0001 1 2.45 0.30 weer 0.90\n",
+        ),
+    ]
+    assert merge_segment_outputs(segments, str(tmp_path), ASSET_ID)
+
+    with open(os.path.join(tmp_path, TXT_FILE), encoding="utf-8") as f:
+        assert f.read() == (
+            f"goedemorgen nederland ({ASSET_ID}.0001 1.200)\n"
+            f"het nieuws ({ASSET_ID}.0002 300.000)\n"
+            f"het weer ({ASSET_ID}.0003 602.750)\n"
+        )
+    with open(os.path.join(tmp_path, CTM_FILE), encoding="utf-8") as f:
+        assert f.read() == (
+            f"{ASSET_ID}.0001 1 1.20 0.50 goedemorgen 1.00\n"
+            f"{ASSET_ID}.0001 1 1.70 0.60 nederland 0.98\n"
+            f"{ASSET_ID}.0002 1 300.00 0.20 het 1.00\n"
+            f"{ASSET_ID}.0002 1 300.20 0.40 nieuws 0.95\n"
+            f"{ASSET_ID}.0003 1 602.75 0.20 het 1.00\n"
+            f"{ASSET_ID}.0003 1 602.95 0.30 weer 0.90\n"
+        )
+
+
+def test_merge_fails_on_missing_segment_output(tmp_path):
+    segment = _segment(tmp_path, 0, 0, 600, "", "")
+    os.remove(os.path.join(segment.output_dir, CTM_FILE))
+    assert not merge_segment_outputs([segment], str(tmp_path), ASSET_ID)
+    assert not os.path.exists(os.path.join(tmp_path, TXT_FILE))
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+import transcode
+from base_util import get_asset_info
+from media_probe import MediaInfo, StreamInfo
+
+
+@pytest.fixture
+def base_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(transcode, "transcode_format", "wav")
+
+    def fake_transcode(path: str, asr_path: str) -> bool:
+        with open(asr_path, "wb") as f:
+            f.write(b"transcoded")
+        return True
+
+    monkeypatch.setattr(transcode, "transcode_to_wav", fake_transcode)
+    return str(tmp_path)
+
+
+def _stereo_wav(input_path: str) -> MediaInfo:
+    audio = StreamInfo(0, "audio", "pcm_s16le", 48000, 2)
+    return MediaInfo(input_path, 0, 0, "wav", 10.0, [audio])
+
+
+def test_wav_input_keeps_its_asset_id(base_dir):
+    input_path = os.path.join(base_dir, "asset.wav")
+    with open(input_path, "wb") as f:
+        f.write(b"original")
+
+    path = transcode.try_transcode(
+        input_path, "asset", ".wav", info=_stereo_wav(input_path)
+    )
+
+    assert path and path != input_path
+    assert get_asset_info(path)[0] == "asset"
+    with open(input_path, "rb") as f:
+        assert f.read() == b"original"
+
+
+def test_transcode_of_other_input_is_next_to_it(base_dir):
+    input_path = os.path.join(base_dir, "asset.mp4")
+
+    path = transcode.try_transcode(
+        input_path, "asset", ".mp4", info=_stereo_wav(input_path)
+    )
+
+    assert path == os.path.join(base_dir, "asset.wav")
@@ -0,0 +1,98 @@
+import json
+import os
+
+import pytest
+
+import transcript
+from transcript import CTM_FILE, JSON_FILE, TXT_FILE, generate_transcript
+
+TXT = (
+    "goedemorgen nederland (test_asset.0001 1.200)\n"
+    "één café (test_asset.0002 12.000)\n"
+)
+CTM = (
+    "test_asset.0001 1 1.20 0.50 goedemorgen 1.00\n"
+    "test_asset.0001 1 1.70 0.60 nederland 0.98\n"
+    "test_asset.0002 1 12.00 0.20 één 1.00\n"
+    "test_asset.0002 1 12.25 0.40 café 0.95\n"
+)
+# what the original (non-streaming) implementation wrote with json.dump(indent=4)
+EXPECTED_TRANSCRIPT = [
+    {
+        "words": "goedemorgen nederland",
+        "wordTimes": [1200, 1700],
+        "start": 1000.0,
+        "sequenceNr": 0,
+        "fragmentId": "0001",
+        "carrierId": "test_asset",
+    },
+    {
+        "words": "één café",
+        "wordTimes": [12000, 12250],
+        "start": 12000.0,
+        "sequenceNr": 1,
+        "fragmentId": "0002",
+        "carrierId": "test_asset",
+    },
+]
+
+
+@pytest.fixture
+def asr_output_dir(tmp_path, monkeypatch) -> str:
+    monkeypatch.setattr(transcript, "word_index", False)
+    (tmp_path / TXT_FILE).write_text(TXT, encoding="utf-8")
+    (tmp_path / CTM_FILE).write_text(CTM, encoding="utf-8")
+    return str(tmp_path)
+
+
+def test_pretty_output_is_unchanged(asr_output_dir, monkeypatch):
+    monkeypatch.setattr(transcript, "transcript_format", "pretty")
+    assert generate_transcript(asr_output_dir)
+    with open(os.path.join(asr_output_dir, JSON_FILE), "rb") as f:
+        assert f.read() == json.dumps(
+            EXPECTED_TRANSCRIPT, ensure_ascii=False, indent=4
+        ).encode("utf-8")
+
+
+def test_compact_output(asr_output_dir, monkeypatch):
+    monkeypatch.setattr(transcript, "transcript_format", "compact")
+    assert generate_transcript(asr_output_dir)
+    with open(os.path.join(asr_output_dir, JSON_FILE), "r", encoding="utf-8") as f:
+        assert json.load(f) == EXPECTED_TRANSCRIPT
+
+
+def test_fails_without_asr_output(tmp_path):
+    assert not generate_transcript(str(tmp_path))
+    assert not os.path.exists(tmp_path / JSON_FILE)
+
+
+@pytest.mark.parametrize("transcript_format", ["pretty", "compact"])
+def test_empty_asr_output_gives_empty_transcript(
+    tmp_path, monkeypatch, transcript_format
+):
+    monkeypatch.setattr(transcript, "word_index", False)
+    monkeypatch.setattr(transcript, "transcript_format", transcript_format)
+    (tmp_path / TXT_FILE).write_text("", encoding="utf-8")
+    (tmp_path / CTM_FILE).write_text("", encoding="utf-8")
+
+    assert generate_transcript(str(tmp_path))
+    with open(tmp_path / JSON_FILE, "r", encoding="utf-8") as f:
+        assert json.load(f) == []
+
+
+def test_empty_asr_output_gives_empty_word_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(transcript, "word_index", True)
+    (tmp_path / TXT_FILE).write_text("", encoding="utf-8")
+    (tmp_path / CTM_FILE).write_text("", encoding="utf-8")
+
+    assert generate_transcript(str(tmp_path))
+    assert os.path.exists(transcript.word_index_file(str(tmp_path)))
+
+
+def test_fails_on_unparsable_asr_output(asr_output_dir):
+    with open(os.path.join(asr_output_dir, TXT_FILE), "a", encoding="utf-8") as f:
+        f.write("no fragment id\n")
+
+    assert not generate_transcript(asr_output_dir)
+    assert not os.path.exists(os.path.join(asr_output_dir, JSON_FILE))
+    assert not os.path.exists(os.path.join(asr_output_dir, f"{JSON_FILE}.part"))
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from transcript import CTM_FILE, TXT_FILE
+from vad import VAD_DIR, SpeechAudio, SpeechRegion, decode_speech
+
+# 2 secs of speech at 1s and 10s of the original audio, with a 0.5s gap between
+# them in the speech only audio
+REGIONS = [SpeechRegion(1.0, 3.0, 0.0), SpeechRegion(10.0, 12.0, 2.5)]
+
+
+@pytest.fixture
+def speech(tmp_path) -> SpeechAudio:
+    audio_path = tmp_path / VAD_DIR / "test_asset.wav"
+    audio_path.parent.mkdir()
+    audio_path.write_bytes(b"")
+    return SpeechAudio(str(audio_path), 20.0, REGIONS)
+
+
+@pytest.mark.parametrize(
+    "speech_time, original_time",
+    [
+        (0.0, 1.0),
+        (1.5, 2.5),
+        (2.2, 3.2),  # in the gap, so just after the first region
+        (2.5, 10.0),
+        (4.0, 11.5),
+        (9.0, 16.5),  # beyond the speech only audio, capped at the duration
+    ],
+)
+def test_to_original_time(speech, speech_time, original_time):
+    assert speech.to_original_time(speech_time) == pytest.approx(original_time)
+
+
+def test_decode_speech_maps_times_back(speech, tmp_path):
+    def decode(input_path: str, output_dir: str) -> bool:
+        assert input_path == speech.audio_path
+        os.makedirs(output_dir)
+        with open(os.path.join(output_dir, TXT_FILE), "w", encoding="utf-8") as f:
+            f.write("hallo (test_asset.0001 0.500)\nwereld (test_asset.0002 3.000)\n")
+        with open(os.path.join(output_dir, CTM_FILE), "w", encoding="utf-8") as f:
+            f.write("test_asset.0001 1 0.50 0.30 hallo 1.00\n")
+            f.write("test_asset.0002 1 3.25 0.40 wereld 0.90\n")
+        return True
+
+    assert decode_speech(speech, str(tmp_path), decode)
+
+    with open(os.path.join(tmp_path, TXT_FILE), encoding="utf-8") as f:
+        assert f.read() == (
+            "hallo (test_asset.0001 1.500)\nwereld (test_asset.0002 10.500)\n"
+        )
+    with open(os.path.join(tmp_path, CTM_FILE), encoding="utf-8") as f:
+        assert f.read() == (
+            "test_asset.0001 1 1.50 0.30 hallo 1.00\n"
+            "test_asset.0002 1 10.75 0.40 wereld 0.90\n"
+        )
+    assert not os.path.exists(speech.audio_path)  # only the time map is kept
+
+
+def test_decode_speech_fails_with_the_decode(speech, tmp_path):
+    assert not decode_speech(speech, str(tmp_path), lambda i, o: False)
+    assert not os.path.exists(os.path.join(tmp_path, TXT_FILE))
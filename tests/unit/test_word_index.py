@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from word_index import (
+    Posting,
+    WordIndex,
+    WordIndexWriter,
+    merge_word_indexes,
+    word_index_file,
+)
+
+
+def _write_index(path: str, asset_id: str, segments) -> str:
+    writer = WordIndexWriter(asset_id)
+    for i, (words, word_times, start) in enumerate(segments):
+        writer.add_segment(i, words, word_times, start)
+    writer.write(path)
+    return path
+
+
+@pytest.fixture
+def index_path(tmp_path) -> str:
+    return _write_index(
+        word_index_file(str(tmp_path)),
+        "asset1",
+        [
+            ("Goedemorgen Nederland", [1000, 1500], 1000.0),
+            ("het nieuws van nederland", [5000, 5200, 5600, 5800], 5000.0),
+            ("één woord", [9000], 9000.0),  # missing word time
+        ],
+    )
+
+
+def test_lookup(index_path):
+    with WordIndex(index_path) as index:
+        assert index.docs() == ["asset1"]
+        assert index.lookup("nederland") == [
+            Posting("asset1", 0, 1500),
+            Posting("asset1", 1, 5800),
+        ]
+        assert index.lookup("GOEDEMORGEN") == [Posting("asset1", 0, 1000)]
+        assert index.lookup("één") == [Posting("asset1", 2, 9000)]
+        assert index.lookup("woord") == [Posting("asset1", 2, 9000)]  # segment start
+        assert index.lookup("onbekend") == []
+        assert index.lookup("nederlan") == []
+
+
+def test_lookup_time_range(index_path):
+    with WordIndex(index_path) as index:
+        assert index.lookup("nederland", 1500, 5800) == [Posting("asset1", 0, 1500)]
+        assert index.lookup("nederland", 2000) == [Posting("asset1", 1, 5800)]
+        assert index.lookup("nederland", 6000) == []
+
+
+def test_lookup_prefix(index_path):
+    with WordIndex(index_path) as index:
+        assert list(index.terms("ne")) == ["nederland"]
+        assert list(index.terms("n")) == ["nederland", "nieuws"]
+        assert index.lookup_prefix("n", 5000) == {
+            "nederland": [Posting("asset1", 1, 5800)],
+            "nieuws": [Posting("asset1", 1, 5200)],
+        }
+        assert index.lookup_prefix("x") == {}
+        assert len(list(index.terms())) == index.num_terms == 7
+
+
+def test_merge(index_path, tmp_path):
+    other_path = _write_index(
+        str(tmp_path / "other.bin"),
+        "asset2",
+        [("nederland en het weer", [100, 200, 300, 400], 0.0)],
+    )
+    merged_path = str(tmp_path / "merged.bin")
+    assert merge_word_indexes([index_path, other_path], merged_path)
+    with WordIndex(merged_path) as index:
+        assert index.docs() == ["asset1", "asset2"]
+        assert index.lookup("nederland") == [
+            Posting("asset1", 0, 1500),
+            Posting("asset1", 1, 5800),
+            Posting("asset2", 0, 100),
+        ]
+        assert index.lookup("weer") == [Posting("asset2", 0, 400)]
+        assert index.lookup("van") == [Posting("asset1", 1, 5600)]
+        assert index.num_postings == 12
+
+
+def test_merge_fails_on_invalid_index(index_path, tmp_path):
+    invalid_path = str(tmp_path / "invalid.bin")
+    with open(invalid_path, "wb") as f:
+        f.write(b"not a word index, but long enough for the header")
+    merged_path = str(tmp_path / "merged.bin")
+    assert not merge_word_indexes([index_path, invalid_path], merged_path)
+    assert not os.path.exists(merged_path)
+
+
+def test_truncated_index_is_rejected(index_path):
+    with open(index_path, "rb") as f:
+        data = f.read()
+    with open(index_path, "wb") as f:
+        f.write(data[:-4])
+    with pytest.raises(ValueError):
+        WordIndex(index_path)
@@ -1,42 +1,74 @@
 import logging
 import os
-from typing import Optional
+import shlex
+from typing import Iterable, Optional
 
 import base_util
-from base_util import output_base_dir
+from config import (
+    transcode_format,
+    transcode_sample_rate,
+    transcode_channels,
+    transcode_timeout,
+)
+from media_probe import AS_IS, STREAM_COPY, MediaInfo, choose_route, probe
 
 logger = logging.getLogger(__name__)
+TRANSCODE_DIR = "transcoded"  # next to the input, for inputs already in the format
 
 
-def try_transcode(input_path, asset_id, extension) -> Optional[str]:
+# reuse: use an earlier transcode of the input if there is one. The input is probed
+# (unless info is given) to find the cheapest way to get the audio in the right format
+def try_transcode(
+    input_path, asset_id, extension, reuse=True, info: Optional[MediaInfo] = None
+) -> Optional[str]:
     logger.info(
         f"Determining if transcode is required for input_path: {input_path} asset_id: ({asset_id}) extension: ({extension})"
     )
+    info = info or probe(input_path)
+    if info is None:
+        logger.error(f"Could not read the input with extension {extension}")
+        return None
+    route, reason = choose_route(info)
+    if route is None:  # e.g. a video without audio
+        logger.error(f"Cannot use the input: {reason}")
+        return None
 
     # if it's alrady valid audio no transcode necessary
-    if _is_audio_file(extension):
-        logger.info("No transcode required, input is audio")
+    if route == AS_IS:
+        logger.info(f"No transcode required, {reason}")
         return input_path
 
-    # if the input format is not supported, fail
-    if not _is_transcodable(extension):
-        logger.error(f"input with extension {extension} is not transcodable")
-        return None
-
-    # check if the input file was already transcoded
-    transcoded_file_path = os.path.join(output_base_dir, f"{asset_id}.mp3")
-    if os.path.exists(transcoded_file_path):
+    # check if the input file was already transcoded (into the configured format)
+    # (next to the input, which is in its own dir if another URI has the same name)
+    input_dir = os.path.dirname(input_path)
+    transcoded_file_path = os.path.join(input_dir, f"{asset_id}.{transcode_format}")
+    if transcoded_file_path == input_path:  # e.g. a 48 kHz stereo .wav input
+        # same file name in a subdir: the file name is the asset ID (Kaldi_NL's
+        # carrierId and the key of the later stages)
+        transcoded_file_path = os.path.join(
+            input_dir, TRANSCODE_DIR, f"{asset_id}.{transcode_format}"
+        )
+        os.makedirs(os.path.dirname(transcoded_file_path), exist_ok=True)
+    if reuse and os.path.exists(transcoded_file_path):
         logger.info("Transcoded file is already available, no new transcode needed")
         return transcoded_file_path
 
-    # go ahead and transcode the input file
-    success = transcode_to_mp3(
-        input_path,
-        transcoded_file_path,
-    )
+    # go ahead and transcode the input file (via a tmp file, so a failed
+    # transcode never leaves a partial file that is reused by the check above)
+    logger.info(f"Transcoding ({route}): {reason}")
+    tmp_file_path = f"{transcoded_file_path}.part"
+    if route == STREAM_COPY:
+        success = extract_audio(input_path, tmp_file_path)
+    elif transcode_format == "wav":
+        success = transcode_to_wav(input_path, tmp_file_path)
+    else:
+        success = transcode_to_mp3(input_path, tmp_file_path)
     if not success:
         logger.error("Transcode failed")
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
         return None
+    os.replace(tmp_file_path, transcoded_file_path)
 
     logger.info(
         f"Transcode of {extension} successful, returning: {transcoded_file_path}"
@@ -47,13 +79,52 @@ def try_transcode(input_path, asset_id, extension) -> Optional[str]:
 
 def transcode_to_mp3(path: str, asr_path: str) -> bool:
     logger.debug(f"Encoding file: {path}")
-    cmd = "ffmpeg -y -i {0} {1}".format(path, asr_path)
-    return base_util.run_shell_command(cmd)
-
-
-def _is_audio_file(extension):
-    return extension in [".mp3", ".wav"]
-
-
-def _is_transcodable(extension):
-    return extension in [".mov", ".mp4", ".m4a", ".3gp", ".3g2", ".mj2"]
+    cmd = "ffmpeg -y -i {0} -f mp3 {1}".format(shlex.quote(path), shlex.quote(asr_path))
+    return base_util.run_shell_command(cmd, transcode_timeout).success
+
+
+# copies the first audio stream as it is (it already has the right codec) into the
+# configured container, e.g. the PCM audio of a .mov or the mp3 audio of an .mp4
+def extract_audio(path: str, asr_path: str) -> bool:
+    logger.debug(f"Copying the audio stream of file: {path}")
+    cmd = (
+        "ffmpeg -nostdin -y -i {0} -map 0:a:0 -vn -sn -dn -c:a copy -f {1} {2}".format(
+            shlex.quote(path), transcode_format, shlex.quote(asr_path)
+        )
+    )
+    return base_util.run_shell_command(cmd, transcode_timeout).success
+
+
+# decodes only the first audio stream (video is not decoded at all) straight into
+# the PCM format Kaldi_NL works with, so it does not need to decode/resample again
+def transcode_to_wav(path: str, asr_path: str) -> bool:
+    logger.debug(f"Extracting audio to PCM from file: {path}")
+    cmd = (
+        "ffmpeg -nostdin -y -i {0} -map 0:a:0 -vn -sn -dn "
+        "-ac {1} -ar {2} -c:a pcm_s16le -f wav {3}"
+    ).format(
+        shlex.quote(path),
+        transcode_channels,
+        transcode_sample_rate,
+        shlex.quote(asr_path),
+    )
+    return base_util.run_shell_command(cmd, transcode_timeout).success
+
+
+# like transcode_to_wav/transcode_to_mp3, but the input is read from the chunks (e.g.
+# an HTTP response) on stdin, so it never has to be stored. Only works for containers
+# that can be read without seeking
+def transcode_stream(chunks: Iterable[bytes], asr_path: str) -> bool:
+    logger.debug(f"Extracting audio from a stream into: {asr_path}")
+    if transcode_format == "wav":
+        options = "-ac {0} -ar {1} -c:a pcm_s16le -f wav".format(
+            transcode_channels, transcode_sample_rate
+        )
+    else:
+        options = "-f mp3"
+    cmd = "ffmpeg -y -i pipe:0 -map 0:a:0 -vn -sn -dn {0} {1}".format(
+        options, shlex.quote(asr_path)
+    )
+    return base_util.run_shell_command(
+        cmd, transcode_timeout, stdin_chunks=chunks
+    ).success
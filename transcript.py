@@ -1,60 +1,150 @@
+from array import array
 import codecs
 from codecs import StreamReaderWriter
+from itertools import islice
 import json
 import logging
 import os
-from typing import TypedDict, List
+import textwrap
+from typing import IO, Iterator, List, Optional, Sequence, TypedDict
+
+from config import transcript_format, word_index
+from word_index import WordIndexWriter, word_index_file
 
 
 logger = logging.getLogger(__name__)
 CTM_FILE = "1Best.ctm"  # contains the word timings
 TXT_FILE = "1Best.txt"  # contains the words
 JSON_FILE = "transcript.json"  # transcript used for indexing
+NDJSON_FILE = "transcript.ndjson"  # same, but one segment per line
 
 
 class ParsedResult(TypedDict):
     words: str
-    wordTimes: List[int]
+    wordTimes: Sequence[int]  # array('i') while parsing, a list in the JSON
     start: float
     sequenceNr: int
     fragmentId: str
     carrierId: str
 
 
+# the transcript file generated for the configured TRANSCRIPT_FORMAT
+def transcript_file(asr_output_dir: str) -> str:
+    return os.path.join(
+        asr_output_dir, NDJSON_FILE if transcript_format == "ndjson" else JSON_FILE
+    )
+
+
+# all files generate_transcript writes: the transcript and (with WORD_INDEX) its index
+def transcript_files(asr_output_dir: str) -> List[str]:
+    files = [transcript_file(asr_output_dir)]
+    if word_index:
+        files.append(word_index_file(asr_output_dir))
+    return files
+
+
 # asr_output_dir e.g mount/asr-output/1272-128104-0000
-# NOTE: only handles Kaldi_NL generated files at this moment
+# NOTE: only handles Kaldi_NL generated files at this moment. Empty ASR output (e.g.
+# music only) gives an empty transcript, only missing/unparsable output is an error
 def generate_transcript(asr_output_dir: str) -> bool:
     logger.info(f"Generating transcript from: {asr_output_dir}")
     if not _is_valid_kaldi_output(asr_output_dir):
         return False
 
-    transcript = None
+    output_file = transcript_file(asr_output_dir)
+    tmp_file = f"{output_file}.part"
+    index_writer: Optional[WordIndexWriter] = None
+    if word_index:  # the asset ID is the name of the output dir
+        index_writer = WordIndexWriter(
+            os.path.basename(os.path.normpath(asr_output_dir))
+        )
     try:
-        with codecs.open(
-            os.path.join(asr_output_dir, CTM_FILE), encoding="utf-8"
-        ) as times_file:
+        # both files are read in a single pass, one line/segment at a time
+        with (
+            codecs.open(
+                os.path.join(asr_output_dir, CTM_FILE), encoding="utf-8"
+            ) as times_file,
+            codecs.open(
+                os.path.join(asr_output_dir, TXT_FILE), encoding="utf-8"
+            ) as asr_file,
+            open(tmp_file, "w", encoding="utf-8") as f,
+        ):
             times = _extract_time_info(times_file)
-
-        with codecs.open(
-            os.path.join(asr_output_dir, TXT_FILE), encoding="utf-8"
-        ) as asr_file:
             transcript = _parse_asr_results(asr_file, times)
-
-        if not transcript:
-            logger.error("Failed to generate transcript.json")
-            return False
-
-        # write transcript.json
-        with open(os.path.join(asr_output_dir, JSON_FILE), "w+", encoding="utf-8") as f:
-            logger.info(transcript)
-            json.dump(transcript, f, ensure_ascii=False, indent=4)
+            if index_writer:
+                transcript = _indexed(transcript, index_writer)
+            num_segments = _write_transcript(transcript, f)
+
+        os.replace(tmp_file, output_file)
+        if not num_segments:
+            logger.warning(f"No speech recognised, wrote an empty {output_file}")
+        else:
+            logger.info(f"Wrote {num_segments} segments to {output_file}")
+        if index_writer:
+            index_writer.write(word_index_file(asr_output_dir))
     except EnvironmentError as e:  # OSError or IOError...
-        logger.exception(os.strerror(e.errno))
+        logger.exception(os.strerror(e.errno) if e.errno else str(e))
+        _remove_if_exists(tmp_file)
+        return False
+    except (IndexError, ValueError):  # a malformed line in the 1Best.* files
+        logger.exception(f"Could not parse the ASR output in {asr_output_dir}")
+        _remove_if_exists(tmp_file)
         return False
 
     return True
 
 
+# writes the segments as soon as they are parsed, returns the number of segments
+def _write_transcript(transcript: Iterator[ParsedResult], f: IO[str]) -> int:
+    count = 0
+    for subtitle in transcript:
+        if transcript_format == "ndjson":
+            f.write(json.dumps(subtitle, ensure_ascii=False, default=list))
+            f.write("\n")
+        elif transcript_format == "compact":
+            f.write("," if count else "[")
+            f.write(
+                json.dumps(
+                    subtitle, ensure_ascii=False, default=list, separators=(",", ":")
+                )
+            )
+        else:  # same output as json.dump(transcript, f, indent=4)
+            f.write(",\n" if count else "[\n")
+            f.write(
+                textwrap.indent(
+                    json.dumps(subtitle, ensure_ascii=False, default=list, indent=4),
+                    " " * 4,
+                )
+            )
+        count += 1
+    if not count and transcript_format != "ndjson":
+        f.write("[]")
+    elif count and transcript_format == "compact":
+        f.write("]")
+    elif count and transcript_format == "pretty":
+        f.write("\n]")
+    return count
+
+
+def _remove_if_exists(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# adds the words of each segment to the word index as it passes by
+def _indexed(
+    transcript: Iterator[ParsedResult], index_writer: WordIndexWriter
+) -> Iterator[ParsedResult]:
+    for subtitle in transcript:
+        index_writer.add_segment(
+            subtitle["sequenceNr"],
+            subtitle["words"],
+            subtitle["wordTimes"],
+            subtitle["start"],
+        )
+        yield subtitle
+
+
 def _is_valid_kaldi_output(path: str) -> bool:
     if not all(
         [
@@ -73,9 +163,8 @@ def _is_valid_kaldi_output(path: str) -> bool:
 
 
 def _parse_asr_results(
-    asr_file: StreamReaderWriter, times: List[int]
-) -> List[ParsedResult]:
-    transcript = []
+    asr_file: StreamReaderWriter, times: Iterator[int]
+) -> Iterator[ParsedResult]:
     i = 0
     cur_pos = 0
 
@@ -85,7 +174,7 @@ def _parse_asr_results(
         # extract the text
         words = parts[0].strip()
         num_words = len(words.split(" "))
-        word_times = times[cur_pos : cur_pos + num_words]
+        word_times = array("i", islice(times, num_words))
         cur_pos = cur_pos + num_words
 
         # Check number of words matches the number of word_times
@@ -112,17 +201,12 @@ def _parse_asr_results(
             "fragmentId": fragid,
             "carrierId": carrier,
         }
-        transcript.append(subtitle)
+        yield subtitle
         i += 1
-    return transcript
-
 
-def _extract_time_info(times_file: StreamReaderWriter) -> List[int]:
-    times = []
 
+def _extract_time_info(times_file: StreamReaderWriter) -> Iterator[int]:
     for line in times_file:
         time_string = line.split(" ")[2]
         ms_value = int(float(time_string) * 1000)
-        times.append(ms_value)
-
-    return times
+        yield ms_value
@@ -0,0 +1,251 @@
+from bisect import bisect_right
+from dataclasses import asdict, dataclass, field
+from functools import cached_property
+import json
+import logging
+import os
+from typing import Callable, List, Optional, Tuple
+import wave
+
+from base_util import get_asset_info
+from config import (
+    vad_threshold_db,
+    vad_min_nonspeech,
+    vad_padding,
+    vad_gap,
+)
+from segmented_asr import detect_silences, get_duration
+from transcript import CTM_FILE, TXT_FILE
+
+logger = logging.getLogger(__name__)
+VAD_DIR = "vad"  # subdir of the ASR output dir with the speech only audio & its output
+TIME_MAP_FILE = "time_map.json"
+SPEECH_BAND_FILTER = "highpass=f=200,lowpass=f=4000"  # only count energy in this band
+MIN_SKIPPED_RATIO = 0.05  # not worth decoding a copy when less is skipped
+CHUNK_FRAMES = 64 * 1024  # frames copied at a time
+
+
+@dataclass
+class SpeechRegion:
+    start: float  # secs, in the original audio
+    end: float  # secs, in the original audio
+    offset: float  # secs, start in the speech only audio
+
+
+@dataclass
+class SpeechAudio:
+    audio_path: str  # the speech only audio, empty if the input is decoded as is
+    duration: float  # secs, of the original audio
+    regions: List[SpeechRegion] = field(default_factory=list)
+
+    @property
+    def speech_duration(self) -> float:
+        return sum([r.end - r.start for r in self.regions])
+
+    @property
+    def skipped_duration(self) -> float:
+        return self.duration - self.speech_duration
+
+    @property
+    def speech_ratio(self) -> float:
+        return self.speech_duration / self.duration if self.duration > 0 else 1
+
+    # the offsets of the regions, built once for all the words that are mapped back
+    @cached_property
+    def _offsets(self) -> List[float]:
+        return [r.offset for r in self.regions]
+
+    # maps a time in the speech only audio back to the original audio
+    def to_original_time(self, t: float) -> float:
+        i = max(bisect_right(self._offsets, t) - 1, 0)
+        region = self.regions[i]
+        limit = (
+            self.regions[i + 1].start if i + 1 < len(self.regions) else self.duration
+        )
+        return min(region.start + max(t - region.offset, 0), limit)
+
+
+# writes a copy of the (PCM wav) input without the non-speech regions to the ASR
+# output dir (unless reuse and that was already done). Returns None if the ASR should
+# just use the input (nothing to skip, not a PCM wav or failure). That there is
+# nothing to skip is saved as well (as a time map without audio), so it is reused
+def filter_speech(
+    input_path: str, output_dir: str, reuse: bool = True
+) -> Optional[SpeechAudio]:
+    vad_dir = os.path.join(output_dir, VAD_DIR)
+    time_map_path = time_map_file(output_dir)
+    if reuse and os.path.exists(time_map_path):
+        speech = _load_time_map(time_map_path)
+        if speech and not speech.audio_path:
+            logger.info("Nothing to skip in the input (found before)")
+            return None
+        if speech and os.path.exists(speech.audio_path):
+            logger.info(f"Speech only audio already available: {speech.audio_path}")
+            return speech
+    if os.path.exists(time_map_path):
+        os.remove(time_map_path)  # of another (version of the) input
+
+    if not input_path.endswith(".wav"):
+        logger.warning(f"Not skipping non-speech: {input_path} is not a PCM wav")
+        return None
+    duration = get_duration(input_path)
+    silences = detect_silences(
+        input_path, vad_threshold_db, vad_min_nonspeech, SPEECH_BAND_FILTER
+    )
+    regions = speech_regions(duration, silences)
+    if not regions:
+        logger.warning(f"No speech found in {input_path}, decoding it as is")
+        _save_nothing_to_skip(time_map_path, duration)
+        return None
+
+    asset_id, _ = get_asset_info(input_path)
+    speech = SpeechAudio(os.path.join(vad_dir, f"{asset_id}.wav"), duration, regions)
+    logger.info(
+        f"Speech: {speech.speech_duration:.1f}s of {duration:.1f}s "
+        f"in {len(regions)} region(s)"
+    )
+    if speech.skipped_duration < duration * MIN_SKIPPED_RATIO:
+        logger.info("Hardly any non-speech, decoding the input as is")
+        _save_nothing_to_skip(time_map_path, duration)
+        return None
+
+    os.makedirs(vad_dir, exist_ok=True)
+    try:
+        _write_speech_audio(input_path, speech)
+        _write_time_map(time_map_path, speech)
+    except (OSError, wave.Error, EOFError):
+        logger.exception(f"Failed to write the speech only audio of {input_path}")
+        return None
+    return speech
+
+
+def time_map_file(output_dir: str) -> str:
+    return os.path.join(output_dir, VAD_DIR, TIME_MAP_FILE)
+
+
+# the regions to keep (with their offset in the speech only audio), given the
+# non-speech regions found by silencedetect
+def speech_regions(
+    duration: float, silences: List[Tuple[float, float]]
+) -> List[SpeechRegion]:
+    kept: List[Tuple[float, float]] = []
+    pos = 0.0
+    for start, end in silences:
+        start = start + vad_padding if start > 0 else 0
+        end = min(end - vad_padding, duration) if end < duration else duration
+        if end <= start:
+            continue
+        if start > pos:
+            kept.append((pos, start))
+        pos = max(pos, end)
+    if pos < duration:
+        kept.append((pos, duration))
+
+    regions = []
+    offset = 0.0
+    for start, end in kept:
+        regions.append(SpeechRegion(start, end, offset))
+        offset += end - start + vad_gap
+    return regions
+
+
+# runs decode on the speech only audio and writes its output, with the times mapped
+# back to the original audio, to output_dir
+def decode_speech(
+    speech: SpeechAudio, output_dir: str, decode: Callable[[str, str], bool]
+) -> bool:
+    vad_output_dir = os.path.join(output_dir, VAD_DIR, "asr")
+    if not decode(speech.audio_path, vad_output_dir):
+        return False
+    txt_path = os.path.join(output_dir, TXT_FILE)
+    ctm_path = os.path.join(output_dir, CTM_FILE)
+    try:
+        with (
+            open(os.path.join(vad_output_dir, TXT_FILE), encoding="utf-8") as txt_in,
+            open(f"{txt_path}.part", "w", encoding="utf-8") as txt_out,
+        ):
+            for line in txt_in:
+                txt_out.write(_map_txt_line(line, speech))
+        with (
+            open(os.path.join(vad_output_dir, CTM_FILE), encoding="utf-8") as ctm_in,
+            open(f"{ctm_path}.part", "w", encoding="utf-8") as ctm_out,
+        ):
+            for line in ctm_in:
+                ctm_out.write(_map_ctm_line(line, speech))
+        os.replace(f"{txt_path}.part", txt_path)
+        os.replace(f"{ctm_path}.part", ctm_path)
+    except (OSError, IndexError, ValueError):
+        logger.exception(f"Failed to map the ASR output back into {output_dir}")
+        return False
+    os.remove(speech.audio_path)  # the time map and the ASR output are kept
+    return True
+
+
+def _write_speech_audio(input_path: str, speech: SpeechAudio):
+    tmp_path = f"{speech.audio_path}.part"
+    with wave.open(input_path, "rb") as w_in, wave.open(tmp_path, "wb") as w_out:
+        w_out.setparams(w_in.getparams())
+        rate = w_in.getframerate()
+        gap = b"\0" * int(vad_gap * rate) * w_in.getsampwidth() * w_in.getnchannels()
+        for i, region in enumerate(speech.regions):
+            if i > 0:
+                w_out.writeframes(gap)
+            w_in.setpos(int(region.start * rate))
+            remaining = int(region.end * rate) - int(region.start * rate)
+            while remaining > 0:
+                frames = w_in.readframes(min(remaining, CHUNK_FRAMES))
+                if not frames:
+                    break
+                w_out.writeframes(frames)
+                remaining -= min(remaining, CHUNK_FRAMES)
+    os.replace(tmp_path, speech.audio_path)
+
+
+# saves an identity time map without audio, so a rerun knows there is nothing to skip
+def _save_nothing_to_skip(time_map_path: str, duration: float):
+    try:
+        os.makedirs(os.path.dirname(time_map_path), exist_ok=True)
+        _write_time_map(
+            time_map_path, SpeechAudio("", duration, [SpeechRegion(0, duration, 0)])
+        )
+    except OSError:
+        logger.exception(f"Failed to write {time_map_path}")
+
+
+def _write_time_map(path: str, speech: SpeechAudio):
+    with open(f"{path}.part", "w", encoding="utf-8") as f:
+        json.dump(asdict(speech), f, indent=4)
+    os.replace(f"{path}.part", path)
+
+
+def _load_time_map(path: str) -> Optional[SpeechAudio]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        data["regions"] = [SpeechRegion(**r) for r in data["regions"]]
+        return SpeechAudio(**data)
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.exception(f"Could not read {path}")
+        return None
+
+
+# e.g. "words words (carrier.0001 12.340)"
+def _map_txt_line(line: str, speech: SpeechAudio) -> str:
+    words, info = line.rstrip("\n").split("(", 1)
+    fields = info.split(" ")
+    start = fields[1].rstrip(")")
+    fields[1] = _map(start, speech) + fields[1][len(start) :]
+    return f"{words}({' '.join(fields)}\n"
+
+
+# e.g. "carrier.0001 1 12.34 0.33 word 1.00"
+def _map_ctm_line(line: str, speech: SpeechAudio) -> str:
+    fields = line.rstrip("\n").split(" ")
+    fields[2] = _map(fields[2], speech)
+    return f"{' '.join(fields)}\n"
+
+
+# maps the time, keeping the number of decimals of the original value
+def _map(value: str, speech: SpeechAudio) -> str:
+    decimals = len(value.split(".")[1]) if "." in value else 0
+    return f"{speech.to_original_time(float(value)):.{decimals}f}"
@@ -0,0 +1,354 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+import logging
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+WORD_INDEX_FILE = "word_index.bin"  # in the ASR output dir, next to the transcript
+MAGIC = b"ASRWIDX\0"
+VERSION = 1
+# magic, version, docs, terms, postings, bytes of the doc IDs & bytes of the terms
+HEADER = struct.Struct("<8sIIIIII")
+POSTING_FIELDS = 3  # each posting is a packed (doc, segment index, word time in ms)
+
+# Compact binary word index of one or more transcripts (docs), meant to be searched
+# with mmap instead of parsing the transcript JSON. All integers are little endian
+# uint32, every section is padded to a multiple of 4 bytes:
+#   header
+#   doc offsets    num_docs + 1 offsets into the doc IDs
+#   doc IDs        UTF-8 asset IDs, concatenated
+#   term offsets   num_terms + 1 offsets into the terms
+#   term postings  num_terms + 1 indexes of the first posting of each term
+#   terms          UTF-8 terms, concatenated & sorted (as bytes)
+#   postings       num_postings * (doc, segment, time), sorted by doc & time per term
+
+
+class Posting(NamedTuple):
+    doc: str  # asset ID
+    segment: int  # sequenceNr of the segment in the transcript
+    time: int  # ms
+
+
+class WordIndex:
+    """
+    Read-only view of a word index file. The file is memory-mapped and only the
+    terms & postings that are looked up are read, so opening a (collection) index
+    is cheap whatever its size. Use it as a context manager or call close().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._open()
+        except ValueError:
+            self._mmap.close()
+            raise
+
+    def _open(self):
+        _check_platform()
+        if len(self._mmap) < HEADER.size:
+            raise ValueError(f"{self.path} is not a word index (too small)")
+        magic, version, num_docs, num_terms, num_postings, docs_size, terms_size = (
+            HEADER.unpack_from(self._mmap)
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{self.path} is not a version {VERSION} word index")
+        sections = [
+            (num_docs + 1) * 4,
+            _padded(docs_size),
+            (num_terms + 1) * 4,
+            (num_terms + 1) * 4,
+            _padded(terms_size),
+            num_postings * POSTING_FIELDS * 4,
+        ]
+        if len(self._mmap) != HEADER.size + sum(sections):
+            raise ValueError(f"{self.path} is truncated or corrupt")
+        view = memoryview(self._mmap)
+        offsets = [HEADER.size]
+        for size in sections:
+            offsets.append(offsets[-1] + size)
+        self._doc_offsets = _uint32s(view, offsets[0], num_docs + 1)
+        self._docs = view[offsets[1] : offsets[1] + docs_size]
+        self._term_offsets = _uint32s(view, offsets[2], num_terms + 1)
+        self._term_postings = _uint32s(view, offsets[3], num_terms + 1)
+        self._terms = view[offsets[4] : offsets[4] + terms_size]
+        self._postings = _uint32s(view, offsets[5], num_postings * POSTING_FIELDS)
+        self._views = [
+            self._doc_offsets,
+            self._docs,
+            self._term_offsets,
+            self._term_postings,
+            self._terms,
+            self._postings,
+            view,
+        ]
+        self.num_docs, self.num_terms, self.num_postings = (
+            num_docs,
+            num_terms,
+            num_postings,
+        )
+
+    def __enter__(self) -> "WordIndex":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def doc(self, i: int) -> str:
+        start, end = self._doc_offsets[i], self._doc_offsets[i + 1]
+        return bytes(self._docs[start:end]).decode("utf-8")
+
+    def docs(self) -> List[str]:
+        return [self.doc(i) for i in range(self.num_docs)]
+
+    def term(self, i: int) -> str:
+        return self._term_bytes(i).decode("utf-8")
+
+    def terms(self, prefix: str = "") -> Iterator[str]:
+        start, end = self._prefix_range(prefix)
+        for i in range(start, end):
+            yield self.term(i)
+
+    # the occurrences of the word, optionally only those in [start_ms, end_ms)
+    def lookup(
+        self, term: str, start_ms: int = 0, end_ms: Optional[int] = None
+    ) -> List[Posting]:
+        key = _normalise(term).encode("utf-8")
+        i = bisect_left(range(self.num_terms), key, key=self._term_bytes)
+        if i == self.num_terms or self._term_bytes(i) != key:
+            return []
+        return list(self._term_range(i, start_ms, end_ms))
+
+    # the occurrences of all words starting with prefix, per word
+    def lookup_prefix(
+        self, prefix: str, start_ms: int = 0, end_ms: Optional[int] = None
+    ) -> Dict[str, List[Posting]]:
+        start, end = self._prefix_range(prefix)
+        results = {
+            self.term(i): list(self._term_range(i, start_ms, end_ms))
+            for i in range(start, end)
+        }
+        return {term: postings for term, postings in results.items() if postings}
+
+    # the raw (doc, segment, time) triples of the i-th term, for merging
+    def _raw_postings(self, i: int) -> memoryview:
+        start, end = self._term_postings[i], self._term_postings[i + 1]
+        return self._postings[start * POSTING_FIELDS : end * POSTING_FIELDS]
+
+    def _term_range(
+        self, i: int, start_ms: int, end_ms: Optional[int]
+    ) -> Iterator[Posting]:
+        postings = self._raw_postings(i)
+        for p in range(0, len(postings), POSTING_FIELDS):
+            doc, segment, time = postings[p : p + POSTING_FIELDS]
+            if time >= start_ms and (end_ms is None or time < end_ms):
+                yield Posting(self.doc(doc), segment, time)
+
+    def _term_bytes(self, i: int) -> bytes:
+        return bytes(self._terms[self._term_offsets[i] : self._term_offsets[i + 1]])
+
+    # the terms starting with prefix are i for start <= i < end
+    def _prefix_range(self, prefix: str) -> Tuple[int, int]:
+        key = _normalise(prefix).encode("utf-8")
+        terms = range(self.num_terms)
+        start = bisect_left(terms, key, key=self._term_bytes)
+        # the terms cut to the length of the prefix are just as sorted
+        end = bisect_right(
+            terms, key, lo=start, key=lambda i: self._term_bytes(i)[: len(key)]
+        )
+        return start, end
+
+
+class WordIndexWriter:
+    """
+    Collects the words of the segments of one transcript (as they are generated)
+    and writes them as a word index with the asset ID as its only doc.
+    """
+
+    def __init__(self, asset_id: str):
+        self.asset_id = asset_id
+        self._postings: Dict[str, array] = {}  # per term: (0, segment, time) triples
+
+    def add_segment(
+        self, segment: int, words: str, word_times: Sequence[int], start: float
+    ):
+        words_list = words.split()
+        # Kaldi_NL's output should have a time for every word, if not the segment
+        # start is the best guess
+        times = list(word_times[: len(words_list)])
+        times += [int(start)] * (len(words_list) - len(times))
+        for word, time in zip(words_list, times):
+            term = _normalise(word)
+            if term not in self._postings:
+                self._postings[term] = array("I")
+            self._postings[term].extend([0, segment, max(0, time)])
+
+    def write(self, path: str):
+        terms = sorted(self._postings, key=lambda t: t.encode("utf-8"))
+        _write_index(
+            path,
+            [self.asset_id],
+            [t.encode("utf-8") for t in terms],
+            [len(self._postings[t]) // POSTING_FIELDS for t in terms],
+            # the segments (and their words) are added in order of time
+            (self._postings[t] for t in terms),
+        )
+
+
+# the word index of the transcript in asr_output_dir
+def word_index_file(asr_output_dir: str) -> str:
+    return os.path.join(asr_output_dir, WORD_INDEX_FILE)
+
+
+# merges (asset) word indexes into a single (collection) index, in two passes over
+# the sorted terms of the indexes: one to count & one to copy the postings, so only
+# the merged terms are kept in memory. The docs are numbered in the order of paths
+def merge_word_indexes(paths: List[str], output_path: str) -> bool:
+    indexes: List[WordIndex] = []
+    try:
+        for path in paths:
+            indexes.append(WordIndex(path))
+        doc_base = [0]
+        for index in indexes[:-1]:
+            doc_base.append(doc_base[-1] + index.num_docs)
+        terms: List[bytes] = []
+        counts: List[int] = []
+        for term, group in _merged_terms(indexes):
+            terms.append(term)
+            counts.append(
+                sum([len(indexes[s]._raw_postings(i)) for s, i in group])
+                // POSTING_FIELDS
+            )
+        _write_index(
+            output_path,
+            [doc for index in indexes for doc in index.docs()],
+            terms,
+            counts,
+            (
+                _renumbered(indexes[s]._raw_postings(i), doc_base[s])
+                for _, group in _merged_terms(indexes)
+                for s, i in group
+            ),
+        )
+    except (OSError, ValueError):
+        logger.exception(f"Failed to merge the word indexes into {output_path}")
+        return False
+    finally:
+        for index in indexes:
+            index.close()
+    logger.info(
+        f"Merged {len(paths)} word indexes into {output_path} ({len(terms)} terms)"
+    )
+    return True
+
+
+# per term (in sorted order): the (index, term number) of the indexes that have it
+def _merged_terms(
+    indexes: List[WordIndex],
+) -> Iterator[Tuple[bytes, List[Tuple[int, int]]]]:
+    streams = [_sorted_terms(index, s) for s, index in enumerate(indexes)]
+    term = b""
+    group: List[Tuple[int, int]] = []
+    for next_term, s, i in heapq.merge(*streams):
+        if group and next_term != term:
+            yield term, group
+            group = []
+        term = next_term
+        group.append((s, i))
+    if group:
+        yield term, group
+
+
+def _sorted_terms(index: WordIndex, s: int) -> Iterator[Tuple[bytes, int, int]]:
+    for i in range(index.num_terms):
+        yield index._term_bytes(i), s, i
+
+
+def _renumbered(postings: memoryview, doc_base: int) -> array:
+    renumbered = array("I", postings)
+    if doc_base:
+        docs = renumbered[::POSTING_FIELDS]
+        renumbered[::POSTING_FIELDS] = array("I", [d + doc_base for d in docs])
+    return renumbered
+
+
+# writes the sections (see the top of this file) to a .part file first, the postings
+# are given per term (as packed triples) in the order of the terms
+def _write_index(
+    path: str,
+    docs: List[str],
+    terms: List[bytes],
+    counts: List[int],
+    postings: Iterable[array],
+):
+    _check_platform()
+    doc_ids = [d.encode("utf-8") for d in docs]
+    docs_blob, terms_blob = b"".join(doc_ids), b"".join(terms)
+    with open(f"{path}.part", "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                VERSION,
+                len(docs),
+                len(terms),
+                sum(counts),
+                len(docs_blob),
+                len(terms_blob),
+            )
+        )
+        f.write(_offsets([len(d) for d in doc_ids]).tobytes())
+        f.write(_pad(docs_blob))
+        f.write(_offsets([len(t) for t in terms]).tobytes())
+        f.write(_offsets(counts).tobytes())
+        f.write(_pad(terms_blob))
+        written = 0
+        for term_postings in postings:
+            term_postings.tofile(f)
+            written += len(term_postings)
+    if written != sum(counts) * POSTING_FIELDS:
+        os.remove(f"{path}.part")
+        raise ValueError(f"Expected {sum(counts)} postings, got {written}")
+    os.replace(f"{path}.part", path)
+
+
+def _offsets(sizes: List[int]) -> array:
+    offsets = array("I", [0])
+    for size in sizes:
+        offsets.append(offsets[-1] + size)
+    return offsets
+
+
+def _uint32s(view: memoryview, offset: int, count: int) -> memoryview:
+    return view[offset : offset + count * 4].cast("I")
+
+
+def _padded(size: int) -> int:
+    return (size + 3) // 4 * 4
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (_padded(len(data)) - len(data))
+
+
+# the words are looked up case insensitive
+def _normalise(word: str) -> str:
+    return word.lower()
+
+
+# the file is read & written as native uint32 arrays
+def _check_platform():
+    if sys.byteorder != "little" or array("I").itemsize != 4:
+        raise ValueError("Word indexes are only supported on little endian platforms")
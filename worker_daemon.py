@@ -0,0 +1,95 @@
+import logging
+import signal
+import sys
+import threading
+from typing import List
+
+from base_util import cancel_running_commands
+from config import (
+    job_max_attempts,
+    job_retry_backoff,
+    job_poll_interval,
+    worker_concurrency,
+)
+from job_queue import Job, JobQueue
+import simple_asr
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerDaemon:
+    """
+    Long-lived worker that keeps taking jobs from a JobQueue, so the process start
+    up and the pooled HTTP/S3 clients are reused for every asset. On SIGTERM/SIGINT
+    the running jobs are finished before exiting, a second signal cancels them.
+    """
+
+    def __init__(self, queue: JobQueue, concurrency: int = worker_concurrency):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.stop_event = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        logger.info(f"Starting worker daemon with {self.concurrency} worker(s)")
+        for i in range(self.concurrency):
+            thread = threading.Thread(
+                target=self._work, name=f"worker-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        # join with a timeout, so the main thread keeps handling signals
+        while any([t.is_alive() for t in self.threads]):
+            for thread in self.threads:
+                thread.join(timeout=1)
+        logger.info("Worker daemon stopped")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _on_signal(self, signum, frame):
+        if self.stop_event.is_set():
+            logger.warning(f"Received signal {signum} again, cancelling running jobs")
+            cancel_running_commands(wait=True)
+            sys.exit(128 + signum)
+        logger.warning(
+            f"Received signal {signum}, finishing the running jobs "
+            "(send it again to cancel them)"
+        )
+        self.stop()
+
+    def _work(self):
+        while not self.stop_event.is_set():
+            try:
+                job = self.queue.get()
+            except Exception:
+                logger.exception("Failed to get a job from the queue")
+                job = None
+            if not job:
+                self.stop_event.wait(job_poll_interval)
+                continue
+            self._process(job)
+
+    def _process(self, job: Job):
+        logger.info(f"Processing job {job.id} (attempt {job.attempts}): {job}")
+        error = ""
+        try:
+            success = simple_asr.run(job.input_uri, job.output_uri or "")
+        except Exception as e:
+            logger.exception(f"Job {job.id} failed")
+            success, error = False, repr(e)
+        try:
+            if success:
+                self.queue.ack(job)
+            elif job.attempts < job_max_attempts:
+                delay = job_retry_backoff * 2 ** (job.attempts - 1)
+                logger.warning(f"Job {job.id} failed, retrying in {delay}s")
+                self.queue.retry(job, delay, error)
+            else:
+                logger.error(f"Job {job.id} failed {job.attempts} times, giving up")
+                self.queue.fail(job, error)
+        except Exception:
+            # the job is handed out again after the visibility timeout
+            logger.exception(f"Failed to update the status of job {job.id}")